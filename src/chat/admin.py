@@ -1,3 +1,13 @@
 from django.contrib import admin
 
+from .models import TokenUsage
+
 # Register your models here.
+
+
+@admin.register(TokenUsage)
+class TokenUsageAdmin(admin.ModelAdmin):
+    list_display = ("created", "room", "source", "model", "prompt_tokens", "completion_tokens", "latency")
+    list_filter = ("source", "model", "created")
+    search_fields = ("room",)
+    date_hierarchy = "created"
@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import job_queue
+from . import metrics
+
+# Bounded pool of threads for the blocking agent runs (LLM calls, Chrome, DynamoDB)
+executor = ThreadPoolExecutor(
+    max_workers=settings.CHAT_AGENT_WORKERS, thread_name_prefix="chat-agent"
+)
+
+# One lock per room so that messages in the same room are answered in order
+_room_locks = {}
+_room_pending = {}
+
+# At most CHAT_MAX_CONCURRENT_RUNS runs at a time, one semaphore per event loop
+_run_slots = weakref.WeakKeyDictionary()
+# Moving average of a run's duration, for the retry hint of admit()
+_run_seconds = 5.0
+
+
+def queue_depth():
+    # Number of jobs running or waiting for a worker across all rooms
+    return sum(_room_pending.values())
+
+
+def room_queue_depth(room_name):
+    return _room_pending.get(room_name, 0)
+
+
+metrics.register_gauge("chat_agent_queue_depth", "Agent runs running or waiting across all rooms.", queue_depth)
+
+
+# Runs at once, 0 would never run anything
+def max_runs():
+    return max(1, settings.CHAT_MAX_CONCURRENT_RUNS)
+
+
+# 0 if another run can be queued, otherwise the seconds until one probably can
+def admit():
+    running = max_runs()
+    if settings.CHAT_AGENT_MODE == "queue":
+        # The runs are on the workers, what waits for them is the shared queue
+        waiting = job_queue.get_queue().depth()
+        if waiting < settings.CHAT_MAX_QUEUED_RUNS:
+            return 0
+        return _run_seconds * (waiting - settings.CHAT_MAX_QUEUED_RUNS + 1) / running
+
+    depth = queue_depth()
+    if depth < running + settings.CHAT_MAX_QUEUED_RUNS:
+        return 0
+    return _run_seconds * (depth - running + 1) / running
+
+
+# admit() for the event loop, in queue mode it asks Redis
+async def aadmit():
+    if settings.CHAT_AGENT_MODE == "queue":
+        return await sync_to_async(admit, thread_sensitive=False)()
+    return admit()
+
+
+def _run_slot():
+    loop = asyncio.get_running_loop()
+    slot = _run_slots.get(loop)
+    if slot is None:
+        slot = _run_slots[loop] = asyncio.Semaphore(max_runs())
+    return slot
+
+
+# Hold the room's turn, and one of the run slots, for the duration of the block
+@contextlib.asynccontextmanager
+async def room_turn(room_name):
+    global _run_seconds
+
+    lock = _room_locks.get(room_name)
+    if lock is None:
+        lock = _room_locks[room_name] = asyncio.Lock()
+    _room_pending[room_name] = _room_pending.get(room_name, 0) + 1
+
+    slot = _run_slot()
+    try:
+        with metrics.span("queue_wait"):
+            await lock.acquire()
+            try:
+                await slot.acquire()
+            except BaseException:
+                lock.release()
+                raise
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _run_seconds = 0.9 * _run_seconds + 0.1 * (time.perf_counter() - start)
+            slot.release()
+            lock.release()
+    finally:
+        # Forget the room once nothing is queued for it
+        _room_pending[room_name] -= 1
+        if _room_pending[room_name] == 0:
+            del _room_pending[room_name]
+            del _room_locks[room_name]
+
+
+async def run_for_room(room_name, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # The worker sees the caller's context, e.g. the trace of the message
+    context = contextvars.copy_context()
+    async with room_turn(room_name):
+        return await loop.run_in_executor(
+            executor, functools.partial(context.run, func, *args, **kwargs)
+        )
+
+
+# Same as run_for_room for a coroutine function, it runs on the event loop
+async def arun_for_room(room_name, func, *args, **kwargs):
+    async with room_turn(room_name):
+        return await func(*args, **kwargs)
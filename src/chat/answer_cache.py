@@ -0,0 +1,171 @@
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Exported by openai_utils.get_doc_answers(), name -> help text
+cache_gauges = {
+    "hits": "Document questions answered from the answer cache.",
+    "exact_hits": "Document questions answered from the answer cache with the same wording.",
+    "misses": "Document questions that went to the document search.",
+    "hit_rate": "Share of document questions answered from the answer cache.",
+    "size": "Answers in the answer cache.",
+    "invalidations": "Times the answer cache was cleared because the document index changed.",
+    "estimated_time_saved_s": "Seconds of document search the answer cache saved.",
+}
+
+
+def normalise_question(question):
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+
+# Answers of the document search keyed by the meaning of the question.
+# A question close enough to one answered before (cosine similarity of the
+# embeddings at least `threshold`) gets the stored answer. Entries expire
+# after `ttl` seconds, the least recently used is evicted when full, and
+# everything is dropped when `fingerprint()` reports a changed index.
+class SemanticAnswerCache:
+    def __init__(self, embeddings, threshold=0.95, maxsize=500, ttl=3600,
+                 fingerprint=lambda: None, fingerprint_interval=10):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.fingerprint = fingerprint
+        self.fingerprint_interval = fingerprint_interval
+
+        # normalised question -> (stored at, unit vector, answer)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._index_fingerprint = fingerprint()
+        self._fingerprint_checked = time.monotonic()
+
+        self.hits = 0
+        self.exact_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.time_saved = 0.0
+        self._answer_times = []
+
+    def _embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # Drop every answer once the documents behind them changed
+    def _check_fingerprint(self):
+        now = time.monotonic()
+        if now - self._fingerprint_checked < self.fingerprint_interval:
+            return
+        self._fingerprint_checked = now
+        current = self.fingerprint()
+        if current != self._index_fingerprint:
+            with self._lock:
+                self._entries.clear()
+            self._index_fingerprint = current
+            self.invalidations += 1
+
+    def _expire(self, now):
+        for key in [key for key, entry in self._entries.items() if now - entry[0] > self.ttl]:
+            del self._entries[key]
+
+    # Returns the stored answer for the question or None. `vector` is the
+    # embedding of the question, or None to only look for the same wording.
+    def _lookup(self, key, vector):
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[2], True
+            if vector is None or not self._entries:
+                return None, False
+
+            keys = list(self._entries)
+            matrix = np.stack([self._entries[key][1] for key in keys])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None, False
+            self._entries.move_to_end(keys[best])
+            return self._entries[keys[best]][2], False
+
+    def _store(self, key, vector, answer):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), vector, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _record_hit(self, exact):
+        self.hits += 1
+        if exact:
+            self.exact_hits += 1
+        if self._answer_times:
+            self.time_saved += sum(self._answer_times) / len(self._answer_times)
+
+    def _record_miss(self, elapsed):
+        self.misses += 1
+        self._answer_times.append(elapsed)
+        del self._answer_times[:-100]
+
+    # Return a cached answer for the question or call `answer(question)` and keep its result
+    def get_or_answer(self, question, answer):
+        self._check_fingerprint()
+        key = normalise_question(question)
+
+        # The same wording does not need an embedding
+        cached, exact = self._lookup(key, None)
+        if cached is None:
+            vector = self._embed(question)
+            cached, exact = self._lookup(key, vector)
+        if cached is not None:
+            self._record_hit(exact)
+            return cached
+
+        start = time.perf_counter()
+        result = answer(question)
+        self._record_miss(time.perf_counter() - start)
+        self._store(key, vector, result)
+        return result
+
+    # Same as get_or_answer for a coroutine `answer`
+    async def aget_or_answer(self, question, answer):
+        loop = asyncio.get_running_loop()
+        # Reads the index manifest, keep it off the event loop
+        await loop.run_in_executor(None, self._check_fingerprint)
+        key = normalise_question(question)
+
+        cached, exact = self._lookup(key, None)
+        if cached is None:
+            vector = await loop.run_in_executor(None, self._embed, question)
+            cached, exact = self._lookup(key, vector)
+        if cached is not None:
+            self._record_hit(exact)
+            return cached
+
+        start = time.perf_counter()
+        result = await answer(question)
+        self._record_miss(time.perf_counter() - start)
+        self._store(key, vector, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "exact_hits": self.exact_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "size": len(self._entries),
+            "invalidations": self.invalidations,
+            "estimated_time_saved_s": self.time_saved,
+        }
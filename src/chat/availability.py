@@ -0,0 +1,230 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from . import metrics
+from .caching import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+def normalise_date(date):
+    for date_format in ("%d-%m-%Y", "%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(date.strip(), date_format).strftime("%d-%m-%Y")
+        except ValueError:
+            continue
+    return date.strip()
+
+
+# Searches that are the same for IHG map to the same key
+def availability_key(num_adult, num_children, num_rooms, check_in_date, check_out_date):
+    return (
+        int(num_adult),
+        int(num_children),
+        int(num_rooms),
+        normalise_date(check_in_date),
+        normalise_date(check_out_date),
+    )
+
+
+# Cache of scraped room availability. Looks in process memory first, then
+# in Redis (shared by every worker) if enabled. Identical searches that
+# run at the same time wait for a single scrape.
+class AvailabilityCache:
+    redis_prefix = "chat:availability:"
+
+    def __init__(self, maxsize, ttl, redis_client=None, scrape_timeout=120):
+        self.local = TTLCache(maxsize, ttl)
+        self.ttl = ttl
+        self.redis = redis_client
+        self.scrape_timeout = scrape_timeout
+        self._inflight = {}  # key -> Future of the running scrape
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.hit_ages = []
+
+    def _redis_key(self, key):
+        return self.redis_prefix + ":".join(str(part) for part in key)
+
+    def _get_shared(self, key):
+        if self.redis is None:
+            return None
+        try:
+            raw = self.redis.get(self._redis_key(key))
+        except Exception as e:
+            logger.warning("Availability cache Redis read failed: %s", e)
+            return None
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return entry["rooms"], time.time() - entry["stored"]
+
+    def _set_shared(self, key, rooms):
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(
+                self._redis_key(key), json.dumps({"rooms": rooms, "stored": time.time()}), ex=self.ttl
+            )
+        except Exception as e:
+            logger.warning("Availability cache Redis write failed: %s", e)
+
+    def _record_hit(self, age):
+        self.hit_ages.append(age)
+        del self.hit_ages[:-1000]
+
+    def get(self, key):
+        cached = self.local.get(key)
+        if cached is not None:
+            self.hits += 1
+            self._record_hit(cached[1])
+            return cached[0]
+
+        cached = self._get_shared(key)
+        if cached is not None:
+            self.redis_hits += 1
+            self._record_hit(cached[1])
+            self.local.set(key, cached[0])
+            return cached[0]
+        return None
+
+    def set(self, key, rooms):
+        self.local.set(key, rooms)
+        self._set_shared(key, rooms)
+
+    # Return the cached rooms for the search or run `fetch` once for everyone asking.
+    # `cacheable` decides whether a result is worth keeping (errors are not).
+    def get_or_fetch(self, key, fetch, cacheable=lambda rooms: True):
+        rooms = self.get(key)
+        if rooms is not None:
+            return rooms
+
+        future, owner = self._claim(key)
+        if not owner:
+            return future.result(timeout=self.scrape_timeout)
+
+        try:
+            rooms = fetch()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, rooms, cacheable)
+        return rooms
+
+    # Same as get_or_fetch for a coroutine `fetch`, sync and async callers
+    # share the same in-flight scrapes
+    async def aget_or_fetch(self, key, fetch, cacheable=lambda rooms: True):
+        rooms = await self._off_loop(self.get, key)
+        if rooms is not None:
+            return rooms
+
+        future, owner = self._claim(key)
+        if not owner:
+            return await asyncio.wrap_future(future)
+
+        try:
+            rooms = await fetch()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        await self._off_loop(self._finish, key, future, rooms, cacheable)
+        return rooms
+
+    # The Redis round trips of aget_or_fetch run on a worker thread
+    async def _off_loop(self, func, *args):
+        if self.redis is None:
+            return func(*args)
+        return await sync_to_async(func, thread_sensitive=False)(*args)
+
+    # Returns the future of the scrape for `key` and whether the caller has to run it
+    def _claim(self, key):
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if owner:
+            self.misses += 1
+        else:
+            self.joined += 1
+        return future, owner
+
+    def _finish(self, key, future, rooms=None, cacheable=None, exception=None):
+        if exception is None and cacheable(rooms):
+            self.set(key, rooms)
+        with self._lock:
+            del self._inflight[key]
+        if exception is None:
+            future.set_result(rooms)
+        else:
+            future.set_exception(exception)
+
+    def in_flight(self, key):
+        with self._lock:
+            return self._inflight.get(key)
+
+    # Cached in this process or being scraped, without counting a lookup
+    def peek(self, key):
+        return self.local.get(key) is not None or self.in_flight(key) is not None
+
+    def stats(self):
+        ages = sorted(self.hit_ages)
+        lookups = self.hits + self.redis_hits + self.misses + self.joined
+        return {
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "joined": self.joined,
+            "hit_rate": (self.hits + self.redis_hits + self.joined) / lookups if lookups else None,
+            "size": len(self.local),
+            "evictions": self.local.evictions,
+            "median_hit_age_s": ages[len(ages) // 2] if ages else None,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# Exported by get_cache(), name -> help text
+cache_gauges = {
+    "hits": "Room searches answered from the availability cache of this process.",
+    "redis_hits": "Room searches answered from the availability cache in Redis.",
+    "misses": "Room searches that had to scrape.",
+    "joined": "Room searches that waited for an identical scrape already running.",
+    "hit_rate": "Share of room searches that did not scrape.",
+    "size": "Room searches in the availability cache of this process.",
+}
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                redis_client = None
+                if settings.CHAT_AVAILABILITY_CACHE_REDIS:
+                    from .redis_client import get_redis
+
+                    redis_client = get_redis()
+                _cache = AvailabilityCache(
+                    settings.CHAT_AVAILABILITY_CACHE_SIZE,
+                    settings.CHAT_AVAILABILITY_CACHE_TTL,
+                    redis_client,
+                )
+                for name, help_text in cache_gauges.items():
+                    metrics.register_gauge(
+                        f"chat_availability_cache_{name}", help_text, lambda name=name: get_cache().stats()[name]
+                    )
+    return _cache
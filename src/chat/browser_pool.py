@@ -0,0 +1,156 @@
+import atexit
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class BrowserPoolTimeout(Exception):
+    pass
+
+
+# Pool of warm browsers shared by concurrent scrapes. At most `size`
+# browsers are alive, each is replaced after `max_pages` pages or as soon
+# as a scrape fails with it.
+class DriverPool:
+    def __init__(self, factory, size=2, warm=0, max_pages=50, checkout_timeout=30):
+        self.factory = factory
+        self.size = size
+        self.warm = min(warm, size)
+        self.max_pages = max_pages
+        self.checkout_timeout = checkout_timeout
+
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._pages = {}  # id(driver) -> pages loaded
+        self._retired = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.created = 0
+        self.destroyed = 0
+
+    def _create(self):
+        with metrics.span("browser_start"):
+            driver = self.factory()
+        with self._lock:
+            self._pages[id(driver)] = 0
+            self.created += 1
+        return driver
+
+    def _destroy(self, driver):
+        with self._lock:
+            self._pages.pop(id(driver), None)
+            self._retired.discard(id(driver))
+            self.destroyed += 1
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.warning("Failed to quit browser: %s", e)
+
+    # Start browsers ahead of the first scrape. Each browser is idle before
+    # its slot is released, a scrape waiting for the slot takes it instead of
+    # starting another one.
+    def warm_up(self):
+        while self._idle.qsize() < self.warm:
+            if not self._slots.acquire(blocking=False):
+                break
+            try:
+                with self._lock:
+                    alive = self.created - self.destroyed
+                if alive >= self.size:
+                    break
+                self._idle.put(self._create())
+            except Exception as e:
+                logger.warning("Failed to start browser: %s", e)
+                break
+            finally:
+                self._slots.release()
+
+    def warm_up_in_background(self):
+        threading.Thread(target=self.warm_up, name="browser-pool-warm-up", daemon=True).start()
+
+    # Mark a browser to be replaced when it is returned
+    def recycle(self, driver):
+        with self._lock:
+            self._retired.add(id(driver))
+
+    @contextmanager
+    def driver(self, timeout=None):
+        if self._closed:
+            raise RuntimeError("Browser pool is closed")
+        timeout = self.checkout_timeout if timeout is None else timeout
+        with metrics.span("browser_checkout"):
+            acquired = self._slots.acquire(timeout=timeout)
+        if not acquired:
+            raise BrowserPoolTimeout(f"No browser free after {timeout}s")
+
+        driver = None
+        healthy = False
+        try:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                driver = self._create()
+            yield driver
+            healthy = True
+        finally:
+            if driver is not None:
+                with self._lock:
+                    self._pages[id(driver)] += 1
+                    keep = (
+                        healthy
+                        and not self._closed
+                        and id(driver) not in self._retired
+                        and self._pages[id(driver)] < self.max_pages
+                    )
+                if keep:
+                    try:
+                        # Do not carry a guest's search over to the next one
+                        driver.delete_all_cookies()
+                    except Exception:
+                        keep = False
+                if keep:
+                    self._idle.put(driver)
+                else:
+                    self._destroy(driver)
+            self._slots.release()
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._destroy(driver)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from django.conf import settings
+
+                from .webscraping import create_driver
+
+                _pool = DriverPool(
+                    create_driver,
+                    size=settings.CHAT_BROWSER_POOL_SIZE,
+                    warm=settings.CHAT_BROWSER_POOL_WARM,
+                    max_pages=settings.CHAT_BROWSER_MAX_PAGES,
+                    checkout_timeout=settings.CHAT_BROWSER_CHECKOUT_TIMEOUT,
+                )
+                # Quit every browser when the process exits
+                atexit.register(_pool.close)
+                _pool.warm_up_in_background()
+    return _pool
@@ -0,0 +1,145 @@
+import time
+
+from langchain.callbacks.base import BaseCallbackHandler
+
+from . import metrics
+
+
+# Forwards every LLM token to a callback, used for streaming replies
+class TokenStreamHandler(BaseCallbackHandler):
+    def __init__(self, on_token):
+        self.on_token = on_token
+
+    # Called in order on the calling thread, also in async runs
+    run_inline = True
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        # Function call steps stream empty content, skip them
+        if token:
+            self.on_token(token)
+
+
+# Times the LLM calls, tools and retrievals of an agent run, see metrics
+class MetricsCallbackHandler(BaseCallbackHandler):
+    # Inline so async runs record into the trace of the running message
+    run_inline = True
+
+    def __init__(self):
+        self._started = {}  # run_id -> (stage, start)
+
+    def _start(self, run_id, stage):
+        self._started[run_id] = (stage, time.perf_counter())
+
+    def _end(self, run_id):
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            metrics.observe(started[0], time.perf_counter() - started[1])
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, f"tool:{serialized.get('name')}")
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id, "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id)
+
+
+# Records the tokens and latency of every LLM call for the room, see usage.
+# Streamed OpenAI calls report no usage, their tokens are counted with `llm`.
+# `history` and `history_tokens` are the chat history with the new message
+# and their count from build_history, those messages are not counted again.
+class UsageCallbackHandler(BaseCallbackHandler):
+    run_inline = True
+
+    def __init__(self, tracker, llm, room, source="agent", history=None, history_tokens=None):
+        self.tracker = tracker
+        self.llm = llm
+        self.room = room
+        self.source = source
+        self.history = history
+        self.history_tokens = history_tokens
+        self._started = {}  # run_id -> (start, prompt messages or texts)
+
+    # Same room, for the LLM calls of a tool
+    def for_source(self, source):
+        return UsageCallbackHandler(self.tracker, self.llm, self.room, source)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = (time.perf_counter(), prompts)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = (time.perf_counter(), messages)
+
+    def _count_prompt(self, prompts):
+        if prompts and not isinstance(prompts[0], str):
+            return sum(self._count_messages(messages) for messages in prompts)
+        return sum(self.llm.get_num_tokens(prompt) for prompt in prompts)
+
+    def _count_messages(self, messages):
+        if self.history_tokens is None:
+            return self.llm.get_num_tokens_from_messages(messages)
+        rest = list(messages)
+        for message in self.history:
+            if message not in rest:
+                return self.llm.get_num_tokens_from_messages(messages)
+            rest.remove(message)
+        # The per-call overhead is already in history_tokens
+        return (
+            self.history_tokens
+            + self.llm.get_num_tokens_from_messages(rest)
+            - self.llm.get_num_tokens_from_messages([])
+        )
+
+    def _count_completion(self, response):
+        tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                tokens += self.llm.get_num_tokens(generation.text)
+                message = getattr(generation, "message", None)
+                function_call = message.additional_kwargs.get("function_call") if message else None
+                if function_call:
+                    tokens += self.llm.get_num_tokens(function_call.get("name", "") + function_call.get("arguments", ""))
+        return tokens
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        started = self._started.pop(run_id, None)
+        if started is None:
+            return
+        start, prompts = started
+        llm_output = response.llm_output or {}
+        token_usage = llm_output.get("token_usage") or {}
+        prompt_tokens = token_usage.get("prompt_tokens")
+        completion_tokens = token_usage.get("completion_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = self._count_prompt(prompts)
+        if completion_tokens is None:
+            completion_tokens = self._count_completion(response)
+        self.tracker.record(
+            self.room, self.source, llm_output.get("model_name", ""),
+            prompt_tokens, completion_tokens, time.perf_counter() - start,
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._started.pop(run_id, None)
@@ -1,20 +1,135 @@
+import contextlib
+import functools
 import json
+import logging
+import uuid
 from . import openai_utils as oau
+from . import agent_runner
+from . import job_queue
+from . import metrics
+from . import prefetch
+from . import presence
+from . import ratelimit
+from . import redis_client
+from . import replay
+from . import sessions
 import asyncio
 
+from django.conf import settings
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 
 
+logger = logging.getLogger(__name__)
+
+# Keep references to running answer tasks so they are not garbage collected
+_background_tasks = set()
+
+error_message = "Sorry for the inconvenience, I am unable to answer your question right now. Try again later."
+
+
+# One turn of a server side session, runs on the worker pool in room order
+def run_session_turn(key, new_message, on_token=None):
+    store = sessions.get_session_store()
+    store.append(key, "user", new_message)
+
+    assistant_message = oau.generate_chat_response(store.get_history(key), on_token, session_key=key)
+    if assistant_message is not None:
+        store.append(key, "assistant", assistant_message)
+    return assistant_message
+
+
+# Async version of run_session_turn, for CHAT_AGENT_ASYNC
+async def arun_session_turn(key, new_message, on_token=None):
+    store = sessions.get_session_store()
+    await redis_client.call(store.append, key, "user", new_message)
+
+    history = await redis_client.call(store.get_history, key)
+    assistant_message = await oau.agenerate_chat_response(history, on_token, session_key=key)
+    if assistant_message is not None:
+        await redis_client.call(store.append, key, "assistant", assistant_message)
+    return assistant_message
+
+
+# Agent runs on the worker threads, or on the event loop with async tools
+def get_session_turn():
+    return arun_session_turn if settings.CHAT_AGENT_ASYNC else run_session_turn
+
+
+# Run `job` in the room's turn and send the reply, streamed if enabled, with
+# `send(event, timed=True)`. Used by ChatConsumer and by the queue workers.
+async def answer(room_group_name, stream_id, send, job, *args):
+    on_token = None
+    if settings.CHAT_STREAMING:
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+        # Tokens arrive on the worker thread, hand them over to the loop
+        on_token = lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token)
+        stream_task = asyncio.ensure_future(stream_tokens(tokens, stream_id, send))
+
+    # Use chatgpt to generate a response
+    try:
+        run = agent_runner.arun_for_room if asyncio.iscoroutinefunction(job) else agent_runner.run_for_room
+        assistant_message = await run(room_group_name, job, *args, on_token=on_token)
+    finally:
+        if on_token:
+            loop.call_soon_threadsafe(tokens.put_nowait, None)
+            await stream_task
+
+    # The full reply also terminates the stream
+    if assistant_message == None:  # Check if there is an error
+        assistant_message = error_message
+    await send({"type": "bot_message", "assistant_message": assistant_message, "stream_id": stream_id})
+
+
+# Forward streamed tokens until the end marker (None) arrives
+async def stream_tokens(tokens, stream_id, send):
+    finished = False
+    while not finished:
+        delta = ""
+        token = await tokens.get()
+        # Send whatever has queued up since the last frame in one go
+        while True:
+            if token is None:
+                finished = True
+                break
+            delta += token
+            if tokens.empty():
+                break
+            token = tokens.get_nowait()
+
+        if delta:
+            await send({"type": "bot_message_delta", "delta": delta, "stream_id": stream_id}, timed=False)
+
+
+def get_session_id(text_data_json):
+    session_id = text_data_json.get("session_id")
+    if isinstance(session_id, str) and 0 < len(session_id) <= 64:
+        return session_id
+    return None
+
+
+# Number of a frame the client can resume from, see chat/replay.py
+def sequence(event):
+    return {key: event[key] for key in ("seq", "epoch") if key in event}
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = "chat_%s" % self.room_name
+        # Messages this connection may still send right away
+        self.rate_bucket = ratelimit.connection_bucket()
 
         # Join room group
         await self.channel_layer.group_add(
             self.room_group_name, self.channel_name
         )
+        # Members of the room, this connection sends to itself while it is alone
+        self.room_members = await redis_client.call(presence.get_presence().join, self.room_group_name, self.channel_name)
+        if self.room_members > 1:
+            await self.channel_layer.group_send(self.room_group_name, {"type": "room_members_changed"})
 
         await self.accept()
 
@@ -23,6 +138,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         await self.channel_layer.group_discard(
             self.room_group_name, self.channel_name
         )
+        # Replies still running go to whoever is left through the group
+        self.room_members = 0
+        if await redis_client.call(presence.get_presence().leave, self.room_group_name, self.channel_name):
+            await self.channel_layer.group_send(self.room_group_name, {"type": "room_members_changed"})
 
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -44,37 +163,157 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if existing_messages is None:
                 existing_messages = []
 
-            existing_messages.append({"role": "user", "content": new_message})
+            session_id = get_session_id(text_data_json)
 
+            if await self._reject_if_busy(new_message):
+                return
 
             # Send new message instantly back
-            await self.channel_layer.group_send(
-                self.room_group_name, {"type": "chat_message", "message": new_message}
-            )
-            
-            # Use chatgpt to generate a response
-            assistant_message = oau.generate_chat_response(existing_messages)
-
-            if assistant_message == None:  # Check if there is an error
-                await self.channel_layer.group_send(
-                    self.room_group_name, {"type": "bot_message", "assistant_message": "Sorry for the inconvenience, I am unable to answer your question right now. Try again later."}
-                )
+            await self._broadcast({"type": "chat_message", "message": new_message})
+
+            self._prefetch(new_message)
+
+            if session_id:
+                # Seed the server side session, later messages only send the new message
+                key = sessions.session_key(self.room_name, session_id)
+                await redis_client.call(sessions.get_session_store().replace, key, existing_messages)
+                await self._answer_session(key, new_message)
             else:
-                await self.channel_layer.group_send(
-                    self.room_group_name, {"type": "bot_message", "assistant_message": assistant_message}
-                )
+                existing_messages.append({"role": "user", "content": new_message})
+                # Summaries of old turns are still cached, per room
+                legacy_key = sessions.session_key(self.room_name, "legacy")
+                if settings.CHAT_AGENT_MODE == "queue":
+                    await self._enqueue({"key": legacy_key, "messages": existing_messages})
+                else:
+                    generate = oau.agenerate_chat_response if settings.CHAT_AGENT_ASYNC else oau.generate_chat_response
+                    self._start_answer(functools.partial(generate, session_key=legacy_key), existing_messages)
+
+        elif command == "send_message":
+            session_id = get_session_id(text_data_json)
+            # New message
+            new_message = text_data_json["message"]
+
+            key = sessions.session_key(self.room_name, session_id)
+            if session_id is None or not await redis_client.call(sessions.get_session_store().exists, key):
+                # Unknown or expired session, the client resends its history with send_all_messages
+                await self.send(text_data=json.dumps({"session_missing": session_id, "message_new": new_message}))
+                return
+
+            if await self._reject_if_busy(new_message):
+                return
+
+            # Send new message instantly back
+            await self._broadcast({"type": "chat_message", "message": new_message})
+
+            self._prefetch(new_message)
+            await self._answer_session(key, new_message)
 
+        elif command == "resume":
+            # Reconnected, send what the room got since the client's last numbered frame
+            last_seq = text_data_json.get("last_seq")
+            epoch = text_data_json.get("epoch")
+            if isinstance(last_seq, int) and isinstance(epoch, str):
+                for event in await redis_client.call(replay.get_buffer().since, self.room_group_name, epoch, last_seq):
+                    await getattr(self, event["type"])(event)
+
+    # Rate limits per connection and per room, then the global run queue.
+    # A rejected message is not echoed and spends no tokens, the client can
+    # send it again later.
+    async def _reject_if_busy(self, new_message):
+        room_buckets = ratelimit.room_buckets()
+        wait = max(self.rate_bucket.wait(), room_buckets.wait(self.room_group_name), await agent_runner.aadmit())
+        if not wait:
+            self.rate_bucket.take()
+            room_buckets.take(self.room_group_name)
+            return False
+        await self.send(text_data=json.dumps({
+            "busy": True, "retry_after": ratelimit.retry_after(wait), "message_new": new_message,
+        }))
+        return True
+
+    # Start the room search in the message while the agent is still deciding
+    # to look it up. The queue workers do this themselves, no browsers here.
+    def _prefetch(self, new_message):
+        if settings.CHAT_AVAILABILITY_PREFETCH and settings.CHAT_AGENT_MODE != "queue":
+            prefetch.prefetch(new_message)
+
+    # Answer the new message of a session, here or on a queue worker
+    async def _answer_session(self, key, new_message):
+        if settings.CHAT_AGENT_MODE == "queue":
+            await self._enqueue({"key": key, "message": new_message})
+        else:
+            self._start_answer(get_session_turn(), key, new_message)
+
+    # Hand the message to `manage.py run_chat_workers`, the reply comes back
+    # through the room group
+    async def _enqueue(self, job):
+        job.update(room=self.room_name, group=self.room_group_name, stream_id=uuid.uuid4().hex)
+        with metrics.span("job_enqueue"):
+            depth = await redis_client.call(job_queue.get_queue().enqueue, job)
+        await self.send(text_data=json.dumps({"queue_depth": depth - 1}))
+
+    # Generate the response in the background so this consumer keeps
+    # handling pings, echoes and new messages while the agent runs
+    def _start_answer(self, job, *args):
+        task = asyncio.ensure_future(self._answer(job, *args))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    # Run the agent on the worker pool and send its reply to the room
+    async def _answer(self, job, *args):
+        # Every reply gets an id so the client can join its partial frames,
+        # it also identifies the message in the trace log
+        stream_id = uuid.uuid4().hex
+        with metrics.trace(self.room_name, stream_id):
+            await self._answer_traced(job, stream_id, *args)
+
+    async def _answer_traced(self, job, stream_id, *args):
+        # Let the client know how many jobs are ahead of it
+        await self.send(text_data=json.dumps({"queue_depth": agent_runner.queue_depth()}))
+        try:
+            await answer(self.room_group_name, stream_id, self._broadcast, job, *args)
+        except Exception:
+            # e.g. the session store or the replay buffer is unreachable
+            logger.exception("Chat answer for room %s failed", self.room_name)
+            event = {"type": "bot_message", "assistant_message": error_message, "stream_id": stream_id}
+            try:
+                await self._broadcast(event)
+            except Exception:
+                # The room cannot be reached, this guest still gets the error
+                await self.bot_message(event)
+
+    # Send an event to everyone in the room. Alone in it, the event is handled
+    # right here instead of taking a round trip through the channel layer.
+    async def _broadcast(self, event, timed=True):
+        event = await replay.record(self.room_group_name, event)
+        if settings.CHAT_DIRECT_SEND and self.room_members == 1:
+            with metrics.span("direct_send") if timed else contextlib.nullcontext():
+                await getattr(self, event["type"])(event)
+        else:
+            with metrics.span("channel_layer") if timed else contextlib.nullcontext():
+                await self.channel_layer.group_send(self.room_group_name, event)
+
+    # Someone joined or left the room
+    async def room_members_changed(self, event):
+        if self.room_members:
+            self.room_members = await redis_client.call(presence.get_presence().count, self.room_group_name)
 
     # Receive message from room group
     async def chat_message(self, event):
         message = event["message"]
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({"message": message}))
+        await self.send(text_data=json.dumps({"message": message, **sequence(event)}))
 
     # Receive assistant message from chatgpt
     async def bot_message(self, event):
         assistant_message = event["assistant_message"]
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({"assistant_message": assistant_message}))
\ No newline at end of file
+        await self.send(text_data=json.dumps({
+            "assistant_message": assistant_message, "stream_id": event.get("stream_id"), **sequence(event),
+        }))
+
+    # Receive part of a streamed assistant message
+    async def bot_message_delta(self, event):
+        await self.send(text_data=json.dumps({"assistant_message_delta": event["delta"], "stream_id": event["stream_id"]}))
@@ -0,0 +1,127 @@
+import logging
+import re
+import threading
+from typing import Callable, List
+
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain.schema import BaseRetriever, Document
+from langchain.vectorstores.base import VectorStore
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+word_pattern = re.compile(r"\w+")
+
+# Words that say nothing about which chunk answers the question
+stop_words = frozenset(
+    "a an and are at be can do does for from have how i in is it me my of on or our the there "
+    "to we what when where which who will with you your".split()
+)
+
+
+def content_words(text):
+    return {word for word in word_pattern.findall(text.lower()) if word not in stop_words}
+
+
+# Word trigrams, two chunks sharing most of them say the same thing
+def shingles(text):
+    words = word_pattern.findall(text.lower())
+    return {tuple(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+# Across all document searches of this process
+_stats = {"queries": 0, "candidate_tokens": 0, "context_tokens": 0, "duplicates": 0}
+_stats_lock = threading.Lock()
+
+
+def record(candidate_tokens, context_tokens, duplicates):
+    with _stats_lock:
+        _stats["queries"] += 1
+        _stats["candidate_tokens"] += candidate_tokens
+        _stats["context_tokens"] += context_tokens
+        _stats["duplicates"] += duplicates
+
+
+def tokens_saved():
+    with _stats_lock:
+        return _stats["candidate_tokens"] - _stats["context_tokens"]
+
+
+metrics.register_gauge("chat_context_tokens_saved", "Prompt tokens the document search context builder left out.", tokens_saved)
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats, tokens_saved=_stats["candidate_tokens"] - _stats["context_tokens"])
+    result["tokens_saved_per_query"] = result["tokens_saved"] / result["queries"] if result["queries"] else 0.0
+    return result
+
+
+def reset_stats():
+    with _stats_lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+# Retriever for the "stuff" chain of get_doc_info. It fetches `fetch_k`
+# chunks, drops the ones repeating a better chunk, re-ranks the rest by
+# vector relevance and the question's words they contain, and keeps the
+# best of them that fit in `token_budget` prompt tokens. It never stuffs more
+# than the `k` chunks as_retriever() would have returned, the tokens saved
+# are measured against those.
+class ContextRetriever(BaseRetriever):
+    store: VectorStore
+    count_tokens: Callable[[str], int]
+    token_budget: int = 600
+    k: int = 4
+    fetch_k: int = 8
+    duplicate_threshold: float = 0.8
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    # Returns the chunks in the order they should be read
+    def build(self, question, docs_and_scores):
+        words = content_words(question)
+        kept = []  # (score, doc, shingles)
+        duplicates = 0
+        for doc, relevance in docs_and_scores:
+            # Stores should score in [0, 1], an l2 collection does not
+            relevance = min(1.0, max(0.0, relevance))
+            doc_shingles = shingles(doc.page_content)
+            if any(jaccard(doc_shingles, other) >= self.duplicate_threshold for _, _, other in kept):
+                duplicates += 1
+                continue
+            overlap = len(words & content_words(doc.page_content)) / len(words) if words else 0.0
+            kept.append((relevance + overlap, doc, doc_shingles))
+        kept.sort(key=lambda item: item[0], reverse=True)
+
+        tokens = {id(doc): self.count_tokens(doc.page_content) for doc, _ in docs_and_scores}
+        candidate_tokens = sum(tokens[id(doc)] for doc, _ in docs_and_scores[:self.k])
+        budget = min(self.token_budget, candidate_tokens)
+        context, used = [], 0
+        for _, doc, _ in kept:
+            if len(context) == self.k:
+                break
+            # The best chunk goes in even if it is over the budget on its own
+            if context and used + tokens[id(doc)] > budget:
+                continue
+            context.append(doc)
+            used += tokens[id(doc)]
+
+        record(candidate_tokens, used, duplicates)
+        logger.debug("Context of %d tokens for %r, %d saved", used, question, candidate_tokens - used)
+        return context
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return self.build(query, self.store.similarity_search_with_relevance_scores(query, k=self.fetch_k))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.build(query, await self.store.asimilarity_search_with_relevance_scores(query, k=self.fetch_k))
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from langchain.document_loaders import TextLoader
+from langchain.text_splitter import CharacterTextSplitter
+from langchain.vectorstores import Chroma
+
+from .vectorstore import NumpyVectorStore, normalise_rows
+
+logger = logging.getLogger(__name__)
+
+COLLECTION_NAME = "data"
+MANIFEST_NAME = "manifest.json"
+
+
+# Load every document in the documents directory
+def load_documents(docs_dir=None):
+    docs_dir = Path(docs_dir or settings.CHAT_DOCUMENTS_DIR)
+    documents = []
+    for path in sorted(docs_dir.glob(settings.CHAT_DOCUMENTS_GLOB)):
+        documents.extend(TextLoader(str(path), encoding="utf-8").load())
+    return documents
+
+
+def split_documents(documents):
+    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    return text_splitter.split_documents(documents)
+
+
+# Chunks are identified by their content, unchanged chunks keep their embedding
+def chunk_id(chunk):
+    return hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()
+
+
+# Cosine distances in [0, 2] give relevance scores in [0, 1], like NumpyVectorStore's.
+# Chroma's default l2 distances give negative scores.
+def open_chroma(embeddings, index_dir=None):
+    return Chroma(
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings,
+        persist_directory=index_dir,
+        collection_metadata={"hnsw:space": "cosine"},
+        relevance_score_fn=lambda distance: 1 - distance / 2,
+    )
+
+
+def manifest_path(index_dir=None):
+    return os.path.join(index_dir or settings.CHAT_INDEX_DIR, MANIFEST_NAME)
+
+
+def read_manifest(index_dir=None):
+    try:
+        with open(manifest_path(index_dir)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+# Vectors of other embeddings cannot be mixed in, nor can a collection
+# another backend left behind be trusted. Chroma collections from before
+# the cosine metric are built again.
+def manifest_matches(manifest):
+    return (
+        manifest is not None
+        and manifest.get("embeddings", "openai") == settings.CHAT_EMBEDDINGS_PROVIDER
+        and manifest.get("backend", "chroma") == settings.CHAT_VECTOR_BACKEND
+        and (settings.CHAT_VECTOR_BACKEND != "chroma" or manifest.get("metric", "l2") == "cosine")
+    )
+
+
+# Changes whenever the indexed content changes
+def index_fingerprint(index_dir=None):
+    manifest = read_manifest(index_dir)
+    return manifest["fingerprint"] if manifest else None
+
+
+# Bring the persisted index in line with the documents directory,
+# only new or changed chunks are embedded
+def sync_index(embeddings, docs_dir=None, index_dir=None, rebuild=False):
+    index_dir = index_dir or settings.CHAT_INDEX_DIR
+    chunks = {chunk_id(chunk): chunk for chunk in split_documents(load_documents(docs_dir))}
+
+    if not manifest_matches(read_manifest(index_dir)):
+        rebuild = True
+
+    if settings.CHAT_VECTOR_BACKEND == "numpy":
+        result = sync_numpy_index(embeddings, chunks, index_dir, rebuild)
+    else:
+        result = sync_chroma_index(embeddings, chunks, index_dir, rebuild)
+
+    with open(manifest_path(index_dir), "w") as f:
+        json.dump({
+            "fingerprint": hashlib.sha256("".join(sorted(chunks)).encode()).hexdigest(),
+            "chunks": len(chunks),
+            "embeddings": settings.CHAT_EMBEDDINGS_PROVIDER,
+            "backend": settings.CHAT_VECTOR_BACKEND,
+            "metric": "cosine",
+        }, f)
+
+    return result
+
+
+def sync_chroma_index(embeddings, chunks, index_dir, rebuild):
+    docsearch = open_chroma(embeddings, index_dir)
+    if rebuild:
+        docsearch.delete_collection()
+        docsearch = open_chroma(embeddings, index_dir)
+
+    existing = set(docsearch.get(include=[])["ids"])
+
+    added = [id_ for id_ in chunks if id_ not in existing]
+    if added:
+        docsearch.add_texts(
+            [chunks[id_].page_content for id_ in added],
+            metadatas=[chunks[id_].metadata for id_ in added],
+            ids=added,
+        )
+
+    removed = list(existing - chunks.keys())
+    if removed:
+        docsearch.delete(ids=removed)
+
+    docsearch.persist()
+
+    return {"added": len(added), "removed": len(removed), "kept": len(chunks) - len(added)}
+
+
+# The matrix is written again in chunk order, unchanged rows are copied over
+def sync_numpy_index(embeddings, chunks, index_dir, rebuild):
+    existing = None
+    if not rebuild and NumpyVectorStore.exists(index_dir):
+        existing = NumpyVectorStore.load(index_dir, embeddings)
+    rows = {id_: row for row, id_ in enumerate(existing.ids)} if existing else {}
+
+    added = [id_ for id_ in chunks if id_ not in rows]
+    new_rows = {}
+    if added:
+        vectors = normalise_rows(embeddings.embed_documents([chunks[id_].page_content for id_ in added]))
+        new_rows = dict(zip(added, vectors))
+
+    store = NumpyVectorStore(
+        embeddings,
+        ids=list(chunks),
+        texts=[chunk.page_content for chunk in chunks.values()],
+        metadatas=[chunk.metadata for chunk in chunks.values()],
+        vectors=np.vstack([new_rows[id_] if id_ in new_rows else existing.vectors[rows[id_]] for id_ in chunks])
+        if chunks else None,
+    )
+    store.save(index_dir)
+
+    removed = rows.keys() - chunks.keys()
+    return {"added": len(added), "removed": len(removed), "kept": len(chunks) - len(added)}
+
+
+# Open the index written by `manage.py build_index`. Without one the
+# documents are embedded into a throwaway in-memory collection.
+def open_index(embeddings, index_dir=None):
+    index_dir = index_dir or settings.CHAT_INDEX_DIR
+    backend = settings.CHAT_VECTOR_BACKEND
+    if not manifest_matches(read_manifest(index_dir)):
+        logger.warning(
+            "No %s document index for %s embeddings in %s, run manage.py build_index. Embedding in memory.",
+            backend, settings.CHAT_EMBEDDINGS_PROVIDER, index_dir,
+        )
+        if backend == "numpy":
+            return NumpyVectorStore.from_documents(
+                split_documents(load_documents()), embeddings, query_cache_size=settings.CHAT_VECTOR_QUERY_CACHE_SIZE
+            )
+        docsearch = open_chroma(embeddings)
+        docsearch.add_documents(split_documents(load_documents()))
+        return docsearch
+
+    if backend == "numpy":
+        return NumpyVectorStore.load(index_dir, embeddings, query_cache_size=settings.CHAT_VECTOR_QUERY_CACHE_SIZE)
+    return open_chroma(embeddings, index_dir)
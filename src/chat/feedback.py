@@ -0,0 +1,229 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# DynamoDB takes at most 25 items per batch_write_item
+MAX_BATCH_SIZE = 25
+
+
+# Process wide, write-behind sink for guest feedback. Items are buffered and
+# written in batches by size or interval with a single reused client.
+# Items DynamoDB does not take after the retries, or that do not fit in the
+# queue, go to a local spill file that is replayed after the next good write.
+# An item rejected by `max_attempts` writes goes to the dead letter file
+# (the spill file's path + ".dead") instead, for someone to look at.
+class FeedbackSink:
+    def __init__(self, client_factory, table_name, batch_size=MAX_BATCH_SIZE, flush_interval=2.0,
+                 max_queue=10000, spill_path=None, max_retries=5, key_name="date", max_attempts=5):
+        self.client_factory = client_factory
+        self.table_name = table_name
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.max_retries = max_retries
+        self.max_attempts = max_attempts
+        # Table key, one batch cannot hold two items with the same key
+        self.key_name = key_name
+
+        self._queue = queue.Queue(maxsize=max_queue)  # (item, writes that rejected it)
+        self._client = None
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.written = 0
+        self.spilled = 0
+        self.dead_lettered = 0
+        self.batches = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.client_factory()
+        return self._client
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="feedback-sink", daemon=True)
+            self._thread.start()
+
+    # Never blocks, returns False only if the item could not be kept at all
+    def submit(self, item, attempts=0):
+        try:
+            self._queue.put_nowait((item, attempts))
+            return True
+        except queue.Full:
+            return self._spill([(item, attempts)])
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Wake up early once a full batch is waiting
+            deadline = time.monotonic() + self.flush_interval
+            while self._queue.qsize() < self.batch_size and time.monotonic() < deadline:
+                if self._stop.wait(0.05):
+                    break
+            self.flush()
+
+    def _take(self):
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    # Write everything buffered so far
+    def flush(self):
+        with self._write_lock:
+            pending = self._take()
+            written = False
+            while pending:
+                batch, keys, later = [], set(), []
+                for entry in pending:
+                    key = entry[0].get(self.key_name)
+                    if len(batch) < self.batch_size and key not in keys:
+                        batch.append(entry)
+                        keys.add(key)
+                    else:
+                        later.append(entry)
+                pending = later
+
+                if not self._write_batch(batch):
+                    # DynamoDB is unreachable or throttling, keep the rest locally too
+                    self._spill(pending)
+                    return
+                written = True
+            # Only once DynamoDB took a write again, not every interval of an outage
+            if written:
+                self._replay_spill()
+
+    # Returns False when part of the batch had to be spilled after the retries
+    def _write_batch(self, batch):
+        attempts = {item.get(self.key_name): count for item, count in batch}
+        request = {self.table_name: [{"PutRequest": {"Item": item}} for item, _ in batch]}
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.span("dynamodb_write"):
+                    response = self.client.batch_write_item(RequestItems=request)
+            except Exception as e:
+                logger.warning("Feedback batch write failed: %s", e)
+            else:
+                self.batches += 1
+                unprocessed = response.get("UnprocessedItems") or {}
+                self.written += len(request[self.table_name]) - len(unprocessed.get(self.table_name, []))
+                if not unprocessed.get(self.table_name):
+                    return True
+                request = unprocessed
+            if attempt < self.max_retries:
+                time.sleep(min(0.05 * 2 ** attempt, 2))
+
+        rejected = [put["PutRequest"]["Item"] for put in request[self.table_name]]
+        self._spill([(item, attempts[item.get(self.key_name)] + 1) for item in rejected])
+        return False
+
+    # Keeps (item, attempts) entries for a later replay, or as dead letters
+    def _spill(self, entries):
+        dead = [item for item, attempts in entries if attempts >= self.max_attempts]
+        if dead:
+            self._dead_letter(dead)
+        entries = [(item, attempts) for item, attempts in entries if attempts < self.max_attempts]
+        if not entries:
+            return True
+        if not self.spill_path:
+            logger.error("Dropped %d feedback items, no spill file configured", len(entries))
+            return False
+        try:
+            with open(self.spill_path, "a") as f:
+                for item, attempts in entries:
+                    f.write(json.dumps({"item": item, "attempts": attempts}) + "\n")
+        except OSError as e:
+            logger.error("Dropped %d feedback items, spill file failed: %s", len(entries), e)
+            return False
+        self.spilled += len(entries)
+        return True
+
+    # Not retried any more, the items are only logged without a spill file
+    def _dead_letter(self, items):
+        self.dead_lettered += len(items)
+        if self.spill_path:
+            try:
+                with open(self.spill_path + ".dead", "a") as f:
+                    for item in items:
+                        f.write(json.dumps(item) + "\n")
+                logger.error("%d feedback items were rejected %d times, moved to %s.dead",
+                             len(items), self.max_attempts, self.spill_path)
+                return
+            except OSError as e:
+                logger.error("Dead letter file failed: %s", e)
+        for item in items:
+            logger.error("Feedback item rejected %d times, dropped: %s", self.max_attempts, json.dumps(item))
+
+    # Queue the spilled items again now that DynamoDB takes writes. A replay
+    # file left behind by a crash goes first, its items may be written twice,
+    # which only overwrites them.
+    def _replay_spill(self):
+        if not self.spill_path:
+            return
+        replay_path = self.spill_path + ".replay"
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.spill_path):
+                return
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.submit(entry["item"], entry["attempts"])
+        os.remove(replay_path)
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+
+def create_client():
+    import boto3
+
+    # The resource's client takes and returns plain Python values
+    dynamodb = boto3.resource('dynamodb',
+                              region_name=settings.CHAT_FEEDBACK_REGION,
+                              endpoint_url=settings.CHAT_DYNAMODB_ENDPOINT,
+                              aws_access_key_id=os.environ.get('AWS_ACCESS_KEY'),
+                              aws_secret_access_key=os.environ.get('AWS_SECRET_KEY'))
+    return dynamodb.meta.client
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                _sink = FeedbackSink(
+                    create_client,
+                    settings.CHAT_FEEDBACK_TABLE,
+                    batch_size=settings.CHAT_FEEDBACK_BATCH_SIZE,
+                    flush_interval=settings.CHAT_FEEDBACK_FLUSH_INTERVAL,
+                    max_queue=settings.CHAT_FEEDBACK_QUEUE_SIZE,
+                    spill_path=settings.CHAT_FEEDBACK_SPILL_PATH,
+                    max_attempts=settings.CHAT_FEEDBACK_MAX_ATTEMPTS,
+                )
+                _sink.start()
+                # Write what is still buffered when the process exits
+                atexit.register(_sink.close)
+    return _sink
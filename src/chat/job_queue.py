@@ -0,0 +1,77 @@
+import json
+import time
+import zlib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics
+
+# Chat jobs handed from the websocket front end to `manage.py run_chat_workers`
+# (CHAT_AGENT_MODE = "queue"). Rooms are spread over CHAT_QUEUE_SHARDS Redis
+# lists. Each shard is read by the one worker holding its lease, so the
+# messages of a room are answered in order. The workers publish the replies through the
+# channel layer as bot_message events.
+
+
+class JobQueue:
+    prefix = "chat:jobs:"
+
+    def __init__(self, client, shards):
+        self.client = client
+        self.shards = shards
+
+    def shard_of(self, room_group_name):
+        return zlib.crc32(room_group_name.encode()) % self.shards
+
+    def key(self, shard):
+        return f"{self.prefix}{shard}"
+
+    # Jobs taken by a worker and not answered yet, put back when it restarts
+    def running_key(self, shard):
+        return f"{self.prefix}{shard}:running"
+
+    # Held by the worker working the shard, see workers.ShardLease
+    def lease_key(self, shard):
+        return f"{self.prefix}{shard}:lease"
+
+    # Returns the number of jobs in the room's shard, this one included
+    def enqueue(self, job):
+        job = dict(job, enqueued=time.time())
+        return self.client.rpush(self.key(self.shard_of(job["group"])), json.dumps(job))
+
+    # Jobs waiting across all shards
+    def depth(self):
+        pipe = self.client.pipeline()
+        for shard in range(self.shards):
+            pipe.llen(self.key(shard))
+        return sum(pipe.execute())
+
+
+# "0-3,8" -> [0, 1, 2, 3, 8]
+def parse_shards(value, shards):
+    if not value:
+        return list(range(shards))
+    selected = set()
+    for part in value.split(","):
+        first, _, last = part.strip().partition("-")
+        selected.update(range(int(first), int(last or first) + 1))
+    if not selected or max(selected) >= shards:
+        raise ValueError(f"Shards must be between 0 and {shards - 1}")
+    return sorted(selected)
+
+
+_queue = None
+
+
+def get_queue():
+    global _queue
+    if _queue is None:
+        # Workers append the turns to the session, they have to share it
+        if settings.CHAT_SESSION_BACKEND != "redis":
+            raise ImproperlyConfigured("CHAT_AGENT_MODE = 'queue' needs CHAT_SESSION_BACKEND = 'redis'")
+        from .redis_client import get_redis
+
+        _queue = JobQueue(get_redis(), settings.CHAT_QUEUE_SHARDS)
+        metrics.register_gauge("chat_job_queue_depth", "Chat jobs waiting for a queue worker.", _queue.depth)
+    return _queue
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import openai_utils as oau
+
+
+# Per message setup cost of the agent, rebuilt every time vs built once
+class Command(BaseCommand):
+    help = "Benchmark the per-message agent setup overhead"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200)
+
+    def handle(self, *args, **options):
+        iterations = options["iterations"]
+
+        # Before: initialize_agent on every message
+        start = time.perf_counter()
+        for _ in range(iterations):
+            oau.build_agent()
+        rebuilt = (time.perf_counter() - start) / iterations
+
+        # After: one shared agent
+        oau.get_agent()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            oau.get_agent()
+        reused = (time.perf_counter() - start) / iterations
+
+        self.stdout.write(f"initialize_agent per message: {rebuilt * 1000:.3f} ms")
+        self.stdout.write(f"shared agent per message:     {reused * 1000:.3f} ms")
+        self.stdout.write(f"saved per message:            {(rebuilt - reused) * 1000:.3f} ms")
@@ -0,0 +1,316 @@
+import asyncio
+import itertools
+import json
+import platform
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Messages the simulated guests send, in turn
+GUEST_MESSAGES = [
+    "hi",
+    "What time is check in?",
+    "2 adults and 1 child from 25-07-2024 to 26-07-2024",
+    "thanks, my feedback is that the website is great",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarise(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+# Websocket client that goes through a real socket
+class SocketClient:
+    def __init__(self, url):
+        self.url = url
+
+    async def connect(self):
+        try:
+            import websockets
+        except ImportError:
+            raise CommandError("--url needs the 'websockets' package")
+        self.socket = await websockets.connect(self.url)
+
+    async def send(self, data):
+        await self.socket.send(json.dumps(data))
+
+    async def receive(self):
+        return json.loads(await self.socket.recv())
+
+    async def close(self):
+        await self.socket.close()
+
+
+# Websocket client that talks to ChatConsumer inside this process
+class InProcessClient:
+    def __init__(self, application, path):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise CommandError("Consumer refused the connection")
+
+    async def send(self, data):
+        await self.communicator.send_json_to(data)
+
+    async def receive(self):
+        return await self.communicator.receive_json_from(timeout=3600)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class Room:
+    def __init__(self, name):
+        self.name = name
+        # Messages sent and not echoed yet
+        self.unechoed = {}
+        # Messages waiting for a bot reply, in the order the room echoed
+        # them, which is the order the replies arrive in. Every guest sees
+        # the echoes in that order, the first to see one queues it.
+        self.pending = deque()
+        # Streams already counted, every guest receives every frame
+        self.streams_started = set()
+        self.streams_finished = set()
+
+
+class Guest:
+    def __init__(self, client, room, guest_id, results):
+        self.client = client
+        self.room = room
+        self.guest_id = guest_id
+        self.results = results
+        self.echoes = {}
+        self.session_started = False
+        self.current = None
+
+    async def listen(self):
+        while True:
+            data = await self.client.receive()
+            now = time.perf_counter()
+
+            # Turned away, the message never reached the room
+            if "busy" in data and self.current is not None:
+                self.results["busy"] += 1
+                self.echoes.pop(data["message_new"], None)
+                self.room.unechoed.pop(data["message_new"], None)
+                self.current["retry_after"] = data["retry_after"]
+                self.current["done"].set()
+                continue
+
+            if "message" in data:
+                waiter = self.echoes.pop(data["message"], None)
+                if waiter:
+                    self.results["echo"].append(now - waiter["sent"])
+                entry = self.room.unechoed.pop(data["message"], None)
+                if entry:
+                    self.room.pending.append(entry)
+
+            # Every guest in the room sees every reply, the first to see it records it
+            head = self.room.pending[0] if self.room.pending else None
+            if head is None:
+                continue
+            if "assistant_message_delta" in data and data["stream_id"] not in self.room.streams_started:
+                self.room.streams_started.add(data["stream_id"])
+                self.results["first_token"].append(now - head["sent"])
+            if "assistant_message" in data and data["stream_id"] not in self.room.streams_finished:
+                self.room.streams_finished.add(data["stream_id"])
+                self.room.pending.popleft()
+                self.results["reply"].append(now - head["sent"])
+                head["done"].set()
+
+    async def chat(self, messages, think_time):
+        for number in range(messages):
+            text = f"{GUEST_MESSAGES[number % len(GUEST_MESSAGES)]} #{self.guest_id}.{number}"
+            while True:
+                entry = self.current = {"guest": self, "sent": time.perf_counter(), "done": asyncio.Event()}
+                self.echoes[text] = entry
+                self.room.unechoed[text] = entry
+
+                session_id = f"bench-{self.guest_id}"
+                if self.session_started:
+                    await self.client.send({"command": "send_message", "session_id": session_id, "message": text})
+                else:
+                    await self.client.send({"command": "send_all_messages", "session_id": session_id, "message_new": text, "messages": []})
+
+                await entry["done"].wait()
+                if "retry_after" not in entry:
+                    break
+                # Busy, send it again when the server says so
+                await asyncio.sleep(entry["retry_after"])
+            self.session_started = True
+            self.results["messages"] += 1
+            await asyncio.sleep(think_time)
+
+
+# Measures how late the event loop wakes up from a short sleep
+async def measure_loop_lag(lags, interval=0.01):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+class Command(BaseCommand):
+    help = "Load test ws/chat/<room>/ with concurrent rooms and guests"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--guests-per-room", type=int, default=1)
+        parser.add_argument("--messages", type=int, default=4, help="Messages each guest sends")
+        parser.add_argument("--think-time", type=float, default=0.0, help="Seconds between a reply and the next message")
+        parser.add_argument("--scrape-latency", type=float, default=2.0, help="Seconds the stubbed scraper takes")
+        parser.add_argument("--url", help="Base url of a running server, e.g. ws://127.0.0.1:8000. In process if omitted")
+        parser.add_argument("--output", default="bench_consumer.json")
+
+    def stub_backends(self, scrape_latency):
+        # Offline LLM and embeddings, in memory channel layer
+        settings.CHAT_LLM_PROVIDER = "fake"
+        settings.CHAT_EMBEDDINGS_PROVIDER = "hashing"
+        # Room to queue every streamed frame, past the capacity frames are dropped
+        settings.CHANNEL_LAYERS = {
+            "default": {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 100000}}
+        }
+        settings.CHAT_PRESENCE_BACKEND = "memory"
+        # Keep the bench's token usage out of the database
+        settings.CHAT_TOKEN_USAGE_PERSIST = False
+
+        from chat import tools
+        from chat import webscraping
+
+        rooms = [{"name": "Deluxe King Room", "price": "250 SGD"}, {"name": "Premium Twin Room", "price": "280 SGD"}]
+
+        def scape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_date):
+            time.sleep(scrape_latency)
+            return rooms
+
+        async def ascape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_date):
+            await asyncio.sleep(scrape_latency)
+            return rooms
+
+        webscraping.scape_hotel = scape_hotel
+        webscraping.ascape_hotel = ascape_hotel
+        tools.store_feedback = lambda feedback: "Thank you for your feedback! We appreciate your recommendation."
+
+    # Count the group sends, each one is a round trip to Redis in production
+    def count_group_sends(self, results):
+        from channels.layers import get_channel_layer
+
+        layer = get_channel_layer()
+        group_send = layer.group_send
+
+        async def counted_group_send(group, message):
+            results["group_sends"] += 1
+            return await group_send(group, message)
+
+        layer.group_send = counted_group_send
+
+    async def run(self, options):
+        from chat import context
+        from chat import metrics
+        from chat import prefetch
+        from chat import router
+
+        rooms = [Room(f"bench_{number}") for number in range(options["rooms"])]
+        results = {"echo": [], "reply": [], "first_token": [], "messages": 0, "busy": 0, "group_sends": 0}
+        ids = itertools.count()
+
+        if options["url"]:
+            make_client = lambda room: SocketClient(f"{options['url'].rstrip('/')}/ws/chat/{room.name}/")
+        else:
+            from channels.routing import URLRouter
+            from chat.routing import websocket_urlpatterns
+
+            application = URLRouter(websocket_urlpatterns)
+            self.count_group_sends(results)
+            make_client = lambda room: InProcessClient(application, f"/ws/chat/{room.name}/")
+
+        guests = []
+        for room in rooms:
+            for _ in range(options["guests_per_room"]):
+                client = make_client(room)
+                await client.connect()
+                guests.append(Guest(client, room, next(ids), results))
+
+        lags = []
+        lag_task = asyncio.ensure_future(measure_loop_lag(lags))
+        listeners = [asyncio.ensure_future(guest.listen()) for guest in guests]
+
+        start = time.perf_counter()
+        await asyncio.gather(*(guest.chat(options["messages"], options["think_time"]) for guest in guests))
+        elapsed = time.perf_counter() - start
+
+        for task in listeners + [lag_task]:
+            task.cancel()
+        for guest in guests:
+            await guest.client.close()
+
+        return {
+            "config": {key: options[key] for key in ("rooms", "guests_per_room", "messages", "think_time", "scrape_latency", "url")},
+            "environment": {
+                "python": platform.python_version(),
+                "agent_workers": settings.CHAT_AGENT_WORKERS,
+                "streaming": settings.CHAT_STREAMING,
+                "llm_provider": settings.CHAT_LLM_PROVIDER,
+                "direct_send": settings.CHAT_DIRECT_SEND,
+            },
+            "elapsed_s": elapsed,
+            "messages": results["messages"],
+            "messages_per_s": results["messages"] / elapsed if elapsed else None,
+            "busy_frames": results["busy"],
+            "time_to_echo_s": summarise(results["echo"]),
+            "time_to_first_token_s": summarise(results["first_token"]),
+            "time_to_bot_reply_s": summarise(results["reply"]),
+            # In process this is the server's loop, over a socket only the client's
+            "event_loop_lag_s": summarise(lags),
+            # Only known in process
+            "routes": None if options["url"] else router.stats(),
+            "availability_prefetch": None if options["url"] else prefetch.stats(),
+            "doc_context": None if options["url"] else context.stats(),
+            # Frames sent through the channel layer and straight to the socket
+            "group_sends": None if options["url"] else results["group_sends"],
+            "group_sends_per_message": None if options["url"] else results["group_sends"] / max(1, results["messages"]),
+            "send_s": None if options["url"] else {
+                stage: {"count": count, "mean": total / count}
+                for stage, (count, total) in metrics.stage_seconds.totals().items()
+                if stage in ("channel_layer", "direct_send")
+            },
+        }
+
+    def handle(self, *args, **options):
+        if not options["url"]:
+            self.stub_backends(options["scrape_latency"])
+
+        report = asyncio.run(self.run(options))
+
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=2)
+
+        self.stdout.write(
+            f"{report['messages']} messages in {report['elapsed_s']:.2f}s "
+            f"({report['messages_per_s']:.2f} msg/s), "
+            f"echo p95 {report['time_to_echo_s']['p95']}, "
+            f"reply p95 {report['time_to_bot_reply_s']['p95']}"
+        )
+        if report["group_sends"] is not None:
+            self.stdout.write(f"{report['group_sends_per_message']:.2f} group sends per message")
+        self.stdout.write(f"Results written to {options['output']}")
@@ -0,0 +1,55 @@
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import browser_pool, webscraping
+
+FIXTURE = Path(__file__).resolve().parents[2] / "test_data" / "room_rates.html"
+
+
+# Time each way of getting the room rates
+class Command(BaseCommand):
+    help = "Time the room scraper paths against a saved page and, with --live, against IHG"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fixture", default=str(FIXTURE), help="Saved search result page")
+        parser.add_argument("--iterations", type=int, default=100)
+        parser.add_argument("--live", action="store_true", help="Also run the http, light and full paths against IHG")
+        parser.add_argument("--search", nargs=5, default=["2", "0", "1", "25-07-2024", "26-07-2024"],
+                            metavar=("ADULTS", "CHILDREN", "ROOMS", "CHECK_IN", "CHECK_OUT"))
+
+    def report(self, path, seconds, rooms):
+        count = len(rooms) if isinstance(rooms, list) else 0
+        self.stdout.write(f"{path:<14} {seconds * 1000:10.1f} ms  {count} rooms")
+
+    def handle(self, *args, **options):
+        html = Path(options["fixture"]).read_text()
+        start = time.perf_counter()
+        for _ in range(options["iterations"]):
+            rooms = webscraping.parse_rooms_html(html)
+        self.report("parse fixture", (time.perf_counter() - start) / options["iterations"], rooms)
+
+        if not options["live"]:
+            return
+
+        url = webscraping.build_url(*options["search"])
+
+        start = time.perf_counter()
+        rooms = webscraping.fetch_rooms_http(url)
+        self.report("http", time.perf_counter() - start, rooms)
+
+        # Fresh browsers so both modes pay the same start up cost
+        for mode, scrape in (("light", webscraping.scrape_rooms_light), ("full", webscraping.scrape_rooms)):
+            settings.CHAT_SCRAPER_MODE = mode
+            pool = browser_pool.DriverPool(webscraping.create_driver, size=1)
+            try:
+                start = time.perf_counter()
+                with pool.driver() as driver:
+                    started = time.perf_counter()
+                    rooms = scrape(driver, url)
+                self.report(f"browser {mode}", time.perf_counter() - started, rooms)
+                self.stdout.write(f"{'  start up':<14} {(started - start) * 1000:10.1f} ms")
+            finally:
+                pool.close()
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import docstore, providers
+
+from .bench_consumer import summarise
+
+QUESTIONS = [
+    "What time is check in?",
+    "Is breakfast included?",
+    "Do you have day use rooms?",
+    "Is there a shuttle to the airport?",
+    "Can I get a late check out?",
+    "Where is the swimming pool?",
+    "Is wifi free?",
+    "Can I store my luggage?",
+]
+
+
+# Resident memory of this process in MB
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        # Peak instead of current outside Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# get_doc_info retrieval with the Chroma and the NumPy backend. Each backend
+# is measured in a fresh process so their memory is not mixed up.
+class Command(BaseCommand):
+    help = "Compare retrieval latency and memory of the Chroma and NumPy vector stores"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--batch", type=int, default=16, help="Queries per batched search (NumPy only)")
+        parser.add_argument("--k", type=int, default=4)
+        parser.add_argument("--copies", type=int, default=1, help="Copies of the documents, for a larger corpus")
+        parser.add_argument("--output", default="bench_vector_store.json")
+        parser.add_argument("--child", help=argparse.SUPPRESS)
+        parser.add_argument("--index-dir", help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options["child"]:
+            self.stdout.write(json.dumps(self.measure(options["child"], options)))
+            return
+
+        report = {
+            "config": {key: options[key] for key in ("queries", "batch", "k", "copies")},
+            "embeddings": settings.CHAT_EMBEDDINGS_PROVIDER,
+            "backends": {},
+        }
+        with tempfile.TemporaryDirectory() as docs_dir, tempfile.TemporaryDirectory() as work_dir:
+            self.copy_documents(docs_dir, options["copies"])
+            for backend in ("chroma", "numpy"):
+                index_dir = os.path.join(work_dir, backend)
+                settings.CHAT_VECTOR_BACKEND = backend
+                report["chunks"] = docstore.sync_index(providers.get_embeddings(), docs_dir, index_dir)["added"]
+
+                command = [
+                    sys.executable, sys.argv[0], "bench_vector_store", "--child", backend, "--index-dir", index_dir,
+                    "--queries", str(options["queries"]), "--batch", str(options["batch"]), "--k", str(options["k"]),
+                ]
+                output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+                report["backends"][backend] = json.loads(output.strip().splitlines()[-1])
+
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=2)
+
+        for backend, result in report["backends"].items():
+            self.stdout.write(
+                f"{backend}: open {result['open_s'] * 1000:.1f} ms, "
+                f"query p50 {result['query_s']['p50'] * 1000:.3f} ms, "
+                f"p95 {result['query_s']['p95'] * 1000:.3f} ms, "
+                f"+{result['rss_mb']:.1f} MB RSS"
+            )
+        self.stdout.write(f"Results written to {options['output']}")
+
+    # Every copy is a separate set of chunks
+    def copy_documents(self, docs_dir, copies):
+        documents = sorted(Path(settings.CHAT_DOCUMENTS_DIR).glob(settings.CHAT_DOCUMENTS_GLOB))
+        for copy in range(copies):
+            for number, path in enumerate(documents):
+                text = path.read_text(encoding="utf-8")
+                if copy:
+                    text = f"(copy {copy})\n" + text.replace("\n\n", f"\n\n(copy {copy})\n")
+                Path(docs_dir, f"{copy}-{number}.txt").write_text(text, encoding="utf-8")
+
+    def measure(self, backend, options):
+        settings.CHAT_VECTOR_BACKEND = backend
+        embeddings = providers.get_embeddings()
+        before = rss_mb()
+
+        start = time.perf_counter()
+        store = docstore.open_index(embeddings, options["index_dir"])
+        retriever = store.as_retriever(search_kwargs={"k": options["k"]})
+        retriever.get_relevant_documents(QUESTIONS[0])
+        open_s = time.perf_counter() - start
+
+        # Distinct questions, so the query embedding cache does not help
+        latencies = []
+        for number in range(options["queries"]):
+            question = f"{QUESTIONS[number % len(QUESTIONS)]} ({number})"
+            start = time.perf_counter()
+            retriever.get_relevant_documents(question)
+            latencies.append(time.perf_counter() - start)
+
+        # Guests asking the same questions again
+        repeated = []
+        for number in range(options["queries"]):
+            start = time.perf_counter()
+            retriever.get_relevant_documents(QUESTIONS[number % len(QUESTIONS)])
+            repeated.append(time.perf_counter() - start)
+
+        result = {
+            "open_s": open_s,
+            "query_s": summarise(latencies),
+            "repeated_query_s": summarise(repeated),
+            "rss_mb": rss_mb() - before,
+        }
+        if backend == "numpy":
+            questions = [f"{QUESTIONS[number % len(QUESTIONS)]} [{number}]" for number in range(options["queries"])]
+            start = time.perf_counter()
+            for first in range(0, len(questions), options["batch"]):
+                store.batch_similarity_search(questions[first:first + options["batch"]], k=options["k"])
+            result["batched_query_s"] = (time.perf_counter() - start) / len(questions)
+        return result
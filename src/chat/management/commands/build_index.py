@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from chat import docstore, providers
+
+
+# Embed the document directory into the persisted index used by get_doc_info
+class Command(BaseCommand):
+    help = "Build or update the persisted document index"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rebuild", action="store_true", help="Drop the index and embed everything again")
+
+    def handle(self, *args, **options):
+        result = docstore.sync_index(providers.get_embeddings(), rebuild=options["rebuild"])
+        self.stdout.write(
+            f"Index updated: {result['added']} chunks embedded, "
+            f"{result['kept']} unchanged, {result['removed']} removed"
+        )
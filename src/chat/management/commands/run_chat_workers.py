@@ -0,0 +1,82 @@
+import asyncio
+import signal
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import job_queue
+
+
+# Worker tier for CHAT_AGENT_MODE = "queue". Each process works the shards of its
+# set that no other worker holds the lease of (see workers.ShardLease), run one
+# command per host, with disjoint --shards to spread the shards evenly.
+class Command(BaseCommand):
+    help = "Answer queued chat messages and publish the replies to the rooms"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=1, help="Worker processes, the shards are split between them")
+        parser.add_argument("--shards", help="Shards to work on, e.g. 0-7,12. All of them if omitted")
+        parser.add_argument("--metrics-port", type=int, default=0, help="Serve metrics here, the n-th process on port + n")
+
+    def handle(self, *args, **options):
+        try:
+            shards = job_queue.parse_shards(options["shards"], settings.CHAT_QUEUE_SHARDS)
+        except ValueError as e:
+            raise CommandError(e)
+        processes = max(1, min(options["processes"], len(shards)))
+
+        if processes == 1:
+            self.work(shards, options["metrics_port"])
+        else:
+            self.supervise([shards[number::processes] for number in range(processes)], options["metrics_port"])
+
+    def work(self, shards, metrics_port):
+        from chat import openai_utils as oau
+        from chat import workers
+
+        if metrics_port:
+            workers.serve_metrics(metrics_port)
+        if settings.CHAT_WARM_UP:
+            oau.warm_up()
+        self.stdout.write(f"Working on shards {','.join(map(str, shards))}")
+
+        async def run():
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            # Finish the jobs being answered, then exit
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, stop.set)
+            await workers.work(shards, stop)
+
+        asyncio.run(run())
+
+    # Start one child per shard set and restart the ones that die
+    def supervise(self, shard_sets, metrics_port):
+        def start(number):
+            command = [sys.executable, sys.argv[0], "run_chat_workers", "--shards", ",".join(map(str, shard_sets[number]))]
+            if metrics_port:
+                command += ["--metrics-port", str(metrics_port + number)]
+            return subprocess.Popen(command)
+
+        children = [start(number) for number in range(len(shard_sets))]
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for child in children:
+                child.terminate()
+
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        while not stopping:
+            for number, child in enumerate(children):
+                if child.poll() is not None and not stopping:
+                    self.stderr.write(f"Worker {number} exited with {child.returncode}, restarting")
+                    children[number] = start(number)
+            time.sleep(1)
+        for child in children:
+            child.wait()
@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, Sum
+from django.utils import timezone
+
+from chat.models import TokenUsage
+
+
+class Command(BaseCommand):
+    help = "Token usage per room and source from the TokenUsage table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--hours", type=float, default=24, help="Only the calls of the last N hours")
+        parser.add_argument("--room", help="Only this room")
+
+    def handle(self, *args, **options):
+        calls = TokenUsage.objects.filter(created__gte=timezone.now() - timedelta(hours=options["hours"]))
+        if options["room"]:
+            calls = calls.filter(room=options["room"])
+
+        rows = (
+            calls.values("room", "source")
+            .annotate(
+                calls=Count("id"),
+                prompt=Sum("prompt_tokens"),
+                completion=Sum("completion_tokens"),
+                latency=Avg("latency"),
+            )
+            .order_by("room", "source")
+        )
+
+        self.stdout.write(f"{'room':<24} {'source':<12} {'calls':>7} {'prompt':>10} {'completion':>10} {'avg s':>7}")
+        total_prompt = total_completion = 0
+        for row in rows:
+            total_prompt += row["prompt"]
+            total_completion += row["completion"]
+            self.stdout.write(
+                f"{row['room']:<24} {row['source']:<12} {row['calls']:>7} {row['prompt']:>10} "
+                f"{row['completion']:>10} {row['latency']:>7.2f}"
+            )
+        self.stdout.write(f"Total: {total_prompt} prompt + {total_completion} completion tokens")
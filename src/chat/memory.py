@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+from collections import deque
+
+from django.conf import settings
+from langchain.callbacks.manager import Callbacks
+from langchain.chains import LLMChain
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.schema import HumanMessage, get_buffer_string, messages_from_dict
+
+logger = logging.getLogger(__name__)
+
+# Most recent prompt sizes, (session key, history messages, prompt tokens)
+recent_turns = deque(maxlen=1000)
+
+# Define a mapping from "role" to "type"
+role_to_type = {"user": "human", "assistant": "ai"}
+
+
+def to_langchain_messages(message_hist):
+    return messages_from_dict([
+        {
+            'type': role_to_type[entry['role']],
+            'data': {
+                'content': entry['content'],
+                'additional_kwargs': {}
+            }
+        }
+        for entry in message_hist
+    ])
+
+
+# Summary memory whose LLM calls report to `callbacks`, e.g. the room's token usage
+class SummaryBufferMemory(ConversationSummaryBufferMemory):
+    callbacks: Callbacks = None
+
+    def predict_new_summary(self, messages, existing_summary):
+        new_lines = get_buffer_string(messages, human_prefix=self.human_prefix, ai_prefix=self.ai_prefix)
+        chain = LLMChain(llm=self.llm, prompt=self.prompt)
+        return chain.predict(summary=existing_summary, new_lines=new_lines, callbacks=self.callbacks)
+
+
+# Fingerprint of the messages already folded into a summary, so a cached
+# summary is only reused for the conversation it was made from
+def prefix_hash(message_hist):
+    data = json.dumps([(entry['role'], entry['content']) for entry in message_hist])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+# Build the chat history for the agent within the token budget.
+# The newest turns are kept verbatim, older ones are folded into a rolling
+# summary that is cached in the session store and only extended when
+# more turns fall out of the budget. The summarising LLM calls report to `callbacks`.
+def build_chat_history(llm, message_hist, new_message, session_key=None, store=None, callbacks=None):
+    folded = 0
+    summary = ""
+
+    cached = store.get_summary(session_key) if session_key and store else None
+    if cached and cached["folded"] <= len(message_hist) \
+            and cached["prefix"] == prefix_hash(message_hist[:cached["folded"]]):
+        folded = cached["folded"]
+        summary = cached["summary"]
+
+    memory = SummaryBufferMemory(
+        llm=llm,
+        callbacks=callbacks,
+        max_token_limit=settings.CHAT_MEMORY_TOKEN_BUDGET,
+        moving_summary_buffer=summary,
+        memory_key="chat_history",
+        return_messages=True,
+    )
+    memory.chat_memory.messages = to_langchain_messages(message_hist[folded:])
+    # Summarises whatever no longer fits in the budget
+    memory.prune()
+
+    new_folded = len(message_hist) - len(memory.chat_memory.messages)
+    if new_folded != folded and session_key and store:
+        store.set_summary(session_key, {
+            "summary": memory.moving_summary_buffer,
+            "folded": new_folded,
+            "prefix": prefix_hash(message_hist[:new_folded]),
+        })
+
+    chat_history = memory.load_memory_variables({})["chat_history"]
+
+    prompt_tokens = llm.get_num_tokens_from_messages(chat_history + [HumanMessage(content=new_message)])
+    recent_turns.append((session_key, len(message_hist), prompt_tokens))
+    logger.info(
+        "chat history for %s: %d messages, %d summarised, %d prompt tokens",
+        session_key, len(message_hist), new_folded, prompt_tokens,
+    )
+
+    return chat_history, prompt_tokens
+
+
+# Cheaper history for rooms near their token budget: only the newest turns
+# that fit in `token_budget`, older ones are dropped instead of summarised
+def trim_chat_history(llm, message_hist, new_message, token_budget):
+    chat_history = to_langchain_messages(message_hist)
+    while chat_history and llm.get_num_tokens_from_messages(chat_history) > token_budget:
+        chat_history.pop(0)
+
+    prompt_tokens = llm.get_num_tokens_from_messages(chat_history + [HumanMessage(content=new_message)])
+    return chat_history, prompt_tokens
@@ -0,0 +1,142 @@
+import bisect
+import contextlib
+import contextvars
+import json
+import logging
+import threading
+import time
+
+# Timing of every stage of answering a message. Each stage is observed in a
+# histogram (served in the Prometheus text format by the metrics view) and
+# added to the trace of the message being answered, which is logged as one
+# JSON line with the room and message id when the answer is done.
+
+trace_logger = logging.getLogger("chat.trace")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, name, help_text, label="stage", buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}  # label value -> [count per bucket..., count above, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    # Returns {label value: (count, sum)}
+    def totals(self):
+        with self._lock:
+            return {value: (sum(series[:-1]), series[-1]) for value, series in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = sorted((value, list(series)) for value, series in self._series.items())
+        for value, series in series_items:
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+stage_seconds = Histogram("chat_stage_seconds", "Seconds spent in each stage of answering a message.")
+
+# name -> (help text, function returning the current value, label)
+_gauges = {}
+
+
+# With a `label`, `value` returns {label value: value}, one series each
+def register_gauge(name, help_text, value, label=None):
+    _gauges[name] = (help_text, value, label)
+
+
+class Trace:
+    def __init__(self, room, message_id):
+        self.room = room
+        self.message_id = message_id
+        self.started = time.perf_counter()
+        self.spans = []  # (stage, offset from the start, duration)
+
+
+_current_trace = contextvars.ContextVar("chat_trace", default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+# Collect the spans of one message, worker threads see the trace when the
+# context is copied to them (agent_runner does this)
+@contextlib.contextmanager
+def trace(room, message_id):
+    current = Trace(room, message_id)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+        trace_logger.info(json.dumps({
+            "room": current.room,
+            "message_id": current.message_id,
+            "total_s": round(time.perf_counter() - current.started, 6),
+            "spans": [
+                {"stage": stage, "start_s": round(offset, 6), "duration_s": round(duration, 6)}
+                for stage, offset, duration in current.spans
+            ],
+        }))
+
+
+# Record a stage that started `elapsed` seconds ago
+def observe(stage, elapsed):
+    stage_seconds.observe(stage, elapsed)
+    current = _current_trace.get()
+    if current is not None:
+        current.spans.append((stage, time.perf_counter() - elapsed - current.started, elapsed))
+
+
+@contextlib.contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+# No value yet, e.g. a hit rate before the first lookup
+def _gauge_value(value):
+    return "NaN" if value is None else value
+
+
+# All metrics in the Prometheus text exposition format
+def render():
+    lines = stage_seconds.render()
+    for name, (help_text, value, label) in sorted(_gauges.items()):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge"])
+        if label is None:
+            lines.append(f"{name} {_gauge_value(value())}")
+        else:
+            for label_value, current in sorted(value().items()):
+                lines.append(f'{name}{{{label}="{label_value}"}} {_gauge_value(current)}')
+    return "\n".join(lines) + "\n"
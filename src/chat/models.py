@@ -1 +1,16 @@
-from django.db import models
\ No newline at end of file
+from django.db import models
+from django.utils import timezone
+
+
+# Tokens used by one LLM call, written in batches by usage.TokenUsageTracker
+class TokenUsage(models.Model):
+    room = models.CharField(max_length=100, db_index=True)
+    source = models.CharField(max_length=20)  # "agent", "doc_search" or "summary"
+    model = models.CharField(max_length=100, blank=True)
+    prompt_tokens = models.PositiveIntegerField()
+    completion_tokens = models.PositiveIntegerField()
+    latency = models.FloatField(help_text="Seconds")
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.room} {self.source}: {self.prompt_tokens} + {self.completion_tokens} tokens"
@@ -1,38 +1,24 @@
 import os
+import threading
+import time
 from dotenv import load_dotenv
-from datetime import datetime
 
-import boto3
+from asgiref.sync import sync_to_async
+from django.conf import settings
 
-from langchain.chat_models import ChatOpenAI
+from . import metrics
+from . import router
+from . import sessions
+from . import usage
 
-from langchain.tools import BaseTool
-from typing import Optional, Type
-from langchain.agents import initialize_agent, Tool, AgentType
-from pydantic import BaseModel, Field
-from langchain.prompts import MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory
-from langchain.schema import HumanMessage, SystemMessage
-from langchain.memory.chat_message_histories.in_memory import ChatMessageHistory
-from langchain.schema import messages_from_dict, messages_to_dict
-
-from pathlib import Path
-from langchain.document_loaders import TextLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.chains import RetrievalQA
-
-from . import webscraping as webscrap
+# Langchain, the models, the document index and the tools are created on
+# first use or by warm_up(), importing this module stays cheap
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Use API Key and set the GPT model
 openai_api_key = os.environ.get('OPENAI_API_KEY')
-aws_access_key_id = os.environ.get('AWS_ACCESS_KEY')
-aws_secret_access_key = os.environ.get('AWS_SECRET_KEY')
-GPT_MODEL = "gpt-3.5-turbo-0613"
 
 # Global variable
 messages = []
@@ -40,162 +26,324 @@ function_assistant_messages = []
 assistant_messages = []
 url_official = "https://changiairport.crowneplaza.com/day-use-room"
 
-llm = ChatOpenAI(openai_api_key=openai_api_key, model=GPT_MODEL, temperature=0,)
-
+system_prompt = '''You are a laconic assistant for Crowne Plaza Hotel Singapore. 
+                    You reply with brief, to-the-point answers with no elaboration.
+                    You only reply if the topic is regarding Crowne Plaza Hotel Singapore. 
+                    You refuse to reply if the topic is not about Crowne Plaza Hotel Singapore.
+                    '''
 
-# Create tools
+# Built once per process, see _shared
+_resources = {}
+_resources_lock = threading.RLock()
+_ready = threading.Event()
 
-# Function for storing feedback
-def store_feedback(feedback):
-    try:
-        dynamodb = boto3.resource('dynamodb',
-                                region_name='us-east-1',
-                                aws_access_key_id=aws_access_key_id, 
-                                aws_secret_access_key=aws_secret_access_key)
-         # Get the current datetime
-        current_datetime = datetime.now().strftime('%H:%M:%S %Y-%m-%d')
-        # Get the DynamoDB table
-        table = dynamodb.Table('Feedback')
-        # Data to be inserted into DynamoDB
-        data = {
-            'date': current_datetime,
-            'feedback':feedback
-            }
-
-        # Put the item into the table
-        table.put_item(Item=data)
-        return "Thank you for your feedback! We appreciate your recommendation."
-    except Exception as e:
-        print("Exception for feedback:", e)
-        return "Sorry, we are unable to store your feedback."
 
-# Custom tool for getting hotel room avalibility
-class CheckRoomCheckInput(BaseModel):
-    """Input for Hotel room avaliblity."""
+def _shared(name, build):
+    resource = _resources.get(name)
+    if resource is None:
+        with _resources_lock:
+            resource = _resources.get(name)
+            if resource is None:
+                resource = _resources[name] = build()
+    return resource
 
-    num_adult: int = Field(..., description="The number of adults for the hotel room.")
-    num_children: int = Field(..., description="The number of children for the hotel room. If the user did not state the number of children assume the value to be 0.")
-    num_rooms: int = Field(..., description="The number of rooms needed for the user. If the user did not state the number of rooms make the value 1.")
-    check_in_date: str = Field(..., description="The users check in date of the hotel room. The format must be d-m-Y.")
-    check_out_date: str = Field(..., description="The users check out date of the hotel room. The format must be d-m-Y.")
 
-class CheckRoomTool(BaseTool):
-    name = "get_hotel_availability"
-    description = "Gets the hotel room availability."
+# OpenAI or the offline stand-in, see CHAT_LLM_PROVIDER
+def get_llm():
+    from . import providers
 
-    def _run(self, num_adult: int, num_children: int, num_rooms: int, check_in_date: str, check_out_date: str):
-        # print("i'm running")
-        rooms = webscrap.scape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_date)
+    return _shared("llm", providers.get_chat_model)
 
-        return rooms
 
-    def _arun(self, num_adult: int, num_children: int, num_rooms: int, check_in_date: str, check_out_date: str):
-        raise NotImplementedError("This tool does not support async")
+def get_embeddings():
+    from . import providers
 
-    args_schema: Optional[Type[BaseModel]] = CheckRoomCheckInput
+    return _shared("embeddings", providers.get_embeddings)
 
 
-# Custom tool for getting hotel room avalibility
-class CheckFeedbackInput(BaseModel):
-    """Input for Feedback store."""
-    feedback: str = Field(..., description="The feedback that the user gives. If you are unable to store it apologise.")
+# Prebuilt by `manage.py build_index`
+def get_docsearch():
+    from . import docstore
 
-class CheckFeedbackTool(BaseTool):
-    name = "get_feedback"
-    description = "Gets the users feedback and stores it."
+    return _shared("docsearch", lambda: docstore.open_index(get_embeddings()))
 
-    def _run(self, feedback: str):
-        # print("i'm running")
-        feedback_response = store_feedback(feedback)
 
-        return feedback_response
+# Chunks stuffed into the document search prompt, packed to
+# CHAT_CONTEXT_TOKEN_BUDGET tokens unless that is 0
+def get_doc_retriever():
+    from . import context
 
-    def _arun(self, feedback: str):
-        raise NotImplementedError("This tool does not support async")
+    if not settings.CHAT_CONTEXT_TOKEN_BUDGET:
+        return get_docsearch().as_retriever()
+    return context.ContextRetriever(
+        store=get_docsearch(),
+        count_tokens=get_llm().get_num_tokens,
+        token_budget=settings.CHAT_CONTEXT_TOKEN_BUDGET,
+        fetch_k=settings.CHAT_CONTEXT_FETCH_K,
+        duplicate_threshold=settings.CHAT_CONTEXT_DUPLICATE_THRESHOLD,
+    )
 
-    args_schema: Optional[Type[BaseModel]] = CheckFeedbackInput
 
 # Tool for specific Crowne Plaza matters
-doc_path = "C:\\Users\\iainl\\OneDrive\\Documents\\Year3\\MP\\Project\\src\\static\\data.txt"
-
-loader = TextLoader(doc_path)
-documents = loader.load()
-text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-texts = text_splitter.split_documents(documents)
-
-embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
-docsearch = Chroma.from_documents(texts, embeddings, collection_name="data")
-
-search_doc = RetrievalQA.from_chain_type(
-    llm=llm, chain_type="stuff", retriever=docsearch.as_retriever()
-)
-
-tools = [CheckRoomTool(),
-         CheckFeedbackTool(),
-        Tool(
-            name="get_doc_info",
-            func=search_doc.run,
-            description="A document search. Use this only if you cannot answer the question and require more information.",
-        )]
-
-agent_kwargs = {
-    "extra_prompt_messages": [MessagesPlaceholder(variable_name="chat_history")],
-}
-system_message = SystemMessage(
-                    content='''You are a laconic assistant for Crowne Plaza Hotel Singapore. 
-                    You reply with brief, to-the-point answers with no elaboration.
-                    You only reply if the topic is regarding Crowne Plaza Hotel Singapore. 
-                    You refuse to reply if the topic is not about Crowne Plaza Hotel Singapore.
-                    '''
-                )
+def get_search_doc():
+    from langchain.chains import RetrievalQA
 
-def generate_chat_response(message_hist):
-    try:
-        # Retrieve new message
-        new_message_dict = message_hist[-1]  # Retrieve the last dictionary in the list
-        new_message = new_message_dict.get("content")
-        # transform data
-        # Define a mapping from "role" to "type"
-        role_to_type = {"user": "human", "assistant": "ai"}
-        transformed_data = [
-            {
-                'type': role_to_type[entry['role']],
-                'data': {
-                    'content': entry['content'],
-                    'additional_kwargs': {}
-                }
-            }
-            for entry in message_hist
-        ]
-        
-        transformed_data = transformed_data[:-1] # Remove newest message from the message_obj
-
-        message_obj = messages_from_dict(transformed_data)
-        chat_memory = ChatMessageHistory(chat_memory=message_obj)
-        if len(transformed_data) > 1:
-            memory = ConversationBufferMemory(chat_memory=chat_memory, memory_key="chat_history", return_messages=True)
-            print("1")
-        else:
-             memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-             print("2")
-
-        open_ai_agent = initialize_agent(tools,
-                            llm,
+    return _shared("search_doc", lambda: RetrievalQA.from_chain_type(
+        llm=get_llm(), chain_type="stuff", retriever=get_doc_retriever()
+    ))
+
+
+# Frequently asked questions are answered from here without a completion,
+# cleared whenever `manage.py build_index` changes the index
+def get_doc_answers():
+    return _shared("doc_answers", build_doc_answers)
+
+
+def build_doc_answers():
+    from . import answer_cache
+    from . import docstore
+
+    cache = answer_cache.SemanticAnswerCache(
+        get_embeddings(),
+        threshold=settings.CHAT_ANSWER_CACHE_THRESHOLD,
+        maxsize=settings.CHAT_ANSWER_CACHE_SIZE,
+        ttl=settings.CHAT_ANSWER_CACHE_TTL,
+        fingerprint=docstore.index_fingerprint,
+    )
+    for name, help_text in answer_cache.cache_gauges.items():
+        metrics.register_gauge(f"chat_answer_cache_{name}", help_text, lambda name=name: cache.stats()[name])
+    return cache
+
+
+# Callbacks of the agent run for the retrieval chain: its tokens are
+# accounted to doc search and it does not stream into the reply
+def doc_search_callbacks(callbacks):
+    from . import callbacks as chat_callbacks
+
+    handlers = []
+    for handler in getattr(callbacks, "handlers", None) or []:
+        if isinstance(handler, chat_callbacks.TokenStreamHandler):
+            continue
+        if isinstance(handler, chat_callbacks.UsageCallbackHandler):
+            handler = handler.for_source("doc_search")
+        handlers.append(handler)
+    return handlers or None
+
+
+def search_doc_cached(question, callbacks=None):
+    handlers = doc_search_callbacks(callbacks)
+    with metrics.span("doc_search"):
+        return get_doc_answers().get_or_answer(
+            question, lambda question: get_search_doc().run(question, callbacks=handlers)
+        )
+
+
+async def asearch_doc_cached(question, callbacks=None):
+    handlers = doc_search_callbacks(callbacks)
+    with metrics.span("doc_search"):
+        return await get_doc_answers().aget_or_answer(
+            question, lambda question: get_search_doc().arun(question, callbacks=handlers)
+        )
+
+
+def get_room_tool():
+    from .tools import CheckRoomTool
+
+    return _shared("room_tool", CheckRoomTool)
+
+
+def build_tools():
+    from langchain.agents import Tool
+    from .tools import CheckFeedbackTool
+
+    return [get_room_tool(),
+            CheckFeedbackTool(),
+            Tool(
+                name="get_doc_info",
+                func=search_doc_cached,
+                coroutine=asearch_doc_cached,
+                description="A document search. Use this only if you cannot answer the question and require more information.",
+            )]
+
+
+def get_tools():
+    return _shared("tools", build_tools)
+
+
+# Build the agent once per process, prompts and function schemas included
+def build_agent(tools=None):
+    from langchain.agents import initialize_agent, AgentType
+    from langchain.prompts import MessagesPlaceholder
+    from langchain.schema import SystemMessage
+
+    agent_kwargs = {
+        "extra_prompt_messages": [MessagesPlaceholder(variable_name="chat_history")],
+    }
+    system_message = SystemMessage(content=system_prompt)
+
+    return initialize_agent(tools or get_tools(),
+                            get_llm(),
                             agent=AgentType.OPENAI_FUNCTIONS,
-                            memory=memory,
                             verbose=True,
                             agent_kwargs={
                             "system_message": system_message,
-                            "memory": memory
+                            **agent_kwargs,
                         })
-        
-        response = open_ai_agent.run(new_message)
+
+
+# One agent per tool set, rooms over their token budget get one without doc search
+def get_agent(doc_search=True):
+    name = "agent" if doc_search else "agent:no_doc_search"
+    agent = _resources.get(name)
+    if agent is None:
+        tools = [tool for tool in get_tools() if doc_search or tool.name != "get_doc_info"]
+        with metrics.span("agent_build"):
+            agent = _shared(name, lambda: build_agent(tools))
+    return agent
+
+
+# Create everything the first message needs, returns the seconds it took.
+# Called in the background by the ASGI application, see is_ready()
+def warm_up():
+    start = time.perf_counter()
+    get_agent()
+    # Opens the document index, or embeds the documents when there is none
+    get_search_doc()
+    get_doc_answers()
+    if settings.CHAT_BROWSER_POOL_WARM:
+        from . import browser_pool
+
+        # Starts the browsers in the background, a search meanwhile waits for them
+        browser_pool.get_pool()
+    _ready.set()
+    return time.perf_counter() - start
+
+
+# Without the warm up everything is built by the first message instead
+def is_ready():
+    return _ready.is_set() or not settings.CHAT_WARM_UP
+
+
+# History for the agent, only the newest turns and no summary once the room is near its budget
+def build_history(level, message_hist, new_message, session_key):
+    from . import callbacks as chat_callbacks
+    from . import memory as chat_memory
+
+    if level == usage.FULL:
+        # Summarising counts against the room's budget like the agent's calls
+        summary_usage = chat_callbacks.UsageCallbackHandler(
+            usage.get_tracker(), get_llm(), sessions.room_of(session_key), source="summary"
+        )
+        return chat_memory.build_chat_history(
+            get_llm(), message_hist[:-1], new_message, session_key, sessions.get_session_store(),
+            callbacks=[summary_usage],
+        )
+    return chat_memory.trim_chat_history(get_llm(), message_hist[:-1], new_message, settings.CHAT_TRIMMED_HISTORY_BUDGET)
+
+
+# Counts the agent's tokens, the history's come from build_history
+def usage_handler(tracker, room, chat_history, new_message, prompt_tokens):
+    from langchain.schema import HumanMessage
+    from . import callbacks as chat_callbacks
+
+    return chat_callbacks.UsageCallbackHandler(
+        tracker, get_llm(), room,
+        history=chat_history + [HumanMessage(content=new_message)], history_tokens=prompt_tokens,
+    )
+
+
+def route_message(new_message):
+    if settings.CHAT_ROUTER_ENABLED:
+        return router.route(new_message)
+    return router.Route(router.AGENT)
+
+
+def generate_chat_response(message_hist, on_token=None, session_key=None):
+    from . import callbacks as chat_callbacks
+
+    start = time.perf_counter()
+    route = router.Route(router.AGENT)
+    try:
+        # Retrieve new message
+        new_message_dict = message_hist[-1]  # Retrieve the last dictionary in the list
+        new_message = new_message_dict.get("content")
+
+        # Small talk, refusals and complete availability requests skip the agent
+        with metrics.span("route"):
+            route = route_message(new_message)
+        if route.name == router.AVAILABILITY:
+            with metrics.span("tool:get_hotel_availability"):
+                return router.format_rooms(get_room_tool().run(route.booking), route.booking)
+        if route.reply is not None:
+            return route.reply
+
+        # Rooms close to their token budget are answered more cheaply
+        room = sessions.room_of(session_key)
+        tracker = usage.get_tracker()
+        level = tracker.downgrade(room)
+
+        # Older turns within the token budget, the rest is summarised
+        with metrics.span("history"):
+            chat_history, prompt_tokens = build_history(level, message_hist, new_message, session_key)
+        # Time the LLM calls and tools, count their tokens, stream tokens to the caller if it asked for them
+        callbacks = [chat_callbacks.MetricsCallbackHandler(), usage_handler(tracker, room, chat_history, new_message, prompt_tokens)]
+        if on_token:
+            callbacks.append(chat_callbacks.TokenStreamHandler(on_token))
+
+        # The history is passed per run, the agent itself is shared
+        agent = get_agent(doc_search=level != usage.NO_DOC_SEARCH)
+        with metrics.span("agent"):
+            response = agent.run(input=new_message, chat_history=chat_history, callbacks=callbacks)
         return response
 
     except Exception as e:
         print(e)
         return None
+    finally:
+        router.record(route.name, time.perf_counter() - start)
+
+
+# Async version of generate_chat_response, tools are awaited on the event loop
+# so slow scrapes and feedback writes do not hold a thread each
+async def agenerate_chat_response(message_hist, on_token=None, session_key=None):
+    from . import callbacks as chat_callbacks
 
+    start = time.perf_counter()
+    route = router.Route(router.AGENT)
+    try:
+        # Retrieve new message
+        new_message = message_hist[-1].get("content")
+
+        with metrics.span("route"):
+            route = route_message(new_message)
+        if route.name == router.AVAILABILITY:
+            with metrics.span("tool:get_hotel_availability"):
+                return router.format_rooms(await get_room_tool().arun(route.booking), route.booking)
+        if route.reply is not None:
+            return route.reply
+
+        room = sessions.room_of(session_key)
+        tracker = usage.get_tracker()
+        level = tracker.downgrade(room)
+
+        # Summarising may call the LLM, keep it off the event loop
+        with metrics.span("history"):
+            chat_history, prompt_tokens = await sync_to_async(build_history, thread_sensitive=False)(
+                level, message_hist, new_message, session_key
+            )
+        callbacks = [chat_callbacks.MetricsCallbackHandler(), usage_handler(tracker, room, chat_history, new_message, prompt_tokens)]
+        if on_token:
+            callbacks.append(chat_callbacks.TokenStreamHandler(on_token))
+
+        agent = await sync_to_async(get_agent, thread_sensitive=False)(doc_search=level != usage.NO_DOC_SEARCH)
+        with metrics.span("agent"):
+            return await agent.arun(input=new_message, chat_history=chat_history, callbacks=callbacks)
+
+    except Exception as e:
+        print(e)
+        return None
+    finally:
+        router.record(route.name, time.perf_counter() - start)
 
 
 # def generate_chat_response(message_hist):
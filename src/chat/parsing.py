@@ -0,0 +1,62 @@
+import re
+from datetime import datetime
+
+# Cheap local parsing of booking details out of a guest's message
+
+date_pattern = re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b")
+adult_pattern = re.compile(r"\b(\d+)\s*adults?\b", re.I)
+# Everyone staying, children included
+guest_pattern = re.compile(r"\b(\d+)\s*(?:pax|guests?|people|persons?)\b", re.I)
+child_pattern = re.compile(r"\b(\d+)\s*(?:child|children|kids?)\b", re.I)
+room_pattern = re.compile(r"\b(\d+)\s*rooms?\b", re.I)
+number_words = {"one": "1", "two": "2", "three": "3", "four": "4", "five": "5", "a": "1", "an": "1"}
+number_word_pattern = re.compile(
+    r"\b(" + "|".join(number_words) + r")\b(?=\s*(?:adults?|pax|guests?|people|persons?|child|children|kids?|rooms?)\b)",
+    re.I,
+)
+
+
+def parse_dates(text):
+    dates = []
+    for day, month, year in date_pattern.findall(text):
+        try:
+            dates.append(datetime(int(year), int(month), int(day)).strftime("%d-%m-%Y"))
+        except ValueError:
+            continue
+    return dates
+
+
+# Returns the arguments for get_hotel_availability, or None when the
+# message does not clearly contain both dates and the number of adults
+def parse_booking_request(text):
+    text = number_word_pattern.sub(lambda m: number_words[m.group(1).lower()], text)
+
+    dates = parse_dates(text)
+    if len(dates) != 2:
+        return None
+    check_in, check_out = dates
+    if datetime.strptime(check_out, "%d-%m-%Y") <= datetime.strptime(check_in, "%d-%m-%Y"):
+        return None
+
+    children = child_pattern.search(text)
+    num_children = int(children.group(1)) if children else 0
+    adults = adult_pattern.search(text)
+    if adults is not None:
+        num_adult = int(adults.group(1))
+    else:
+        # "4 guests, 2 children" are 2 adults
+        guests = guest_pattern.search(text)
+        if guests is None:
+            return None
+        num_adult = int(guests.group(1)) - num_children
+        if num_adult < 1:
+            return None
+
+    rooms = room_pattern.search(text)
+    return {
+        "num_adult": num_adult,
+        "num_children": num_children,
+        "num_rooms": int(rooms.group(1)) if rooms else 1,
+        "check_in_date": check_in,
+        "check_out_date": check_out,
+    }
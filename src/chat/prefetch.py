@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from . import availability
+from . import metrics
+from . import parsing
+from . import webscraping
+
+logger = logging.getLogger(__name__)
+
+# Room searches started from the guest's message while the agent is still
+# deciding to call get_hotel_availability. They go through the availability
+# cache, so the tool joins a search that is still running and finds a
+# finished one cached. Searches the agent does not ask for stay cached for
+# the next question.
+
+_tasks = set()
+_unclaimed = {}  # key -> time the search was started, oldest first, until the tool asks for it
+_lock = threading.Lock()
+_stats = {"started": 0, "already_cached": 0, "used": 0, "unused": 0}
+
+
+def cacheable(rooms):
+    return rooms != webscraping.rooms_busy
+
+
+# Start the search in the message on the event loop, returns its key or None
+def prefetch(message):
+    booking = parsing.parse_booking_request(message)
+    if booking is None:
+        return None
+    key = availability.availability_key(**booking)
+
+    cache = availability.get_cache()
+    with _lock:
+        now = time.monotonic()
+        _expire(now)
+        if cache.peek(key):
+            _stats["already_cached"] += 1
+            return key
+        _stats["started"] += 1
+        _unclaimed.pop(key, None)
+        _unclaimed[key] = now
+
+    task = asyncio.ensure_future(cache.aget_or_fetch(key, lambda: webscraping.ascape_hotel(*key), cacheable=cacheable))
+    _tasks.add(task)
+    task.add_done_callback(_done)
+    return key
+
+
+def _done(task):
+    _tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Availability prefetch failed: %s", task.exception())
+
+
+# Past the cache's TTL, or pushed out of it, nobody can use them any more.
+# Called with the lock held.
+def _expire(now):
+    while _unclaimed:
+        key, started = next(iter(_unclaimed.items()))
+        if now - started <= settings.CHAT_AVAILABILITY_CACHE_TTL and len(_unclaimed) <= settings.CHAT_AVAILABILITY_CACHE_SIZE:
+            break
+        del _unclaimed[key]
+        _stats["unused"] += 1
+
+
+# Called by the tool, counts the prefetches the agent did use
+def claim(key):
+    with _lock:
+        _expire(time.monotonic())
+        if _unclaimed.pop(key, None) is not None:
+            _stats["used"] += 1
+
+
+def stats():
+    with _lock:
+        _expire(time.monotonic())
+        return dict(_stats, waiting=len(_unclaimed))
+
+
+# Share of the started searches the agent asked for, of those decided
+def claim_rate():
+    current = stats()
+    decided = current["used"] + current["unused"]
+    return current["used"] / decided if decided else None
+
+
+metrics.register_gauge(
+    "chat_availability_prefetches", "Room searches started from the guests' messages, by outcome.", stats,
+    label="outcome",
+)
+metrics.register_gauge(
+    "chat_availability_prefetch_claim_rate", "Share of the prefetched room searches the agent used.", claim_rate
+)
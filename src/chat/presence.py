@@ -0,0 +1,82 @@
+import threading
+
+from django.conf import settings
+
+# Channels connected to each room group. A consumer that is alone in its room
+# sends to its own websocket instead of going through the channel layer.
+
+
+# Members known to this process only, right when one process serves the websockets
+class InMemoryPresence:
+    def __init__(self):
+        self._members = {}  # group -> set of channel names
+        self._lock = threading.Lock()
+
+    # Returns the number of members after joining
+    def join(self, group, channel_name):
+        with self._lock:
+            members = self._members.setdefault(group, set())
+            members.add(channel_name)
+            return len(members)
+
+    # Returns the number of members left
+    def leave(self, group, channel_name):
+        with self._lock:
+            members = self._members.get(group)
+            if members is None:
+                return 0
+            members.discard(channel_name)
+            if not members:
+                del self._members[group]
+            return len(members)
+
+    def count(self, group):
+        with self._lock:
+            return len(self._members.get(group, ()))
+
+
+# Members shared by every process through Redis sets. A process that dies
+# leaves its channels behind until the set expires, the room then only
+# goes through the channel layer, which is still correct.
+class RedisPresence:
+    prefix = "chat:presence:"
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def _key(self, group):
+        return f"{self.prefix}{group}"
+
+    def join(self, group, channel_name):
+        key = self._key(group)
+        pipe = self.client.pipeline()
+        pipe.sadd(key, channel_name)
+        pipe.expire(key, self.ttl)
+        pipe.scard(key)
+        return pipe.execute()[-1]
+
+    def leave(self, group, channel_name):
+        key = self._key(group)
+        pipe = self.client.pipeline()
+        pipe.srem(key, channel_name)
+        pipe.scard(key)
+        return pipe.execute()[-1]
+
+    def count(self, group):
+        return self.client.scard(self._key(group))
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        if settings.CHAT_PRESENCE_BACKEND == "redis":
+            from .redis_client import get_redis
+
+            _presence = RedisPresence(get_redis(), settings.CHAT_SESSION_TTL)
+        else:
+            _presence = InMemoryPresence()
+    return _presence
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from typing import Any, List, Optional
+
+from django.conf import settings
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.schema import AIMessage, ChatGeneration, ChatResult, FunctionMessage, HumanMessage
+
+from .parsing import parse_booking_request
+
+token_pattern = re.compile(r"\w+|[^\w\s]")
+
+
+# Rough token count shared by the offline models
+def count_tokens(text):
+    return len(token_pattern.findall(text))
+
+
+# Chat model that never leaves the machine, for load tests and profiling.
+# It waits `latency` seconds, then produces tokens at `tokens_per_second`,
+# and calls the agent's functions when a message asks for them.
+# Subclasses ChatOpenAI because the functions agent only accepts that.
+class FakeChatModel(ChatOpenAI):
+    openai_api_key: str = "fake"
+    model_name: str = "fake-chat"
+    latency: float = 0.5
+    tokens_per_second: float = 50.0
+    reply: str = "Thank you for your message. Is there anything else I can help you with regarding your stay at Crowne Plaza Changi Airport?"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def get_num_tokens(self, text: str) -> int:
+        return count_tokens(text)
+
+    def get_num_tokens_from_messages(self, messages) -> int:
+        return sum(count_tokens(message.content) + 3 for message in messages)
+
+    def _function_call(self, messages, functions):
+        names = {function["name"] for function in functions or []}
+        last = messages[-1]
+        if not isinstance(last, HumanMessage):
+            return None
+
+        booking = parse_booking_request(last.content)
+        if booking and "get_hotel_availability" in names:
+            return {"name": "get_hotel_availability", "arguments": json.dumps(booking)}
+        if "feedback" in last.content.lower() and "get_feedback" in names:
+            return {"name": "get_feedback", "arguments": json.dumps({"feedback": last.content})}
+        if "?" in last.content and "get_doc_info" in names:
+            return {"name": "get_doc_info", "arguments": json.dumps({"__arg1": last.content})}
+        return None
+
+    def _respond(self, messages, functions):
+        function_call = self._function_call(messages, functions)
+        if function_call:
+            return "", {"function_call": function_call}
+        if isinstance(messages[-1], FunctionMessage):
+            return f"Here is what I found: {messages[-1].content}", {}
+        return self.reply, {}
+
+    def _result(self, messages, text, additional_kwargs):
+        prompt_tokens = self.get_num_tokens_from_messages(messages)
+        completion_tokens = count_tokens(text)
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=text, additional_kwargs=additional_kwargs))],
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+                "model_name": self._llm_type,
+            },
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, stream=None, **kwargs: Any) -> ChatResult:
+        text, additional_kwargs = self._respond(messages, kwargs.get("functions"))
+        time.sleep(self.latency)
+        for token in re.findall(r"\S+\s*", text):
+            time.sleep(1 / self.tokens_per_second)
+            if self.streaming and run_manager:
+                run_manager.on_llm_new_token(token)
+        return self._result(messages, text, additional_kwargs)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, stream=None, **kwargs: Any) -> ChatResult:
+        text, additional_kwargs = self._respond(messages, kwargs.get("functions"))
+        await asyncio.sleep(self.latency)
+        for token in re.findall(r"\S+\s*", text):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            if self.streaming and run_manager:
+                await run_manager.on_llm_new_token(token)
+        return self._result(messages, text, additional_kwargs)
+
+
+# Deterministic embeddings from hashed words and word pairs, no network needed
+class HashingEmbeddings(Embeddings):
+    def __init__(self, size=256):
+        self.size = size
+
+    def _embed(self, text):
+        vector = [0.0] * self.size
+        words = re.findall(r"\w+", text.lower())
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.size
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+# The chat model used by the agent, selected by CHAT_LLM_PROVIDER
+def get_chat_model(streaming: Optional[bool] = None):
+    if streaming is None:
+        streaming = settings.CHAT_STREAMING
+
+    if settings.CHAT_LLM_PROVIDER == "fake":
+        return FakeChatModel(
+            latency=settings.CHAT_FAKE_LLM_LATENCY,
+            tokens_per_second=settings.CHAT_FAKE_LLM_TOKENS_PER_SECOND,
+            streaming=streaming,
+        )
+    return ChatOpenAI(
+        openai_api_key=os.environ.get('OPENAI_API_KEY'),
+        model=settings.CHAT_OPENAI_MODEL,
+        temperature=0,
+        streaming=streaming,
+    )
+
+
+# The embedding model used for the document index, selected by CHAT_EMBEDDINGS_PROVIDER
+def get_embeddings():
+    if settings.CHAT_EMBEDDINGS_PROVIDER == "hashing":
+        return HashingEmbeddings()
+    return OpenAIEmbeddings(openai_api_key=os.environ.get('OPENAI_API_KEY'))
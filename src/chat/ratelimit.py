@@ -0,0 +1,99 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+# Allows `burst` messages at once and `rate` per second after that
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Returns 0 if a message may go ahead, otherwise the seconds until it could
+    def wait(self):
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            return 0
+        if self.rate <= 0:
+            return math.inf
+        return (1 - self.tokens) / self.rate
+
+    # Same as wait(), and spends a token if the message goes ahead
+    def take(self):
+        wait = self.wait()
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+# One bucket per key (e.g. room), full buckets are forgotten first once
+# there are more than `maxsize`
+class BucketMap:
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._prune()
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            self._buckets.move_to_end(key)
+            return bucket.take()
+
+    # What take(key) would return, without spending a token
+    def wait(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            return bucket.wait() if bucket is not None else TokenBucket(self.rate, self.burst).wait()
+
+    # Make room for one more bucket
+    def _prune(self):
+        if len(self._buckets) < self.maxsize:
+            return
+        for key in [key for key, bucket in self._buckets.items() if bucket.is_full()]:
+            del self._buckets[key]
+        while len(self._buckets) >= self.maxsize:
+            self._buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+_room_buckets = None
+_room_buckets_lock = threading.Lock()
+
+
+def connection_bucket():
+    return TokenBucket(settings.CHAT_RATE_CONNECTION_PER_MINUTE / 60, settings.CHAT_RATE_CONNECTION_BURST)
+
+
+def room_buckets():
+    global _room_buckets
+    if _room_buckets is None:
+        with _room_buckets_lock:
+            if _room_buckets is None:
+                _room_buckets = BucketMap(settings.CHAT_RATE_ROOM_PER_MINUTE / 60, settings.CHAT_RATE_ROOM_BURST)
+    return _room_buckets
+
+
+# Whole seconds for the busy frame, at least 1
+def retry_after(seconds):
+    return max(1, math.ceil(min(seconds, 3600)))
@@ -0,0 +1,22 @@
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+_client = None
+
+
+# Shared Redis connection pool for the chat app (not the channel layer)
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.CHAT_REDIS_URL)
+    return _client
+
+
+# Calls a store's `method` from the event loop. A Redis round trip runs on a
+# worker thread, one slow reply would stall every socket of the process.
+# Stores held in this process are called right away.
+async def call(method, *args):
+    if isinstance(getattr(method.__self__, "client", None), redis.Redis):
+        return await sync_to_async(method, thread_sensitive=False)(*args)
+    return method(*args)
@@ -0,0 +1,136 @@
+import json
+import threading
+import uuid
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Room events a guest must not miss (their echoed message and the full
+# replies) are numbered per room and the last CHAT_REPLAY_BUFFER_SIZE of
+# them kept. A client that reconnects sends the last number it saw and gets
+# what it missed, instead of asking again for another agent run. Streamed
+# deltas are not kept, the full reply replaces them.
+#
+# Numbers are only comparable within an epoch. A buffer that is lost
+# (restart, expiry, eviction) starts a new epoch from 1, and what was in it
+# cannot be replayed any more.
+
+sequenced_types = ("chat_message", "bot_message")
+
+
+class _Room:
+    def __init__(self, size):
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.events = deque(maxlen=size)
+
+
+# Events of this process only, right when one process answers every room
+class InMemoryReplayBuffer:
+    def __init__(self, size=50, max_rooms=10000):
+        self.size = size
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()  # group -> _Room
+        self._lock = threading.Lock()
+
+    # Returns the event with its "seq" and "epoch"
+    def append(self, group, event):
+        with self._lock:
+            room = self._rooms.get(group)
+            if room is None:
+                room = self._rooms[group] = _Room(self.size)
+                while len(self._rooms) > self.max_rooms:
+                    self._rooms.popitem(last=False)
+            self._rooms.move_to_end(group)
+            room.seq += 1
+            event = dict(event, seq=room.seq, epoch=room.epoch)
+            room.events.append(event)
+            return event
+
+    def since(self, group, epoch, last_seq):
+        with self._lock:
+            room = self._rooms.get(group)
+            if room is None:
+                return []
+            events = list(room.events)
+        return missed(events, epoch, last_seq)
+
+
+# Events shared by every process through Redis, needed when queue workers
+# publish the replies. The counter and the events expire CHAT_SESSION_TTL
+# seconds after the room's last event.
+class RedisReplayBuffer:
+    prefix = "chat:replay:"
+
+    # Numbers the event and stores it in one step, two processes appending at
+    # once cannot store their events out of order. The list holds [seq, epoch, event].
+    append_script = """
+redis.call("hsetnx", KEYS[1], "epoch", ARGV[1])
+local seq = redis.call("hincrby", KEYS[1], "seq", 1)
+local epoch = redis.call("hget", KEYS[1], "epoch")
+redis.call("rpush", KEYS[2], "[" .. seq .. ",\"" .. epoch .. "\"," .. ARGV[2] .. "]")
+redis.call("ltrim", KEYS[2], -tonumber(ARGV[3]), -1)
+redis.call("expire", KEYS[1], ARGV[4])
+redis.call("expire", KEYS[2], ARGV[4])
+return {seq, epoch}
+"""
+
+    def __init__(self, client, size=50, ttl=86400):
+        self.client = client
+        self.size = size
+        self.ttl = ttl
+
+    def _keys(self, group):
+        return f"{self.prefix}{group}:seq", f"{self.prefix}{group}:events"
+
+    def append(self, group, event):
+        seq, epoch = self.client.eval(
+            self.append_script, 2, *self._keys(group), uuid.uuid4().hex, json.dumps(event), self.size, self.ttl
+        )
+        return dict(event, seq=seq, epoch=epoch.decode() if isinstance(epoch, bytes) else epoch)
+
+    def since(self, group, epoch, last_seq):
+        _, events_key = self._keys(group)
+        events = []
+        for raw in self.client.lrange(events_key, 0, -1):
+            seq, event_epoch, event = json.loads(raw)
+            events.append(dict(event, seq=seq, epoch=event_epoch))
+        events.sort(key=lambda event: event["seq"])
+        return missed(events, epoch, last_seq)
+
+
+# Events of the current epoch after `last_seq`. A client from another epoch
+# (another room, or a buffer that is gone) gets nothing, the buffer may hold
+# other guests' messages from before it joined.
+def missed(events, epoch, last_seq):
+    if not events or epoch != events[-1]["epoch"]:
+        return []
+    return [event for event in events if event["epoch"] == epoch and event["seq"] > last_seq]
+
+
+_buffer = None
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        # Workers number the replies, the web processes replay them
+        if settings.CHAT_AGENT_MODE == "queue" and settings.CHAT_REPLAY_BACKEND != "redis":
+            raise ImproperlyConfigured("CHAT_AGENT_MODE = 'queue' needs CHAT_REPLAY_BACKEND = 'redis'")
+        if settings.CHAT_REPLAY_BACKEND == "redis":
+            from .redis_client import get_redis
+
+            _buffer = RedisReplayBuffer(get_redis(), settings.CHAT_REPLAY_BUFFER_SIZE, settings.CHAT_SESSION_TTL)
+        else:
+            _buffer = InMemoryReplayBuffer(settings.CHAT_REPLAY_BUFFER_SIZE, settings.CHAT_SESSION_MAX)
+    return _buffer
+
+
+# Number the event if guests have to get it after a reconnect
+async def record(group, event):
+    from .redis_client import call
+
+    if not settings.CHAT_REPLAY_BUFFER_SIZE or event["type"] not in sequenced_types:
+        return event
+    return await call(get_buffer().append, group, event)
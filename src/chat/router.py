@@ -0,0 +1,181 @@
+import math
+import re
+import threading
+from collections import Counter
+
+from . import metrics
+from . import parsing
+
+# Cheap local routing of a guest's message before the agent. Small talk and
+# clearly off-topic questions get a canned reply, complete availability
+# requests go straight to the availability tool, the rest goes to the agent.
+
+GREETING = "greeting"
+THANKS = "thanks"
+OFF_TOPIC = "off_topic"
+AVAILABILITY = "availability"
+AGENT = "agent"
+
+greeting_reply = "Hello! How can I help you with your stay at Crowne Plaza Changi Airport?"
+thanks_reply = "You're welcome! Let me know if there is anything else about your stay."
+off_topic_reply = "Sorry, I can only help with questions about Crowne Plaza Hotel Singapore."
+
+# Whole message only, "thanks, my feedback is ..." still goes to the agent
+greeting_pattern = re.compile(
+    r"^\s*(hi|hello|hey|hiya|yo|good (morning|afternoon|evening)|greetings)( there)?\s*[!.]*\s*$", re.I
+)
+thanks_pattern = re.compile(
+    r"^\s*(thanks|thank you|thx|ty|cheers|ok thanks|okay thanks|great,? thanks)( (so|very) much)?( a lot)?\s*[!.]*\s*$",
+    re.I,
+)
+
+# A message with any of these is about the hotel, whatever the classifier says
+hotel_words = {
+    "hotel", "room", "rooms", "stay", "check", "checkin", "checkout", "book", "booking", "reservation",
+    "price", "rate", "rates", "breakfast", "pool", "gym", "spa", "wifi", "parking", "airport", "changi",
+    "crowne", "plaza", "shuttle", "transfer", "restaurant", "bar", "day", "use", "late", "early",
+    "adult", "adults", "child", "children", "guest", "guests", "night", "nights", "bed", "suite",
+    "feedback", "complaint", "staff", "lobby", "luggage", "towel", "laundry", "pet", "pets", "smoking",
+}
+
+# Training examples of the classifier
+hotel_examples = [
+    "what time is check in", "what time is check out", "do you have day use rooms",
+    "is breakfast included", "how much is a room for one night", "is there a shuttle to the airport",
+    "can i get a late check out", "where is the swimming pool", "do you have a gym",
+    "how do i get to the hotel from terminal 3", "is wifi free", "can i store my luggage",
+    "are pets allowed", "what restaurants are in the hotel", "i want to book a room",
+    "is there parking", "how far is jewel from the hotel", "can i cancel my reservation",
+    "what facilities do you have", "do the rooms have a bathtub",
+]
+off_topic_examples = [
+    "write me a poem about the sea", "what is the capital of france", "solve this math equation for me",
+    "who won the football match yesterday", "tell me a joke", "write python code to sort a list",
+    "what is the meaning of life", "translate this sentence to spanish", "what is the weather in london",
+    "explain quantum physics", "who is the president of the united states", "recommend a good movie",
+    "how do i bake a chocolate cake", "what is the stock price of apple", "help me with my homework",
+    "write an essay about climate change", "what is bitcoin", "how tall is mount everest",
+    "give me a workout plan", "what is your favourite colour",
+]
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+
+# Multinomial naive Bayes over words, small enough to train at import
+class NaiveBayes:
+    def __init__(self, examples):
+        self.counts = {label: Counter() for label in examples}
+        self.totals = {}
+        for label, texts in examples.items():
+            for text in texts:
+                self.counts[label].update(tokenize(text))
+            self.totals[label] = sum(self.counts[label].values())
+        self.vocabulary = set().union(*self.counts.values())
+
+    # Log probability of the message for every label
+    def scores(self, text):
+        words = tokenize(text)
+        size = len(self.vocabulary) + 1
+        return {
+            label: sum(math.log((counts[word] + 1) / (self.totals[label] + size)) for word in words)
+            for label, counts in self.counts.items()
+        }
+
+
+classifier = NaiveBayes({"hotel": hotel_examples, OFF_TOPIC: off_topic_examples})
+
+# Log odds the classifier needs before a message is refused
+OFF_TOPIC_MARGIN = 3.0
+
+
+def is_off_topic(message):
+    words = tokenize(message)
+    # Short follow ups ("and for two?") only make sense with the history
+    if len(words) < 4 or hotel_words.intersection(words):
+        return False
+    scores = classifier.scores(message)
+    return scores[OFF_TOPIC] - scores["hotel"] >= OFF_TOPIC_MARGIN
+
+
+class Route:
+    def __init__(self, name, reply=None, booking=None):
+        self.name = name
+        self.reply = reply
+        self.booking = booking
+
+
+def route(message):
+    if greeting_pattern.match(message):
+        return Route(GREETING, reply=greeting_reply)
+    if thanks_pattern.match(message):
+        return Route(THANKS, reply=thanks_reply)
+
+    booking = parsing.parse_booking_request(message)
+    if booking is not None:
+        return Route(AVAILABILITY, booking=booking)
+
+    if is_off_topic(message):
+        return Route(OFF_TOPIC, reply=off_topic_reply)
+    return Route(AGENT)
+
+
+# Reply for the rooms the availability tool returned
+def format_rooms(rooms, booking):
+    if isinstance(rooms, str):
+        return rooms
+    if not rooms:
+        return "There are no rooms available for those dates."
+    lines = [
+        f"Rooms available from {booking['check_in_date']} to {booking['check_out_date']} "
+        f"for {booking['num_adult']} adult(s), {booking['num_children']} child(ren), {booking['num_rooms']} room(s):"
+    ]
+    lines.extend(f"- {room['name']}: {room['price']}" for room in rooms)
+    return "\n".join(lines)
+
+
+# Per route counts and latency, the saving is measured against agent runs
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def record(name, elapsed):
+    with _stats_lock:
+        entry = _stats.setdefault(name, {"count": 0, "total_s": 0.0})
+        entry["count"] += 1
+        entry["total_s"] += elapsed
+
+
+def stats():
+    with _stats_lock:
+        routes = {name: dict(entry, mean_s=entry["total_s"] / entry["count"]) for name, entry in _stats.items()}
+    agent = routes.get(AGENT)
+    for name, entry in routes.items():
+        if agent and name != AGENT:
+            entry["saved_s"] = max(0.0, agent["mean_s"] - entry["mean_s"]) * entry["count"]
+    return routes
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+# Share of the messages answered without an agent run
+def hit_rate():
+    with _stats_lock:
+        total = sum(entry["count"] for entry in _stats.values())
+        agent = _stats.get(AGENT, {"count": 0})["count"]
+    return (total - agent) / total if total else None
+
+
+metrics.register_gauge(
+    "chat_route_messages", "Messages answered by each route.",
+    lambda: {name: entry["count"] for name, entry in stats().items()}, label="route",
+)
+metrics.register_gauge(
+    "chat_route_saved_seconds", "Seconds saved by the routes answering without the agent.",
+    lambda: {name: entry["saved_s"] for name, entry in stats().items() if "saved_s" in entry}, label="route",
+)
+metrics.register_gauge("chat_route_hit_rate", "Share of the messages answered without the agent.", hit_rate)
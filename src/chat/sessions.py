@@ -0,0 +1,169 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Messages are kept as compact (role, content) pairs
+role_to_code = {"user": "u", "assistant": "a"}
+code_to_role = {"u": "user", "a": "assistant"}
+
+
+def session_key(room_name, session_id):
+    return f"{room_name}:{session_id}"
+
+
+# Room of a session key, None without one
+def room_of(key):
+    return key.rsplit(":", 1)[0] if key else None
+
+
+def to_compact(messages):
+    return [
+        (role_to_code[message["role"]], message["content"])
+        for message in messages
+        if message.get("role") in role_to_code
+    ]
+
+
+def from_compact(pairs):
+    return [{"role": code_to_role[code], "content": content} for code, content in pairs]
+
+
+class _Session:
+    __slots__ = ("last_used", "pairs", "summary")
+
+    def __init__(self, pairs):
+        self.last_used = time.monotonic()
+        self.pairs = pairs
+        # Rolling summary of the oldest messages, see memory.py
+        self.summary = None
+
+
+# Sessions held in this process, least recently used are dropped first
+class InMemorySessionStore:
+    def __init__(self, max_sessions, ttl):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # key -> _Session
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if now - session.last_used > self.ttl:
+            del self._sessions[key]
+            return None
+        session.last_used = now
+        self._sessions.move_to_end(key)
+        return session
+
+    def _get_or_create(self, key):
+        session = self._get(key)
+        if session is None:
+            session = self._sessions[key] = _Session([])
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def exists(self, key):
+        with self._lock:
+            return self._get(key) is not None
+
+    def get_history(self, key):
+        with self._lock:
+            session = self._get(key)
+            return None if session is None else from_compact(session.pairs)
+
+    def replace(self, key, messages):
+        with self._lock:
+            session = self._get_or_create(key)
+            session.pairs = to_compact(messages)
+            session.summary = None
+
+    def append(self, key, role, content):
+        with self._lock:
+            self._get_or_create(key).pairs.append((role_to_code[role], content))
+
+    def get_summary(self, key):
+        with self._lock:
+            session = self._get(key)
+            return None if session is None else session.summary
+
+    def set_summary(self, key, summary):
+        with self._lock:
+            self._get_or_create(key).summary = summary
+
+    def delete(self, key):
+        with self._lock:
+            self._sessions.pop(key, None)
+
+
+# Sessions shared by every worker through Redis lists
+class RedisSessionStore:
+    prefix = "chat:session:"
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    def _messages_key(self, key):
+        return f"{self.prefix}{key}:messages"
+
+    def _summary_key(self, key):
+        return f"{self.prefix}{key}:summary"
+
+    def exists(self, key):
+        return bool(self.client.exists(self._messages_key(key)))
+
+    def get_history(self, key):
+        raw = self.client.lrange(self._messages_key(key), 0, -1)
+        if not raw:
+            return None
+        return from_compact(json.loads(item) for item in raw)
+
+    def replace(self, key, messages):
+        messages_key = self._messages_key(key)
+        pipe = self.client.pipeline()
+        pipe.delete(messages_key, self._summary_key(key))
+        # Redis has no empty lists, an empty session only exists once appended to
+        pairs = to_compact(messages)
+        if pairs:
+            pipe.rpush(messages_key, *[json.dumps(pair) for pair in pairs])
+            pipe.expire(messages_key, self.ttl)
+        pipe.execute()
+
+    def append(self, key, role, content):
+        messages_key = self._messages_key(key)
+        pipe = self.client.pipeline()
+        pipe.rpush(messages_key, json.dumps((role_to_code[role], content)))
+        pipe.expire(messages_key, self.ttl)
+        pipe.execute()
+
+    def get_summary(self, key):
+        raw = self.client.get(self._summary_key(key))
+        return None if raw is None else json.loads(raw)
+
+    def set_summary(self, key, summary):
+        self.client.set(self._summary_key(key), json.dumps(summary), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self._messages_key(key), self._summary_key(key))
+
+
+_store = None
+
+
+def get_session_store():
+    global _store
+    if _store is None:
+        if settings.CHAT_SESSION_BACKEND == "redis":
+            from .redis_client import get_redis
+
+            _store = RedisSessionStore(get_redis(), settings.CHAT_SESSION_TTL)
+        else:
+            _store = InMemorySessionStore(settings.CHAT_SESSION_MAX, settings.CHAT_SESSION_TTL)
+    return _store
@@ -1,11 +1,63 @@
-from django.test import TestCase
-from channels.testing import ChannelsLiveServerTestCase
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from io import StringIO
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import redis
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import ChannelsLiveServerTestCase, WebsocketCommunicator
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.embeddings.fake import FakeEmbeddings
+from langchain.llms.fake import FakeListLLM
+from langchain.schema import AIMessage, ChatGeneration, Document, HumanMessage, LLMResult, SystemMessage
 from selenium import webdriver
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.wait import WebDriverWait
 
+from . import agent_runner
+from . import answer_cache
+from . import availability
+from . import browser_pool
+from . import callbacks
+from . import consumers
+from . import context
+from . import docstore
+from . import feedback
+from . import job_queue
+from . import memory
+from . import metrics
+from .models import TokenUsage
+from . import openai_utils
+from . import prefetch
+from . import presence
+from . import providers
+from . import ratelimit
+from . import redis_client
+from . import replay
+from . import router
+from .routing import websocket_urlpatterns
+from . import sessions
+from . import usage
+from . import vectorstore
+from . import webscraping
+from . import workers
+
 
 class ChatTests(ChannelsLiveServerTestCase):
     serve_static = True  # emulate StaticLiveServerTestCase
@@ -103,4 +155,1741 @@ class ChatTests(ChannelsLiveServerTestCase):
     def _chat_log_value(self):
         return self.driver.find_element(
             by=By.CSS_SELECTOR, value="#chat-log"
-        ).get_property("value")
\ No newline at end of file
+        ).get_property("value")
+
+
+class AgentRunnerTests(SimpleTestCase):
+    def test_messages_in_same_room_are_answered_in_order(self):
+        order = []
+
+        def job(name, delay):
+            time.sleep(delay)
+            order.append(name)
+            return name
+
+        async def run():
+            return await asyncio.gather(
+                agent_runner.run_for_room("room_1", job, "first", 0.2),
+                agent_runner.run_for_room("room_1", job, "second", 0),
+            )
+
+        self.assertEqual(asyncio.run(run()), ["first", "second"])
+        self.assertEqual(order, ["first", "second"])
+        self.assertEqual(agent_runner.queue_depth(), 0)
+
+    def test_event_loop_is_not_blocked_by_agent_run(self):
+        started = threading.Event()
+
+        def job():
+            started.set()
+            time.sleep(0.3)
+
+        async def run():
+            task = asyncio.ensure_future(agent_runner.run_for_room("room_1", job))
+            await asyncio.sleep(0.05)
+            depth = agent_runner.queue_depth()
+            # The loop keeps ticking while the job is running
+            ticks_start = time.monotonic()
+            await asyncio.sleep(0.01)
+            lag = time.monotonic() - ticks_start
+            await task
+            return depth, lag
+
+        depth, lag = asyncio.run(run())
+        self.assertTrue(started.is_set())
+        self.assertEqual(depth, 1)
+        self.assertLess(lag, 0.1)
+
+
+@override_settings(CHAT_LLM_PROVIDER="fake", CHAT_ROUTER_ENABLED=False, CHAT_TOKEN_USAGE_PERSIST=False)
+class SharedAgentTests(SimpleTestCase):
+    def setUp(self):
+        llm = providers.FakeChatModel(latency=0, tokens_per_second=10000)
+        patcher = mock.patch.dict(openai_utils._resources, {"llm": llm}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_agent_is_built_once_for_all_messages(self):
+        with mock.patch.object(openai_utils, "build_agent", wraps=openai_utils.build_agent) as build_agent:
+            for message in ("hello there", "good morning", "thanks a lot"):
+                reply = openai_utils.generate_chat_response([{"role": "user", "content": message}])
+                self.assertEqual(reply, providers.FakeChatModel.__fields__["reply"].default)
+
+        self.assertEqual(build_agent.call_count, 1)
+
+    def test_agent_is_rebuilt_for_other_tools(self):
+        with mock.patch.object(openai_utils, "build_agent", wraps=openai_utils.build_agent) as build_agent:
+            agent = openai_utils.get_agent()
+            without_doc_search = openai_utils.get_agent(doc_search=False)
+            self.assertIs(openai_utils.get_agent(), agent)
+
+        self.assertEqual(build_agent.call_count, 2)
+        self.assertIsNot(without_doc_search, agent)
+        self.assertIn("get_doc_info", [tool.name for tool in agent.tools])
+        self.assertNotIn("get_doc_info", [tool.name for tool in without_doc_search.tools])
+
+
+class SessionStoreTests(SimpleTestCase):
+    def test_history_is_kept_in_compact_form(self):
+        store = sessions.InMemorySessionStore(max_sessions=10, ttl=60)
+        key = sessions.session_key("room_1", "abc")
+        self.assertFalse(store.exists(key))
+
+        store.replace(key, [{"role": "user", "content": "hi", "timestamp": "10:00"}])
+        store.append(key, "assistant", "Hello!")
+
+        self.assertEqual(store._sessions[key].pairs, [("u", "hi"), ("a", "Hello!")])
+        self.assertEqual(
+            store.get_history(key),
+            [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "Hello!"}],
+        )
+
+    def test_least_recently_used_session_is_dropped(self):
+        store = sessions.InMemorySessionStore(max_sessions=2, ttl=60)
+        store.append("room_1:a", "user", "one")
+        store.append("room_1:b", "user", "two")
+        store.get_history("room_1:a")
+        store.append("room_1:c", "user", "three")
+
+        self.assertTrue(store.exists("room_1:a"))
+        self.assertFalse(store.exists("room_1:b"))
+        self.assertTrue(store.exists("room_1:c"))
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_PRESENCE_BACKEND="memory",
+    CHAT_SESSION_BACKEND="memory",
+    CHAT_LLM_PROVIDER="fake",
+)
+class SessionConsumerTests(SimpleTestCase):
+    def setUp(self):
+        presence._presence = None
+        sessions._store = None
+        self.addCleanup(setattr, sessions, "_store", None)
+
+    def talk(self, *commands):
+        async def run():
+            client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+            await client.connect()
+            frames = []
+            for command in commands:
+                await client.send_json_to(command)
+                # Until the reply, or the request to resend the history
+                while True:
+                    frames.append(await client.receive_json_from(timeout=10))
+                    if {"assistant_message", "session_missing"} & frames[-1].keys():
+                        break
+            await client.disconnect()
+            return frames
+
+        return asyncio.run(run())
+
+    def test_unknown_or_expired_session_asks_for_the_history(self):
+        key = sessions.session_key("lobby", "expired")
+        sessions.get_session_store().replace(key, [{"role": "user", "content": "hello"}])
+        sessions.get_session_store().delete(key)
+
+        for session_id in ("unknown", "expired"):
+            frames = self.talk({"command": "send_message", "session_id": session_id, "message": "hi"})
+            self.assertEqual(frames, [{"session_missing": session_id, "message_new": "hi"}])
+
+    def test_history_seeds_the_session(self):
+        history = [{"role": "user", "content": "hello", "timestamp": "10:00"}, {"role": "assistant", "content": "Hi!"}]
+        frames = self.talk(
+            {"command": "send_all_messages", "session_id": "s1", "message_new": "hi", "messages": history},
+            # Later messages only send the new message
+            {"command": "send_message", "session_id": "s1", "message": "hi"},
+        )
+
+        self.assertNotIn("session_missing", [key for frame in frames for key in frame])
+        self.assertEqual([frame["assistant_message"] for frame in frames if "assistant_message" in frame],
+                         [router.greeting_reply, router.greeting_reply])
+        self.assertEqual(
+            sessions.get_session_store().get_history(sessions.session_key("lobby", "s1")),
+            [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "Hi!"},
+             {"role": "user", "content": "hi"}, {"role": "assistant", "content": router.greeting_reply},
+             {"role": "user", "content": "hi"}, {"role": "assistant", "content": router.greeting_reply}],
+        )
+
+
+class WordCountLLM(FakeListLLM):
+    def get_num_tokens(self, text):
+        return len(text.split())
+
+    def get_num_tokens_from_messages(self, messages):
+        return sum(len(message.content.split()) for message in messages)
+
+
+@override_settings(CHAT_MEMORY_TOKEN_BUDGET=6)
+class ChatMemoryTests(SimpleTestCase):
+    def test_old_turns_are_summarised_once_and_cached(self):
+        llm = WordCountLLM(responses=["guest wants a room", "guest wants a room for two"])
+        store = sessions.InMemorySessionStore(max_sessions=10, ttl=60)
+        history = [
+            {"role": "user", "content": "hello there"},
+            {"role": "assistant", "content": "hi how can I help"},
+            {"role": "user", "content": "a room please"},
+            {"role": "assistant", "content": "for how many"},
+        ]
+
+        chat_history, prompt_tokens = memory.build_chat_history(llm, history, "two adults", "room_1:a", store)
+        self.assertEqual(chat_history[0].content, "guest wants a room")
+        self.assertEqual([message.content for message in chat_history[1:]], ["a room please", "for how many"])
+        self.assertEqual(prompt_tokens, 4 + 3 + 3 + 2)
+        self.assertEqual(store.get_summary("room_1:a")["folded"], 2)
+
+        # Still within budget with the summary reused, no new summary is made
+        chat_history, _ = memory.build_chat_history(llm, history, "two adults", "room_1:a", store)
+        self.assertEqual(llm.i, 1)
+        self.assertEqual(chat_history[0].content, "guest wants a room")
+
+    def test_summary_tokens_count_against_the_room(self):
+        llm = WordCountLLM(responses=["guest wants a room"])
+        tracker = usage.TokenUsageTracker()
+        history = [
+            {"role": "user", "content": "hello there"},
+            {"role": "assistant", "content": "hi how can I help"},
+            {"role": "user", "content": "a room please"},
+        ]
+
+        handler = callbacks.UsageCallbackHandler(tracker, llm, "room_1", source="summary")
+        memory.build_chat_history(llm, history, "two adults", "room_1:a", callbacks=[handler])
+
+        summary = tracker.snapshot()["rooms"]["room_1"]["summary"]
+        self.assertEqual((summary["calls"], summary["completion_tokens"]), (1, 4))
+        self.assertEqual(tracker.window_tokens("room_1"), summary["prompt_tokens"] + 4)
+
+    def test_summary_of_a_different_conversation_is_ignored(self):
+        llm = WordCountLLM(responses=["unused"])
+        store = sessions.InMemorySessionStore(max_sessions=10, ttl=60)
+        store.set_summary("room_1:a", {"summary": "stale", "folded": 1, "prefix": "0"})
+
+        chat_history, _ = memory.build_chat_history(
+            llm, [{"role": "user", "content": "hi"}], "hello", "room_1:a", store
+        )
+        self.assertEqual([message.content for message in chat_history], ["hi"])
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    embedded: int = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return super().embed_documents(texts)
+
+
+@override_settings(CHAT_DOCUMENTS_GLOB="*.txt")
+class DocumentIndexTests(SimpleTestCase):
+    def test_only_changed_chunks_are_embedded(self):
+        with tempfile.TemporaryDirectory() as docs_dir, tempfile.TemporaryDirectory() as index_dir:
+            Path(docs_dir, "a.txt").write_text("Check in is at 3pm.")
+            Path(docs_dir, "b.txt").write_text("Day use rooms are available.")
+            embeddings = CountingEmbeddings(size=8)
+
+            result = docstore.sync_index(embeddings, docs_dir, index_dir)
+            self.assertEqual(result, {"added": 2, "removed": 0, "kept": 0})
+            fingerprint = docstore.index_fingerprint(index_dir)
+
+            result = docstore.sync_index(embeddings, docs_dir, index_dir)
+            self.assertEqual(result, {"added": 0, "removed": 0, "kept": 2})
+            self.assertEqual(docstore.index_fingerprint(index_dir), fingerprint)
+
+            Path(docs_dir, "b.txt").write_text("Day use rooms are sold out.")
+            result = docstore.sync_index(embeddings, docs_dir, index_dir)
+            self.assertEqual(result, {"added": 1, "removed": 1, "kept": 1})
+            self.assertEqual(embeddings.embedded, 3)
+            self.assertNotEqual(docstore.index_fingerprint(index_dir), fingerprint)
+
+    def test_other_embeddings_rebuild_the_index(self):
+        with tempfile.TemporaryDirectory() as docs_dir, tempfile.TemporaryDirectory() as index_dir:
+            Path(docs_dir, "a.txt").write_text("Check in is at 3pm.")
+            Path(docs_dir, "b.txt").write_text("Day use rooms are available.")
+
+            with self.settings(CHAT_EMBEDDINGS_PROVIDER="hashing"):
+                docstore.sync_index(CountingEmbeddings(size=8), docs_dir, index_dir)
+            Path(docs_dir, "b.txt").write_text("Day use rooms are sold out.")
+            with self.settings(CHAT_EMBEDDINGS_PROVIDER="openai"):
+                result = docstore.sync_index(CountingEmbeddings(size=8), docs_dir, index_dir)
+
+            # No chunk embedded by the old model is kept
+            self.assertEqual(result, {"added": 2, "removed": 0, "kept": 0})
+            self.assertEqual(docstore.read_manifest(index_dir)["embeddings"], "openai")
+
+    @override_settings(CHAT_EMBEDDINGS_PROVIDER="hashing", CHAT_VECTOR_BACKEND="chroma")
+    def test_chroma_scores_are_relevances(self):
+        with tempfile.TemporaryDirectory() as docs_dir, tempfile.TemporaryDirectory() as index_dir:
+            Path(docs_dir, "a.txt").write_text("Check in is at 3pm.")
+            Path(docs_dir, "b.txt").write_text("Day use rooms are available.")
+            # An index from before the cosine metric is built again
+            docstore.sync_index(providers.HashingEmbeddings(), docs_dir, index_dir)
+            manifest = docstore.read_manifest(index_dir)
+            del manifest["metric"]
+            Path(docstore.manifest_path(index_dir)).write_text(json.dumps(manifest))
+            result = docstore.sync_index(providers.HashingEmbeddings(), docs_dir, index_dir)
+
+            store = docstore.open_index(providers.HashingEmbeddings(), index_dir)
+            with warnings.catch_warnings():
+                warnings.filterwarnings("error", message="Relevance scores must be between")
+                scores = [score for _, score in store.similarity_search_with_relevance_scores("late check out", k=2)]
+
+        self.assertEqual(result["added"], 2)
+        self.assertEqual(len(scores), 2)
+        self.assertTrue(all(0 <= score <= 1 for score in scores), scores)
+
+
+class NumpyVectorStoreTests(SimpleTestCase):
+    texts = ["Check in is at 3pm.", "Day use rooms are available.", "The pool opens at 7am."]
+
+    def test_queries_return_the_most_similar_chunks(self):
+        store = vectorstore.NumpyVectorStore.from_texts(self.texts, providers.HashingEmbeddings())
+        docs = store.as_retriever(search_kwargs={"k": 1}).get_relevant_documents("When is check in?")
+        self.assertEqual(docs[0].page_content, "Check in is at 3pm.")
+
+        results = store.batch_similarity_search(["pool opens", "day use rooms", "pool opens"], k=2)
+        self.assertEqual([docs[0].page_content for docs in results], [self.texts[2], self.texts[1], self.texts[2]])
+        self.assertEqual(len(results[0]), 2)
+        # The repeated query was embedded once
+        self.assertEqual((store.query_cache_misses, store.query_cache_hits), (3, 1))
+
+    @override_settings(CHAT_DOCUMENTS_GLOB="*.txt", CHAT_VECTOR_BACKEND="numpy")
+    def test_index_is_memory_mapped_and_only_changed_chunks_are_embedded(self):
+        with tempfile.TemporaryDirectory() as docs_dir, tempfile.TemporaryDirectory() as index_dir:
+            for number, text in enumerate(self.texts):
+                Path(docs_dir, f"{number}.txt").write_text(text)
+            embeddings = CountingEmbeddings(size=8)
+
+            self.assertEqual(docstore.sync_index(embeddings, docs_dir, index_dir), {"added": 3, "removed": 0, "kept": 0})
+            Path(docs_dir, "1.txt").write_text("Day use rooms are sold out.")
+            self.assertEqual(docstore.sync_index(embeddings, docs_dir, index_dir), {"added": 1, "removed": 1, "kept": 2})
+            self.assertEqual(embeddings.embedded, 4)
+
+            store = docstore.open_index(embeddings, index_dir)
+            self.assertIsInstance(store, vectorstore.NumpyVectorStore)
+            self.assertIsInstance(store.vectors, np.memmap)
+            self.assertEqual(store.vectors.shape, (3, 8))
+            self.assertIn("Day use rooms are sold out.", store.texts)
+
+
+class ContextRetrieverTests(SimpleTestCase):
+    texts = [
+        "Check in is from 3pm and check out is at 12pm.",
+        "Check in is from 3pm and check out is at 12pm. Late check out is possible.",
+        "The swimming pool on level 10 opens at 7am.",
+        "Day use rooms can be booked for up to 12 hours between 8am and 8pm.",
+    ]
+
+    def setUp(self):
+        context.reset_stats()
+        store = vectorstore.NumpyVectorStore.from_texts(self.texts, providers.HashingEmbeddings())
+        self.retriever = context.ContextRetriever(
+            store=store, count_tokens=providers.count_tokens, token_budget=25, k=3, fetch_k=4, duplicate_threshold=0.5
+        )
+
+    def test_duplicates_are_dropped_and_context_fits_the_budget(self):
+        docs = self.retriever.get_relevant_documents("When is check out?")
+        contents = [doc.page_content for doc in docs]
+
+        self.assertEqual(sum(1 for text in contents if text.startswith("Check in")), 1)
+        self.assertIn("check out", contents[0])
+        self.assertLessEqual(sum(providers.count_tokens(text) for text in contents), 25)
+        stats = context.stats()
+        self.assertEqual((stats["queries"], stats["duplicates"]), (1, 1))
+        self.assertGreater(stats["tokens_saved_per_query"], 0)
+
+    def test_question_words_rank_chunks(self):
+        docs = asyncio.run(self.retriever.aget_relevant_documents("Can I book a day use room?"))
+        self.assertTrue(docs[0].page_content.startswith("Day use rooms"))
+
+    def test_out_of_range_scores_do_not_outrank_the_words(self):
+        docs = [Document(page_content=text) for text in self.texts]
+        # An l2 collection scores below 0
+        context_docs = self.retriever.build("When does the pool open?", [(docs[0], -3.0), (docs[2], -5.0)])
+        self.assertEqual(context_docs[0].page_content, self.texts[2])
+
+
+class TokenCollector(BaseCallbackHandler):
+    def __init__(self):
+        self.tokens = []
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+
+class OfflineProviderTests(SimpleTestCase):
+    def test_fake_chat_model_calls_availability_function(self):
+        llm = providers.FakeChatModel(latency=0, tokens_per_second=10000)
+        message = llm.predict_messages(
+            [HumanMessage(content="2 adults and 1 child, 25-07-2024 to 26-07-2024")],
+            functions=[{"name": "get_hotel_availability", "parameters": {}}],
+        )
+        self.assertEqual(message.additional_kwargs["function_call"]["name"], "get_hotel_availability")
+        self.assertEqual(
+            json.loads(message.additional_kwargs["function_call"]["arguments"]),
+            {"num_adult": 2, "num_children": 1, "num_rooms": 1,
+             "check_in_date": "25-07-2024", "check_out_date": "26-07-2024"},
+        )
+
+    def test_fake_chat_model_streams_tokens_at_configured_rate(self):
+        llm = providers.FakeChatModel(latency=0, tokens_per_second=200, streaming=True)
+        collector = TokenCollector()
+
+        start = time.monotonic()
+        reply = llm.predict_messages([HumanMessage(content="hi")], callbacks=[collector])
+        elapsed = time.monotonic() - start
+
+        self.assertEqual("".join(collector.tokens), reply.content)
+        self.assertGreaterEqual(elapsed, len(collector.tokens) / 200)
+
+    def test_hashing_embeddings_are_deterministic(self):
+        embeddings = providers.HashingEmbeddings(size=64)
+        first = embeddings.embed_query("What time is check in?")
+        self.assertEqual(first, embeddings.embed_query("What time is check in?"))
+        self.assertAlmostEqual(sum(value * value for value in first), 1.0)
+
+
+class FakeDriver:
+    def __init__(self):
+        self.quit_called = False
+
+    def delete_all_cookies(self):
+        pass
+
+    def quit(self):
+        self.quit_called = True
+
+
+class DriverPoolTests(SimpleTestCase):
+    def test_browsers_are_reused_and_replaced_after_max_pages(self):
+        pool = browser_pool.DriverPool(FakeDriver, size=1, max_pages=2)
+        with pool.driver() as first:
+            pass
+        with pool.driver() as second:
+            pass
+        with pool.driver() as third:
+            pass
+
+        self.assertIs(first, second)
+        self.assertIsNot(second, third)
+        self.assertTrue(first.quit_called)
+        self.assertEqual(pool.created, 2)
+
+    def test_browser_is_replaced_after_an_error(self):
+        pool = browser_pool.DriverPool(FakeDriver, size=1)
+        with self.assertRaises(ValueError):
+            with pool.driver() as broken:
+                raise ValueError("page crashed")
+        with pool.driver() as driver:
+            pool.recycle(driver)
+
+        self.assertTrue(broken.quit_called)
+        self.assertTrue(driver.quit_called)
+        self.assertEqual(pool.created, pool.destroyed)
+
+    def test_checkout_times_out_when_all_browsers_are_busy(self):
+        pool = browser_pool.DriverPool(FakeDriver, size=1)
+        with pool.driver():
+            with self.assertRaises(browser_pool.BrowserPoolTimeout):
+                with pool.driver(timeout=0.05):
+                    pass
+
+    def test_scrape_during_the_warm_up_takes_the_warming_browser(self):
+        started = threading.Event()
+
+        def slow_driver():
+            started.set()
+            time.sleep(0.2)
+            return FakeDriver()
+
+        pool = browser_pool.DriverPool(slow_driver, size=1, warm=1)
+        pool.warm_up_in_background()
+        started.wait(1)
+        with pool.driver(timeout=5):
+            pass
+        self.assertEqual(pool.created, 1)
+
+    def test_warm_up_stays_within_the_pool_size(self):
+        pool = browser_pool.DriverPool(FakeDriver, size=2, warm=2)
+        pool.warm_up()
+        with pool.driver():
+            # One browser idle, one in use: another one would be the third
+            pool.warm_up()
+        self.assertEqual(pool.created, 2)
+
+    @override_settings(CHAT_BROWSER_POOL_WARM=1)
+    def test_server_warm_up_starts_the_browsers(self):
+        with mock.patch.object(openai_utils, "get_agent"), mock.patch.object(openai_utils, "get_search_doc"), \
+                mock.patch.object(openai_utils, "get_doc_answers"), mock.patch.object(openai_utils, "_ready"), \
+                mock.patch.object(browser_pool, "get_pool") as get_pool:
+            openai_utils.warm_up()
+        get_pool.assert_called_once_with()
+
+    def test_warm_up_and_close(self):
+        pool = browser_pool.DriverPool(FakeDriver, size=2, warm=2)
+        pool.warm_up()
+        self.assertEqual(pool.created, 2)
+        with pool.driver():
+            pass
+        self.assertEqual(pool.created, 2)
+
+        pool.close()
+        self.assertEqual(pool.destroyed, 2)
+
+
+class AvailabilityCacheTests(SimpleTestCase):
+    def test_equivalent_searches_share_a_key(self):
+        self.assertEqual(
+            availability.availability_key("2", 0, 1, "5-7-2024", "06-07-2024"),
+            availability.availability_key(2, "0", "1", "05/07/2024", "2024-07-06"),
+        )
+
+    def test_concurrent_identical_searches_scrape_once(self):
+        cache = availability.AvailabilityCache(maxsize=10, ttl=60)
+        key = availability.availability_key(2, 0, 1, "25-07-2024", "26-07-2024")
+        scrapes = []
+
+        def scrape():
+            scrapes.append(1)
+            time.sleep(0.2)
+            return [{"name": "King", "price": "200"}]
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get_or_fetch(key, scrape)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(scrapes), 1)
+        self.assertEqual(results, [[{"name": "King", "price": "200"}]] * 5)
+        self.assertEqual(cache.get_or_fetch(key, scrape), [{"name": "King", "price": "200"}])
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["joined"] + cache.stats()["hits"], 5)
+
+    def test_async_searches_share_one_scrape(self):
+        cache = availability.AvailabilityCache(maxsize=10, ttl=60)
+        scrapes = []
+
+        async def scrape():
+            scrapes.append(1)
+            await asyncio.sleep(0.1)
+            return []
+
+        async def run():
+            return await asyncio.gather(*(cache.aget_or_fetch("a", scrape) for _ in range(3)))
+
+        self.assertEqual(asyncio.run(run()), [[], [], []])
+        self.assertEqual(len(scrapes), 1)
+
+    def test_errors_are_not_cached_and_entries_expire(self):
+        cache = availability.AvailabilityCache(maxsize=1, ttl=0.1)
+        cache.get_or_fetch("a", lambda: "busy", cacheable=lambda rooms: rooms != "busy")
+        self.assertIsNone(cache.get("a"))
+
+        cache.get_or_fetch("a", lambda: [])
+        self.assertEqual(cache.get("a"), [])
+        cache.get_or_fetch("b", lambda: [])
+        self.assertIsNone(cache.get("a"))
+        time.sleep(0.15)
+        self.assertIsNone(cache.get("b"))
+
+
+class RoomPageParsingTests(SimpleTestCase):
+    def test_rooms_are_parsed_from_saved_page(self):
+        html = (Path(__file__).parent / "test_data" / "room_rates.html").read_text()
+
+        start = time.perf_counter()
+        rooms = webscraping.parse_rooms_html(html)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(rooms, [
+            {"name": "Deluxe Room, 1 King Bed", "price": "280 SGD"},
+            {"name": "Premium Room, 2 Single Beds", "price": "310 SGD"},
+            {"name": "Club Suite, 1 King Bed", "price": ""},
+        ])
+        # The http path has to stay far cheaper than starting a browser
+        self.assertLess(elapsed, 0.05)
+
+    def test_page_without_room_cards_gives_no_rooms(self):
+        self.assertEqual(webscraping.parse_rooms_html("<html><body><div id='app'></div></body></html>"), [])
+
+
+# Stands in for the DynamoDB client, can throttle or be unreachable
+class StubDynamoDB:
+    def __init__(self, unprocessed_rounds=0, down=False, rejected=()):
+        self.unprocessed_rounds = unprocessed_rounds
+        self.down = down
+        # Keys of the items never taken
+        self.rejected = set(rejected)
+        self.calls = []
+        self.items = []
+
+    def batch_write_item(self, RequestItems):
+        if self.down:
+            raise ConnectionError("endpoint unreachable")
+        puts = RequestItems["Feedback"]
+        self.calls.append(len(puts))
+        rejected = [put for put in puts if put["PutRequest"]["Item"]["date"] in self.rejected]
+        if rejected:
+            self.items.extend(put["PutRequest"]["Item"] for put in puts if put not in rejected)
+            return {"UnprocessedItems": {"Feedback": rejected}}
+        if self.unprocessed_rounds:
+            self.unprocessed_rounds -= 1
+            self.items.extend(put["PutRequest"]["Item"] for put in puts[:1])
+            return {"UnprocessedItems": {"Feedback": puts[1:]}}
+        self.items.extend(put["PutRequest"]["Item"] for put in puts)
+        return {"UnprocessedItems": {}}
+
+
+class FeedbackSinkTests(SimpleTestCase):
+    def make_sink(self, client, **kwargs):
+        spill_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(spill_dir.cleanup)
+        kwargs.setdefault("spill_path", str(Path(spill_dir.name) / "spill.jsonl"))
+        return feedback.FeedbackSink(lambda: client, "Feedback", max_retries=2, **kwargs)
+
+    def test_items_are_written_in_batches_of_at_most_25(self):
+        client = StubDynamoDB()
+        sink = self.make_sink(client)
+        for number in range(30):
+            self.assertTrue(sink.submit({"date": str(number), "feedback": "great"}))
+        sink.flush()
+
+        self.assertEqual(client.calls, [25, 5])
+        self.assertEqual(sink.written, 30)
+
+    def test_same_key_goes_to_separate_batches(self):
+        client = StubDynamoDB()
+        sink = self.make_sink(client)
+        sink.submit({"date": "12:00:00 2024-07-25", "feedback": "first"})
+        sink.submit({"date": "12:00:00 2024-07-25", "feedback": "second"})
+        sink.flush()
+
+        self.assertEqual(client.calls, [1, 1])
+        self.assertEqual([item["feedback"] for item in client.items], ["first", "second"])
+
+    def test_unprocessed_items_are_retried(self):
+        client = StubDynamoDB(unprocessed_rounds=1)
+        sink = self.make_sink(client)
+        for number in range(3):
+            sink.submit({"date": str(number), "feedback": "ok"})
+        sink.flush()
+
+        self.assertEqual(client.calls, [3, 2])
+        self.assertEqual(len(client.items), 3)
+
+    def test_spilled_items_are_replayed_when_dynamodb_is_back(self):
+        client = StubDynamoDB(down=True)
+        sink = self.make_sink(client)
+        sink.submit({"date": "1", "feedback": "slow wifi"})
+        sink.flush()
+        self.assertEqual(sink.spilled, 1)
+        self.assertEqual(client.items, [])
+
+        client.down = False
+        sink.submit({"date": "2", "feedback": "nice pool"})
+        sink.flush()
+        sink.flush()
+
+        self.assertEqual(sorted(item["feedback"] for item in client.items), ["nice pool", "slow wifi"])
+        self.assertFalse(Path(sink.spill_path).exists())
+
+    def test_spill_is_left_alone_while_dynamodb_is_down(self):
+        client = StubDynamoDB(down=True)
+        sink = self.make_sink(client)
+        sink.submit({"date": "1", "feedback": "slow wifi"})
+        for _ in range(3):
+            sink.flush()
+
+        self.assertEqual(sink.spilled, 1)
+        self.assertEqual(len(Path(sink.spill_path).read_text().splitlines()), 1)
+
+    def test_replay_file_left_by_a_crash_is_replayed(self):
+        client = StubDynamoDB()
+        sink = self.make_sink(client)
+        Path(sink.spill_path + ".replay").write_text(
+            json.dumps({"item": {"date": "1", "feedback": "slow wifi"}, "attempts": 1}) + "\n"
+        )
+        sink.submit({"date": "2", "feedback": "nice pool"})
+        sink.flush()
+        sink.flush()
+
+        self.assertEqual(sorted(item["feedback"] for item in client.items), ["nice pool", "slow wifi"])
+        self.assertFalse(Path(sink.spill_path + ".replay").exists())
+
+    def test_item_rejected_every_time_goes_to_the_dead_letter_file(self):
+        client = StubDynamoDB(rejected={"1"})
+        sink = self.make_sink(client, max_attempts=2)
+        sink.submit({"date": "1", "feedback": "bad"})
+        sink.flush()
+        for number in range(2, 5):
+            # Each good write replays the spill
+            sink.submit({"date": str(number), "feedback": "good"})
+            sink.flush()
+            sink.flush()
+
+        self.assertEqual(sink.dead_lettered, 1)
+        self.assertFalse(Path(sink.spill_path).exists())
+        dead = [json.loads(line) for line in Path(sink.spill_path + ".dead").read_text().splitlines()]
+        self.assertEqual(dead, [{"date": "1", "feedback": "bad"}])
+        self.assertEqual(sorted(item["date"] for item in client.items), ["2", "3", "4"])
+
+    def test_background_thread_flushes_on_interval(self):
+        client = StubDynamoDB()
+        sink = self.make_sink(client, flush_interval=0.1)
+        sink.start()
+        self.addCleanup(sink.close)
+        sink.submit({"date": "1", "feedback": "quick"})
+        time.sleep(0.5)
+
+        self.assertEqual(client.items, [{"date": "1", "feedback": "quick"}])
+
+
+class SemanticAnswerCacheTests(SimpleTestCase):
+    def make_cache(self, **kwargs):
+        self.answers = []
+
+        def answer(question):
+            self.answers.append(question)
+            return f"answer {len(self.answers)}"
+
+        self.answer = answer
+        return answer_cache.SemanticAnswerCache(providers.HashingEmbeddings(), threshold=0.8, **kwargs)
+
+    def test_similar_question_reuses_the_answer(self):
+        cache = self.make_cache()
+        first = cache.get_or_answer("What time is check in at the hotel?", self.answer)
+        again = cache.get_or_answer("what time is check in at the hotel", self.answer)
+        similar = cache.get_or_answer("What time is check in at the hotel please?", self.answer)
+        other = cache.get_or_answer("Is there a shuttle bus to the airport?", self.answer)
+
+        self.assertEqual([first, again, similar, other], ["answer 1", "answer 1", "answer 1", "answer 2"])
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["exact_hits"], 1)
+
+    def test_expired_answers_are_not_reused(self):
+        cache = self.make_cache(ttl=0.05)
+        cache.get_or_answer("Do you have day use rooms?", self.answer)
+        time.sleep(0.1)
+        cache.get_or_answer("Do you have day use rooms?", self.answer)
+
+        self.assertEqual(len(self.answers), 2)
+
+    def test_index_change_drops_answers(self):
+        fingerprint = ["v1"]
+        cache = self.make_cache(fingerprint=lambda: fingerprint[0], fingerprint_interval=0)
+        cache.get_or_answer("Do you have day use rooms?", self.answer)
+        fingerprint[0] = "v2"
+        cache.get_or_answer("Do you have day use rooms?", self.answer)
+
+        self.assertEqual(len(self.answers), 2)
+        self.assertEqual(cache.stats()["invalidations"], 1)
+
+    def test_async_lookup_shares_entries(self):
+        cache = self.make_cache()
+        cache.get_or_answer("Where is the gym?", self.answer)
+
+        async def answer(question):
+            return self.answer(question)
+
+        self.assertEqual(asyncio.run(cache.aget_or_answer("where is the gym", answer)), "answer 1")
+
+
+class RouterTests(SimpleTestCase):
+    def test_small_talk_gets_a_canned_reply(self):
+        self.assertEqual(router.route("Hi!").name, router.GREETING)
+        self.assertEqual(router.route("thank you so much").name, router.THANKS)
+        self.assertEqual(router.route("thanks, my feedback is that the pool was cold").name, router.AGENT)
+
+    def test_complete_booking_request_goes_to_availability(self):
+        route = router.route("2 adults and 1 child from 25-07-2024 to 26-07-2024")
+        self.assertEqual(route.name, router.AVAILABILITY)
+        self.assertEqual(route.booking["num_children"], 1)
+        self.assertEqual(router.route("I want a room on 25-07-2024").name, router.AGENT)
+
+    def test_guests_include_the_children(self):
+        booking = router.route("4 guests, 2 children from 25-07-2024 to 26-07-2024").booking
+        self.assertEqual((booking["num_adult"], booking["num_children"]), (2, 2))
+        booking = router.route("2 adults, 1 child, 3 guests from 25-07-2024 to 26-07-2024").booking
+        self.assertEqual((booking["num_adult"], booking["num_children"]), (2, 1))
+        self.assertEqual(router.route("2 guests, 2 kids from 25-07-2024 to 26-07-2024").name, router.AGENT)
+
+    def test_only_clearly_off_topic_messages_are_refused(self):
+        self.assertEqual(router.route("write me a poem about the sea please").name, router.OFF_TOPIC)
+        self.assertEqual(router.route("what is the capital of france").name, router.OFF_TOPIC)
+        self.assertEqual(router.route("is there a shuttle to the airport").name, router.AGENT)
+        self.assertEqual(router.route("and for two?").name, router.AGENT)
+
+    def test_rooms_are_listed(self):
+        booking = {"num_adult": 2, "num_children": 0, "num_rooms": 1,
+                   "check_in_date": "25-07-2024", "check_out_date": "26-07-2024"}
+        reply = router.format_rooms([{"name": "Deluxe King Room", "price": "250 SGD"}], booking)
+        self.assertIn("- Deluxe King Room: 250 SGD", reply)
+        self.assertEqual(router.format_rooms("Sorry, busy", booking), "Sorry, busy")
+
+    def test_stats_report_savings_against_the_agent(self):
+        router.reset_stats()
+        self.addCleanup(router.reset_stats)
+        router.record(router.AGENT, 2.0)
+        router.record(router.GREETING, 0.0)
+        router.record(router.GREETING, 0.0)
+
+        stats = router.stats()
+        self.assertEqual(stats[router.GREETING]["count"], 2)
+        self.assertEqual(stats[router.GREETING]["saved_s"], 4.0)
+
+    def test_route_counts_are_served(self):
+        router.reset_stats()
+        self.addCleanup(router.reset_stats)
+        router.record(router.AGENT, 2.0)
+        router.record(router.GREETING, 0.0)
+
+        content = self.client.get("/chat/metrics/").content
+        self.assertIn(b'chat_route_messages{route="greeting"} 1', content)
+        self.assertIn(b'chat_route_saved_seconds{route="greeting"} 2.0', content)
+        self.assertIn(b"chat_route_hit_rate 0.5", content)
+
+
+# Runs `code` in a fresh interpreter with the offline providers, returns its stdout
+def run_fresh(code):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE="chatsite.settings", SECRET_KEY="test",
+               CHAT_LLM_PROVIDER="fake", CHAT_EMBEDDINGS_PROVIDER="hashing", CHAT_BROWSER_POOL_WARM="0", PYTHONPATH=str(settings.BASE_DIR))
+    result = subprocess.run([sys.executable, "-c", code], cwd=settings.BASE_DIR, env=env,
+                            capture_output=True, text=True, timeout=120)
+    if result.returncode:
+        raise AssertionError(result.stderr)
+    return result.stdout.strip().splitlines()[-1]
+
+
+class StartupTests(SimpleTestCase):
+    import_budget_s = 5
+    warm_up_budget_s = 30
+
+    def test_importing_the_consumer_is_cheap(self):
+        output = run_fresh(
+            "import sys, time; start = time.perf_counter(); import django; django.setup(); "
+            "import chat.consumers, chat.views; "
+            "heavy = [m for m in ('langchain', 'selenium', 'boto3', 'chromadb', 'openai') if m in sys.modules]; "
+            "print(time.perf_counter() - start, ','.join(heavy))"
+        )
+        elapsed, _, heavy = output.partition(" ")
+        self.assertEqual(heavy, "")
+        self.assertLess(float(elapsed), self.import_budget_s)
+
+    def test_warm_up_builds_everything_within_budget(self):
+        output = run_fresh(
+            "import django; django.setup(); from chat import openai_utils; "
+            "ready = openai_utils.is_ready(); elapsed = openai_utils.warm_up(); "
+            "built = ','.join(sorted(openai_utils._resources)); "
+            "print(ready, openai_utils.is_ready(), built, elapsed)"
+        )
+        before, after, built, elapsed = output.split()
+        self.assertEqual((before, after), ("False", "True"))
+        for name in ("agent", "docsearch", "search_doc", "doc_answers"):
+            self.assertIn(name, built.split(","))
+        self.assertLess(float(elapsed), self.warm_up_budget_s)
+
+    def test_ready_view_waits_for_the_warm_up(self):
+        self.addCleanup(openai_utils._ready.clear)
+        self.assertEqual(self.client.get("/chat/ready/").status_code, 503)
+        openai_utils._ready.set()
+        self.assertEqual(self.client.get("/chat/ready/").status_code, 200)
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        metrics.stage_seconds.clear()
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "Test.", buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe("llm", value)
+
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{stage="llm",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="llm",le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="llm",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{stage="llm"} 3', lines)
+
+    def test_trace_collects_spans_from_worker_threads(self):
+        def work():
+            with metrics.span("history"):
+                time.sleep(0.01)
+
+        async def answer():
+            with metrics.trace("lobby", "m1"):
+                await agent_runner.run_for_room("lobby", work)
+
+        with self.assertLogs("chat.trace", "INFO") as logs:
+            asyncio.run(answer())
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual((line["room"], line["message_id"]), ("lobby", "m1"))
+        self.assertEqual([span["stage"] for span in line["spans"]], ["queue_wait", "history"])
+        self.assertEqual(metrics.stage_seconds.totals()["history"][0], 1)
+
+    def test_callback_handler_times_llm_and_tools(self):
+        handler = callbacks.MetricsCallbackHandler()
+        llm_run, tool_run = uuid.uuid4(), uuid.uuid4()
+        handler.on_chat_model_start({}, [], run_id=llm_run)
+        handler.on_tool_start({"name": "get_feedback"}, "great", run_id=tool_run)
+        handler.on_tool_end("thanks", run_id=tool_run)
+        handler.on_llm_end(None, run_id=llm_run)
+
+        self.assertEqual(set(metrics.stage_seconds.totals()), {"llm", "tool:get_feedback"})
+
+    def test_metrics_view_serves_prometheus_text(self):
+        metrics.observe("llm", 0.2)
+        response = self.client.get("/chat/metrics/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'chat_stage_seconds_count{stage="llm"} 1', response.content)
+        self.assertIn(b"chat_agent_queue_depth 0", response.content)
+
+    @override_settings(CHAT_AVAILABILITY_CACHE_REDIS=False)
+    def test_availability_cache_counts_are_served(self):
+        with mock.patch.object(availability, "_cache", None):
+            cache = availability.get_cache()
+            key = availability.availability_key(2, 0, 1, "25-07-2024", "26-07-2024")
+            for _ in range(2):
+                cache.get_or_fetch(key, lambda: [{"name": "King", "price": "200"}])
+            response = self.client.get("/chat/metrics/")
+
+        self.assertIn(b"chat_availability_cache_hits 1", response.content)
+        self.assertIn(b"chat_availability_cache_misses 1", response.content)
+        self.assertIn(b"chat_availability_cache_joined 0", response.content)
+        self.assertIn(b"chat_availability_cache_hit_rate 0.5", response.content)
+
+    def test_answer_cache_counts_are_served(self):
+        with mock.patch.dict(openai_utils._resources, {"embeddings": FakeEmbeddings(size=8)}, clear=True):
+            cache = openai_utils.get_doc_answers()
+            cache.get_or_answer("What time is check in?", lambda question: "2pm")
+            cache.get_or_answer("what time is check in", lambda question: "3pm")
+            response = self.client.get("/chat/metrics/")
+
+        self.assertIn(b"chat_answer_cache_hits 1", response.content)
+        self.assertIn(b"chat_answer_cache_hit_rate 0.5", response.content)
+        self.assertIn(b"chat_answer_cache_invalidations 0", response.content)
+
+
+class TokenUsageTests(SimpleTestCase):
+    def test_usage_is_aggregated_per_room_and_source(self):
+        tracker = usage.TokenUsageTracker()
+        tracker.record("lobby", "agent", "gpt", 100, 20, 1.0)
+        tracker.record("lobby", "doc_search", "gpt", 50, 10, 0.5)
+        tracker.record("spa", "agent", "gpt", 10, 5, 0.2)
+
+        snapshot = tracker.snapshot()
+        self.assertEqual(snapshot["rooms"]["lobby"]["doc_search"]["prompt_tokens"], 50)
+        self.assertEqual(snapshot["total"]["calls"], 3)
+        self.assertEqual(tracker.window_tokens("lobby"), 180)
+
+    def test_rooms_are_downgraded_as_they_use_their_budget(self):
+        tracker = usage.TokenUsageTracker(window=0.1, room_budget=100)
+        tracker.record("lobby", "agent", "gpt", 70, 10, 1.0)
+        self.assertEqual(tracker.downgrade("lobby"), usage.TRIM_HISTORY)
+        self.assertEqual(tracker.downgrade("spa"), usage.FULL)
+        tracker.record("lobby", "agent", "gpt", 20, 0, 1.0)
+        self.assertEqual(tracker.downgrade("lobby"), usage.NO_DOC_SEARCH)
+
+        # Old calls leave the window
+        time.sleep(0.15)
+        self.assertEqual(tracker.downgrade("lobby"), usage.FULL)
+
+    def test_quiet_rooms_are_forgotten(self):
+        tracker = usage.TokenUsageTracker(window=0.05, max_rooms=2)
+        for room in ("lobby", "spa", "gym"):
+            tracker.record(room, "agent", "gpt", 10, 0, 0.1)
+        self.assertEqual(list(tracker.snapshot()["rooms"]), ["spa", "gym"])
+
+        time.sleep(0.1)
+        tracker.record("pool", "agent", "gpt", 10, 0, 0.1)
+        self.assertEqual(list(tracker._recent), ["pool"])
+
+    def test_global_budget_downgrades_every_room(self):
+        tracker = usage.TokenUsageTracker(global_budget=100)
+        tracker.record("lobby", "agent", "gpt", 100, 0, 1.0)
+        self.assertEqual(tracker.downgrade("spa"), usage.NO_DOC_SEARCH)
+
+    def test_streamed_calls_are_counted_with_the_llm(self):
+        tracker = usage.TokenUsageTracker()
+        llm = providers.FakeChatModel(latency=0, tokens_per_second=1000)
+        handler = callbacks.UsageCallbackHandler(tracker, llm, "lobby")
+        run_id = uuid.uuid4()
+        handler.on_chat_model_start({}, [[HumanMessage(content="What time is check in?")]], run_id=run_id)
+        handler.on_llm_end(LLMResult(generations=[[ChatGeneration(message=AIMessage(content="At 3 pm."))]]), run_id=run_id)
+
+        totals = tracker.snapshot()["rooms"]["lobby"]["agent"]
+        self.assertEqual((totals["prompt_tokens"], totals["completion_tokens"]), (9, 4))
+
+    def test_history_is_counted_once_by_build_history(self):
+        tracker = usage.TokenUsageTracker()
+        llm = providers.FakeChatModel(latency=0)
+        history = [HumanMessage(content="Is breakfast included?"), AIMessage(content="Yes it is.")]
+        handler = callbacks.UsageCallbackHandler(
+            tracker, llm, "lobby", history=history + [HumanMessage(content="At what time?")], history_tokens=100,
+        )
+        run_id = uuid.uuid4()
+        prompt = [SystemMessage(content="Be brief.")] + history + [HumanMessage(content="At what time?")]
+        handler.on_chat_model_start({}, [prompt], run_id=run_id)
+        handler.on_llm_end(LLMResult(generations=[[ChatGeneration(message=AIMessage(content="7am"))]]), run_id=run_id)
+
+        totals = tracker.snapshot()["rooms"]["lobby"]["agent"]
+        # The system message on top of what build_history counted
+        self.assertEqual(totals["prompt_tokens"], 100 + llm.get_num_tokens_from_messages(prompt[:1]))
+
+    def test_trimmed_history_keeps_the_newest_turns(self):
+        hist = [
+            {"role": "user", "content": "one two three"},
+            {"role": "assistant", "content": "four five"},
+            {"role": "user", "content": "six"},
+        ]
+        chat_history, _ = memory.trim_chat_history(WordCountLLM(responses=[]), hist, "seven", 3)
+        self.assertEqual([message.content for message in chat_history], ["four five", "six"])
+
+
+class TokenUsageStorageTests(TestCase):
+    def test_usage_is_written_and_reported_per_room(self):
+        tracker = usage.TokenUsageTracker(persist=True, flush_interval=3600)
+        tracker.record("lobby", "agent", "gpt", 100, 20, 1.0)
+        tracker.record("lobby", "agent", "gpt", 50, 10, 0.5)
+
+        self.assertEqual(tracker.flush(), 2)
+        self.assertEqual(TokenUsage.objects.filter(room="lobby").count(), 2)
+
+        out = StringIO()
+        call_command("token_usage", stdout=out)
+        self.assertIn("Total: 150 prompt + 30 completion tokens", out.getvalue())
+
+    def test_calls_outside_a_room_are_written(self):
+        tracker = usage.TokenUsageTracker(persist=True, flush_interval=3600)
+        tracker.record(None, "agent", "gpt", 10, 2, 0.1)
+        tracker.record("lobby", "agent", "gpt", 10, 2, 0.1)
+
+        self.assertEqual(tracker.flush(), 2)
+        self.assertEqual(TokenUsage.objects.filter(room="").count(), 1)
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_bucket_allows_a_burst_then_refills(self):
+        bucket = ratelimit.TokenBucket(rate=20, burst=2)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        wait = bucket.take()
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.05)
+
+        time.sleep(0.06)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(ratelimit.retry_after(wait), 1)
+
+    def test_number_of_buckets_is_bounded(self):
+        buckets = ratelimit.BucketMap(rate=0.01, burst=2, maxsize=2)
+        buckets.take("lobby")
+        buckets.take("spa")
+        buckets.take("pool")
+        self.assertEqual(len(buckets), 2)
+        # No bucket was full, the least recently used one was dropped
+        self.assertEqual(buckets.take("spa"), 0)
+        self.assertGreater(buckets.take("spa"), 0)
+        self.assertEqual(buckets.take("lobby"), 0)
+
+    @override_settings(
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        CHAT_PRESENCE_BACKEND="memory",
+        CHAT_LLM_PROVIDER="fake",
+        CHAT_RATE_CONNECTION_BURST=1,
+        CHAT_RATE_ROOM_BURST=1,
+        CHAT_RATE_CONNECTION_PER_MINUTE=0,
+        CHAT_RATE_ROOM_PER_MINUTE=0,
+    )
+    def test_rejected_message_keeps_the_connections_token(self):
+        ratelimit._room_buckets = None
+        self.addCleanup(setattr, ratelimit, "_room_buckets", None)
+
+        async def run():
+            # Another guest used up the room
+            ratelimit.room_buckets().take("chat_lobby")
+            client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+            await client.connect()
+            await client.send_json_to({"command": "send_all_messages", "session_id": "s1", "message_new": "hi", "messages": []})
+            busy = await client.receive_json_from(timeout=10)
+
+            # The room has capacity again, the connection still has its one message
+            ratelimit._room_buckets = None
+            await client.send_json_to({"command": "send_all_messages", "session_id": "s1", "message_new": "hi", "messages": []})
+            echo = await client.receive_json_from(timeout=10)
+            await client.disconnect()
+            return busy, echo
+
+        busy, echo = asyncio.run(run())
+        self.assertTrue(busy["busy"])
+        self.assertEqual(echo.get("message"), "hi")
+
+    @override_settings(CHAT_MAX_CONCURRENT_RUNS=0, CHAT_MAX_QUEUED_RUNS=0)
+    def test_zero_concurrent_runs_still_admits_one(self):
+        self.assertEqual(agent_runner.max_runs(), 1)
+        self.assertEqual(agent_runner.admit(), 0)
+
+    @override_settings(CHAT_AGENT_MODE="queue", CHAT_MAX_QUEUED_RUNS=2)
+    def test_queue_mode_admits_by_the_shared_queue(self):
+        queue = job_queue.JobQueue(StubRedisList(), shards=2)
+        with mock.patch.object(job_queue, "_queue", queue):
+            self.assertEqual(agent_runner.admit(), 0)
+            queue.enqueue({"group": "chat_lobby", "message": "hi"})
+            queue.enqueue({"group": "chat_spa", "message": "hi"})
+            self.assertGreater(agent_runner.admit(), 0)
+
+    @override_settings(CHAT_MAX_CONCURRENT_RUNS=1, CHAT_MAX_QUEUED_RUNS=1)
+    def test_runs_are_capped_and_the_queue_is_bounded(self):
+        running = []
+        peak = []
+
+        def job():
+            running.append(1)
+            peak.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+
+        async def run():
+            tasks = [asyncio.ensure_future(agent_runner.run_for_room(f"room_{i}", job)) for i in range(2)]
+            await asyncio.sleep(0.01)
+            wait = agent_runner.admit()
+            await asyncio.gather(*tasks)
+            return wait
+
+        self.assertEqual(agent_runner.admit(), 0)
+        self.assertGreater(asyncio.run(run()), 0)
+        self.assertEqual(max(peak), 1)
+        self.assertEqual(agent_runner.admit(), 0)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_PRESENCE_BACKEND="memory",
+    CHAT_LLM_PROVIDER="fake",
+)
+class DirectSendTests(SimpleTestCase):
+    def setUp(self):
+        presence._presence = None
+
+    def test_presence_counts_members_per_room(self):
+        members = presence.InMemoryPresence()
+        self.assertEqual(members.join("chat_lobby", "a"), 1)
+        self.assertEqual(members.join("chat_lobby", "b"), 2)
+        self.assertEqual(members.join("chat_spa", "c"), 1)
+        self.assertEqual(members.leave("chat_lobby", "a"), 1)
+        self.assertEqual(members.leave("chat_lobby", "b"), 0)
+        self.assertEqual(members.count("chat_lobby"), 0)
+
+    async def connect(self):
+        client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        return client
+
+    async def send_hi(self, client, session_id):
+        await client.send_json_to({"command": "send_all_messages", "session_id": session_id, "message_new": "hi", "messages": []})
+
+    async def receive_until_reply(self, client):
+        frames = []
+        while not frames or "assistant_message" not in frames[-1]:
+            frames.append(await client.receive_json_from(timeout=10))
+        return frames
+
+    def test_only_shared_rooms_go_through_the_channel_layer(self):
+        async def run():
+            layer = get_channel_layer()
+            group_sends = []
+            group_send = layer.group_send
+
+            async def counted_group_send(group, message):
+                group_sends.append(message["type"])
+                await group_send(group, message)
+
+            layer.group_send = counted_group_send
+
+            alone = await self.connect()
+            await self.send_hi(alone, "s1")
+            frames = await self.receive_until_reply(alone)
+            sent_alone = list(group_sends)
+
+            other = await self.connect()
+            await self.send_hi(alone, "s1")
+            await self.receive_until_reply(alone)
+            other_frames = await self.receive_until_reply(other)
+
+            await alone.disconnect()
+            await other.disconnect()
+            return frames, sent_alone, group_sends, other_frames
+
+        frames, sent_alone, group_sends, other_frames = asyncio.run(run())
+        self.assertIn("hi", [frame.get("message") for frame in frames])
+        self.assertEqual(frames[-1]["assistant_message"], router.greeting_reply)
+        self.assertEqual(sent_alone, [])
+        # The second guest sees the other guest's message and its reply
+        self.assertIn("chat_message", group_sends)
+        self.assertIn("bot_message", group_sends)
+        self.assertIn("hi", [frame.get("message") for frame in other_frames])
+
+    def test_guest_left_alone_goes_back_to_direct_send(self):
+        async def run():
+            layer = get_channel_layer()
+            group_sends = []
+            group_send = layer.group_send
+
+            async def counted_group_send(group, message):
+                group_sends.append(message["type"])
+                await group_send(group, message)
+
+            layer.group_send = counted_group_send
+
+            first = await self.connect()
+            second = await self.connect()
+            await second.disconnect()
+            # The room_members_changed event reaches the first guest
+            await asyncio.sleep(0.1)
+
+            del group_sends[:]
+            await self.send_hi(first, "s1")
+            await self.receive_until_reply(first)
+            await first.disconnect()
+            return group_sends
+
+        self.assertEqual(asyncio.run(run()), [])
+
+
+# Runs RedisReplayBuffer.append_script
+class StubReplayRedis:
+    def __init__(self):
+        self.rooms = {}
+        self.lists = {}
+
+    def eval(self, script, numkeys, seq_key, events_key, epoch, raw, size, ttl):
+        assert script == replay.RedisReplayBuffer.append_script
+        room = self.rooms.setdefault(seq_key, {"epoch": epoch.encode(), "seq": 0})
+        room["seq"] += 1
+        events = self.lists.setdefault(events_key, [])
+        events.append(f'[{room["seq"]},"{room["epoch"].decode()}",{raw}]'.encode())
+        del events[:-size]
+        return [room["seq"], room["epoch"]]
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_PRESENCE_BACKEND="memory",
+    CHAT_REPLAY_BACKEND="memory",
+    CHAT_LLM_PROVIDER="fake",
+)
+class ReplayTests(SimpleTestCase):
+    def setUp(self):
+        presence._presence = None
+        replay._buffer = None
+
+    def test_buffer_keeps_the_newest_events(self):
+        buffer = replay.InMemoryReplayBuffer(size=2)
+        events = [buffer.append("chat_lobby", {"type": "chat_message", "message": str(n)}) for n in range(3)]
+        epoch = events[0]["epoch"]
+
+        self.assertEqual([event["seq"] for event in events], [1, 2, 3])
+        self.assertEqual([event["message"] for event in buffer.since("chat_lobby", epoch, 1)], ["1", "2"])
+        self.assertEqual(buffer.since("chat_lobby", epoch, 3), [])
+        self.assertEqual(buffer.since("chat_spa", epoch, 0), [])
+
+    def test_redis_buffer_replays_in_number_order(self):
+        client = StubReplayRedis()
+        buffer = replay.RedisReplayBuffer(client, size=2)
+        events = [buffer.append("chat_lobby", {"type": "chat_message", "message": str(n)}) for n in range(3)]
+        epoch = events[0]["epoch"]
+
+        self.assertEqual([event["seq"] for event in events], [1, 2, 3])
+        self.assertEqual({event["epoch"] for event in events}, {epoch})
+        self.assertEqual([event["message"] for event in buffer.since("chat_lobby", epoch, 1)], ["1", "2"])
+        # Read back in number order whatever the list order
+        client.lists[buffer._keys("chat_lobby")[1]].reverse()
+        self.assertEqual([event["seq"] for event in buffer.since("chat_lobby", epoch, 0)], [2, 3])
+
+    def test_other_epochs_get_nothing(self):
+        buffer = replay.InMemoryReplayBuffer(size=5, max_rooms=1)
+        lobby = buffer.append("chat_lobby", {"type": "chat_message", "message": "hi"})
+        buffer.append("chat_spa", {"type": "chat_message", "message": "massage?"})
+
+        # Numbers of another room
+        self.assertEqual(buffer.since("chat_spa", lobby["epoch"], 0), [])
+        # The lobby was evicted, its next event starts a new epoch
+        again = buffer.append("chat_lobby", {"type": "chat_message", "message": "other guest"})
+        self.assertNotEqual(again["epoch"], lobby["epoch"])
+        self.assertEqual(buffer.since("chat_lobby", lobby["epoch"], 0), [])
+
+    def test_reconnected_client_gets_the_reply_it_missed(self):
+        async def run():
+            client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+            await client.connect()
+            await client.send_json_to({"command": "send_all_messages", "session_id": "s1", "message_new": "hi", "messages": []})
+            echo = await client.receive_json_from(timeout=10)
+            # Gone before the reply
+            await client.disconnect()
+            await asyncio.sleep(0.2)
+
+            client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+            await client.connect()
+            await client.send_json_to({"command": "resume", "epoch": echo["epoch"], "last_seq": echo["seq"]})
+            replayed = await client.receive_json_from(timeout=10)
+            nothing_else = await client.receive_nothing(timeout=0.2)
+            await client.disconnect()
+
+            # Another room does not replay the lobby's buffer
+            client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/spa/")
+            await client.connect()
+            await client.send_json_to({"command": "resume", "epoch": echo["epoch"], "last_seq": 0})
+            nothing_else = nothing_else and await client.receive_nothing(timeout=0.2)
+            await client.disconnect()
+            return echo, replayed, nothing_else
+
+        echo, replayed, nothing_else = asyncio.run(run())
+        self.assertEqual((echo["message"], echo["seq"]), ("hi", 1))
+        self.assertEqual(replayed["assistant_message"], router.greeting_reply)
+        self.assertEqual((replayed["seq"], replayed["epoch"]), (2, echo["epoch"]))
+        self.assertTrue(nothing_else)
+
+
+# Streams a few tokens of its reply, then fails
+class FailingChatModel(providers.FakeChatModel):
+    def _generate(self, messages, stop=None, run_manager=None, stream=None, **kwargs):
+        for token in ["Thank ", "you ", "for "]:
+            run_manager.on_llm_new_token(token)
+        raise ConnectionError("stream dropped")
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_PRESENCE_BACKEND="memory",
+    CHAT_LLM_PROVIDER="fake",
+    CHAT_STREAMING=True,
+    CHAT_ROUTER_ENABLED=False,
+    CHAT_AGENT_ASYNC=False,
+    CHAT_TOKEN_USAGE_PERSIST=False,
+)
+class StreamingTests(SimpleTestCase):
+    def setUp(self):
+        presence._presence = None
+
+    def receive_reply(self, llm):
+        async def run():
+            client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+            await client.connect()
+            await client.send_json_to({
+                "command": "send_all_messages", "session_id": uuid.uuid4().hex, "message_new": "hello there", "messages": [],
+            })
+            frames = []
+            while not frames or "assistant_message" not in frames[-1]:
+                frames.append(await client.receive_json_from(timeout=10))
+            await client.disconnect()
+            return frames
+
+        # A fresh agent around this model
+        with mock.patch.dict(openai_utils._resources, {"llm": llm}, clear=True):
+            frames = asyncio.run(run())
+        return [frame for frame in frames if "assistant_message_delta" in frame], frames[-1]
+
+    def test_deltas_arrive_in_order_and_add_up_to_the_reply(self):
+        llm = providers.FakeChatModel(latency=0, tokens_per_second=200, streaming=True)
+        deltas, reply = self.receive_reply(llm)
+
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual("".join(frame["assistant_message_delta"] for frame in deltas), reply["assistant_message"])
+        self.assertEqual(reply["assistant_message"], llm.reply)
+        self.assertEqual({frame["stream_id"] for frame in deltas}, {reply["stream_id"]})
+
+    def test_failure_mid_stream_ends_the_bubble(self):
+        deltas, reply = self.receive_reply(FailingChatModel(latency=0, streaming=True))
+
+        self.assertTrue("".join(frame["assistant_message_delta"] for frame in deltas).startswith("Thank"))
+        # The error replaces the partial message in the same bubble
+        self.assertEqual(reply["assistant_message"], consumers.error_message)
+        self.assertEqual({frame["stream_id"] for frame in deltas}, {reply["stream_id"]})
+
+    def test_unreachable_session_store_ends_the_bubble(self):
+        llm = providers.FakeChatModel(latency=0, tokens_per_second=200, streaming=True)
+        with mock.patch.object(sessions.InMemorySessionStore, "append", side_effect=ConnectionError("store down")), \
+                self.assertLogs("chat.consumers", "ERROR"):
+            deltas, reply = self.receive_reply(llm)
+
+        self.assertEqual(deltas, [])
+        self.assertEqual(reply["assistant_message"], consumers.error_message)
+
+    def test_unreachable_replay_buffer_still_ends_the_bubble(self):
+        llm = providers.FakeChatModel(latency=0, tokens_per_second=200, streaming=True)
+        record = replay.record
+
+        async def failing_record(group, event):
+            if event["type"] == "bot_message":
+                raise ConnectionError("replay buffer down")
+            return await record(group, event)
+
+        with mock.patch.object(replay, "record", failing_record), self.assertLogs("chat.consumers", "ERROR"):
+            deltas, reply = self.receive_reply(llm)
+
+        self.assertEqual("".join(frame["assistant_message_delta"] for frame in deltas), llm.reply)
+        self.assertEqual(reply["assistant_message"], consumers.error_message)
+        self.assertEqual({frame["stream_id"] for frame in deltas}, {reply["stream_id"]})
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_PRESENCE_BACKEND="memory",
+    CHAT_SESSION_BACKEND="memory",
+    CHAT_LLM_PROVIDER="fake",
+    CHAT_ROUTER_ENABLED=False,
+    CHAT_AGENT_ASYNC=True,
+    CHAT_AVAILABILITY_PREFETCH=False,
+    CHAT_TOKEN_USAGE_PERSIST=False,
+)
+class AsyncAgentTests(SimpleTestCase):
+    rooms = [{"name": "King", "price": "200"}]
+
+    def setUp(self):
+        presence._presence = None
+        sessions._store = None
+        self.cache = availability.AvailabilityCache(maxsize=10, ttl=60)
+        self.tracker = usage.TokenUsageTracker()
+        for patcher in (
+            mock.patch.object(availability, "_cache", self.cache),
+            mock.patch.object(usage, "_tracker", self.tracker),
+            mock.patch.dict(openai_utils._resources, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @override_settings(CHAT_AVAILABILITY_TIMEOUT=0.05)
+    def test_slow_search_is_busy_but_still_cached(self):
+        from .tools import CheckRoomTool
+
+        async def ascape_hotel(*key):
+            await asyncio.sleep(0.2)
+            return self.rooms
+
+        async def run():
+            rooms = await CheckRoomTool()._arun(2, 0, 1, "25-07-2024", "26-07-2024")
+            # The search goes on after the tool gave up
+            await asyncio.sleep(0.3)
+            return rooms
+
+        with mock.patch.object(webscraping, "ascape_hotel", ascape_hotel):
+            rooms = asyncio.run(run())
+        self.assertEqual(rooms, webscraping.rooms_busy)
+        self.assertEqual(self.cache.get(availability.availability_key(2, 0, 1, "25-07-2024", "26-07-2024")), self.rooms)
+
+    def test_agent_awaits_its_tools(self):
+        openai_utils._resources["llm"] = providers.FakeChatModel(latency=0, tokens_per_second=1000, streaming=True)
+        scrapes = []
+
+        async def ascape_hotel(*key):
+            scrapes.append(key)
+            return self.rooms
+
+        tokens = []
+        message = [{"role": "user", "content": "2 adults from 25-07-2024 to 26-07-2024"}]
+        with mock.patch.object(webscraping, "ascape_hotel", ascape_hotel), \
+                mock.patch.object(webscraping, "scape_hotel", side_effect=AssertionError("blocking scrape")):
+            reply = asyncio.run(openai_utils.agenerate_chat_response(message, tokens.append, session_key="lobby:s1"))
+
+        self.assertEqual(scrapes, [availability.availability_key(2, 0, 1, "25-07-2024", "26-07-2024")])
+        self.assertTrue(reply.startswith("Here is what I found:"), reply)
+        self.assertIn("King", reply)
+        self.assertEqual("".join(tokens), reply)
+        # The function call and the answer
+        self.assertEqual(self.tracker.snapshot()["rooms"]["lobby"]["agent"]["calls"], 2)
+
+    def test_consumer_answers_on_the_event_loop(self):
+        openai_utils._resources["llm"] = providers.FakeChatModel(latency=0, tokens_per_second=1000)
+
+        async def run():
+            client = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+            await client.connect()
+            await client.send_json_to({
+                "command": "send_all_messages", "session_id": "s1", "message_new": "hello there", "messages": [],
+            })
+            frames = []
+            while not frames or "assistant_message" not in frames[-1]:
+                frames.append(await client.receive_json_from(timeout=10))
+            await client.disconnect()
+            return frames
+
+        with mock.patch.object(agent_runner, "run_for_room", side_effect=AssertionError("ran on a worker thread")):
+            frames = asyncio.run(run())
+
+        self.assertEqual(frames[0]["message"], "hello there")
+        self.assertEqual(frames[-1]["assistant_message"], providers.FakeChatModel.__fields__["reply"].default)
+        self.assertEqual(
+            [message["role"] for message in sessions.get_session_store().get_history("lobby:s1")], ["user", "assistant"]
+        )
+
+
+class ConsumerBenchmarkTests(SimpleTestCase):
+    def test_bench_reports_direct_send_for_single_guest_rooms(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            output = Path(out_dir, "bench.json")
+            run_fresh(
+                "import django; django.setup(); from django.core.management import call_command; "
+                f"call_command('bench_consumer', rooms=2, messages=2, scrape_latency=0, output={str(output)!r})"
+            )
+            report = json.loads(output.read_text())
+
+        self.assertEqual(report["messages"], 4)
+        self.assertEqual(report["time_to_bot_reply_s"]["count"], 4)
+        self.assertEqual(report["busy_frames"], 0)
+        # Each guest is alone in its room, nothing goes through the channel layer
+        self.assertEqual(report["group_sends"], 0)
+        self.assertIsNotNone(report["event_loop_lag_s"]["p99"])
+
+
+class StubRedisList:
+    def __init__(self):
+        self.lists = {}
+
+    def rpush(self, key, value):
+        self.lists.setdefault(key, []).append(value)
+        return len(self.lists[key])
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def pipeline(self):
+        return StubPipeline(self)
+
+
+# Runs the commands right away, execute() returns their results
+class StubPipeline:
+    def __init__(self, client):
+        self.client = client
+        self.results = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        return lambda *args: self.results.append(command(*args))
+
+    def execute(self):
+        return self.results
+
+
+class EventLoopRedisTests(SimpleTestCase):
+    def test_redis_round_trips_leave_the_event_loop(self):
+        client = redis.Redis()
+        room_members = presence.RedisPresence(client, ttl=60)
+        with mock.patch.object(client, "scard", side_effect=lambda key: threading.current_thread()):
+            thread = asyncio.run(redis_client.call(room_members.count, "chat_lobby"))
+        self.assertIsNot(thread, threading.current_thread())
+
+        # Nothing to wait for in memory
+        room_members = presence.InMemoryPresence()
+        room_members.join("chat_lobby", "a")
+        self.assertEqual(asyncio.run(redis_client.call(room_members.count, "chat_lobby")), 1)
+
+    def test_availability_cache_reads_redis_off_the_loop(self):
+        client = redis.Redis()
+        cache = availability.AvailabilityCache(maxsize=10, ttl=60, redis_client=client)
+        threads = []
+
+        def get(key):
+            threads.append(threading.current_thread())
+            return json.dumps({"rooms": [{"name": "King"}], "stored": time.time()})
+
+        async def fetch():
+            raise AssertionError("Cached in Redis")
+
+        with mock.patch.object(client, "get", side_effect=get):
+            rooms = asyncio.run(cache.aget_or_fetch(("key",), fetch))
+        self.assertEqual(rooms, [{"name": "King"}])
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+# The commands of redis.asyncio a queue worker uses
+class AsyncStubRedis:
+    def __init__(self):
+        self.lists = {}
+        self.values = {}  # key -> (value, expires at)
+
+    def _get(self, key):
+        value, expires = self.values.get(key, (None, 0))
+        if expires < time.monotonic():
+            self.values.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key, value, nx=False, px=None):
+        if nx and self._get(key) is not None:
+            return None
+        self.values[key] = (value, time.monotonic() + px / 1000)
+        return True
+
+    async def eval(self, script, numkeys, key, owner, *args):
+        if self._get(key) != owner:
+            return 0
+        if script == workers.renew_script:
+            self.values[key] = (owner, time.monotonic() + args[0] / 1000)
+        else:
+            del self.values[key]
+        return 1
+
+    async def lmove(self, source, destination, where_from, where_to):
+        items = self.lists.setdefault(source, [])
+        if not items:
+            return None
+        value = items.pop(0 if where_from == "LEFT" else -1)
+        self.lists.setdefault(destination, []).insert(0 if where_to == "LEFT" else len(self.lists[destination]), value)
+        return value
+
+    async def blmove(self, source, destination, timeout, where_from, where_to):
+        value = await self.lmove(source, destination, where_from, where_to)
+        if value is None:
+            await asyncio.sleep(0.01)
+        return value
+
+    async def lrem(self, key, count, value):
+        self.lists[key].remove(value)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CHAT_LLM_PROVIDER="fake",
+)
+class JobQueueTests(SimpleTestCase):
+    def test_rooms_keep_their_shard(self):
+        client = StubRedisList()
+        queue = job_queue.JobQueue(client, shards=4)
+        self.assertEqual(queue.enqueue({"group": "chat_lobby", "message": "hi"}), 1)
+        self.assertEqual(queue.enqueue({"group": "chat_lobby", "message": "hello"}), 2)
+
+        jobs = client.lists[queue.key(queue.shard_of("chat_lobby"))]
+        self.assertEqual([json.loads(job)["message"] for job in jobs], ["hi", "hello"])
+
+    def test_shards_are_parsed(self):
+        self.assertEqual(job_queue.parse_shards("0-2,5", 8), [0, 1, 2, 5])
+        self.assertEqual(job_queue.parse_shards(None, 3), [0, 1, 2])
+        with self.assertRaises(ValueError):
+            job_queue.parse_shards("7-8", 8)
+
+    def test_worker_publishes_the_reply_to_the_room(self):
+        job = {
+            "room": "lobby", "group": "chat_lobby", "stream_id": "s1", "enqueued": time.time(),
+            "key": "lobby:legacy", "messages": [{"role": "user", "content": "hi"}],
+        }
+
+        async def run():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add("chat_lobby", channel)
+            await workers.run_job(job, layer)
+            return await layer.receive(channel)
+
+        event = asyncio.run(run())
+        self.assertEqual(event["type"], "bot_message")
+        self.assertEqual(event["assistant_message"], router.greeting_reply)
+        self.assertEqual(event["stream_id"], "s1")
+        self.assertIn("job_queue_wait", metrics.stage_seconds.totals())
+
+    @override_settings(CHAT_QUEUE_LEASE_TTL=0.15)
+    def test_one_worker_at_a_time_works_a_shard(self):
+        queue = job_queue.JobQueue(StubRedisList(), shards=1)
+        client = AsyncStubRedis()
+        key, running_key = queue.key(0), queue.running_key(0)
+        client.lists[running_key] = [json.dumps({"message": "first"})]
+        client.lists[key] = [json.dumps({"message": "second"}), json.dumps({"message": "third"})]
+        answered, running = [], []
+
+        async def run_job(job, layer):
+            running.append(job["message"])
+            self.assertEqual(len(running), 1)
+            await asyncio.sleep(0.02)
+            answered.append(job["message"])
+            running.remove(job["message"])
+
+        async def run(owners, seconds):
+            stop = asyncio.Event()
+            tasks = [asyncio.ensure_future(workers.work_shard(client, queue, 0, None, stop, owner)) for owner in owners]
+            await asyncio.sleep(seconds)
+            stop.set()
+            await asyncio.gather(*tasks)
+
+        with mock.patch.object(workers, "run_job", run_job):
+            # A live worker is answering "first", nobody else touches the shard
+            asyncio.run(client.set(queue.lease_key(0), "live", px=1000))
+            asyncio.run(run(["a", "b"], 0.3))
+            self.assertEqual(answered, [])
+            self.assertEqual(len(client.lists[running_key]), 1)
+
+            # Once its lease expires one of them takes over, "first" included
+            client.values.clear()
+            asyncio.run(run(["a", "b"], 0.4))
+        self.assertEqual(answered, ["first", "second", "third"])
+        self.assertEqual(client.lists[running_key], [])
+
+
+class AvailabilityPrefetchTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = availability.AvailabilityCache(maxsize=10, ttl=60)
+        patcher = mock.patch.object(availability, "_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tool_uses_the_search_started_from_the_message(self):
+        from .tools import CheckRoomTool
+
+        scrapes = []
+
+        async def ascape_hotel(*key):
+            scrapes.append(key)
+            await asyncio.sleep(0.1)
+            return [{"name": "King", "price": "200"}]
+
+        async def run():
+            key = prefetch.prefetch("2 adults and 1 child from 25-07-2024 to 26-07-2024")
+            # The agent's first LLM call
+            await asyncio.sleep(0.05)
+            rooms = await CheckRoomTool()._arun(2, 1, 1, "25-7-2024", "26-07-2024")
+            return key, rooms
+
+        before = prefetch.stats()
+        with mock.patch.object(webscraping, "ascape_hotel", ascape_hotel):
+            key, rooms = asyncio.run(run())
+
+        self.assertEqual(rooms, [{"name": "King", "price": "200"}])
+        self.assertEqual(scrapes, [key])
+        self.assertEqual(prefetch.stats()["used"], before["used"] + 1)
+
+    @override_settings(CHAT_AVAILABILITY_CACHE_TTL=0.05)
+    def test_unclaimed_searches_expire_without_stats(self):
+        async def ascape_hotel(*key):
+            return []
+
+        async def run():
+            before = prefetch._stats["unused"]
+            prefetch.prefetch("2 adults from 25-07-2024 to 26-07-2024")
+            await asyncio.sleep(0.1)
+            # A later message sweeps the search nobody asked for
+            prefetch.prefetch("3 adults from 25-07-2024 to 26-07-2024")
+            return prefetch._stats["unused"] - before, len(prefetch._unclaimed)
+
+        with mock.patch.object(webscraping, "ascape_hotel", ascape_hotel):
+            unused, waiting = asyncio.run(run())
+        self.assertEqual((unused, waiting), (1, 1))
+        prefetch._unclaimed.clear()
+
+    def test_prefetch_counts_are_served(self):
+        with mock.patch.dict(prefetch._stats, {"started": 4, "already_cached": 1, "used": 3, "unused": 1}):
+            content = self.client.get("/chat/metrics/").content
+
+        self.assertIn(b'chat_availability_prefetches{outcome="used"} 3', content)
+        self.assertIn(b'chat_availability_prefetches{outcome="unused"} 1', content)
+        self.assertIn(b"chat_availability_prefetch_claim_rate 0.75", content)
+
+    def test_messages_without_a_search_start_nothing(self):
+        self.assertIsNone(prefetch.prefetch("What time is check in?"))
+        self.assertIsNone(prefetch.prefetch("2 adults on 25-07-2024"))
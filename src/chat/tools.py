@@ -0,0 +1,94 @@
+import asyncio
+from datetime import datetime
+
+from django.conf import settings
+from langchain.tools import BaseTool
+from typing import Optional, Type
+from pydantic import BaseModel, Field
+
+from . import webscraping as webscrap
+from . import availability
+from . import feedback as feedback_sink
+from . import prefetch
+
+# Tools of the agent, imported when the agent is first built
+
+
+# Function for storing feedback, written to DynamoDB in the background in batches
+def store_feedback(feedback):
+    # Get the current datetime
+    current_datetime = datetime.now().strftime('%H:%M:%S %Y-%m-%d')
+    # Data to be inserted into DynamoDB
+    data = {
+        'date': current_datetime,
+        'feedback': feedback
+        }
+
+    if feedback_sink.get_sink().submit(data):
+        return "Thank you for your feedback! We appreciate your recommendation."
+    return "Sorry, we are unable to store your feedback."
+
+# Custom tool for getting hotel room avalibility
+class CheckRoomCheckInput(BaseModel):
+    """Input for Hotel room avaliblity."""
+
+    num_adult: int = Field(..., description="The number of adults for the hotel room.")
+    num_children: int = Field(..., description="The number of children for the hotel room. If the user did not state the number of children assume the value to be 0.")
+    num_rooms: int = Field(..., description="The number of rooms needed for the user. If the user did not state the number of rooms make the value 1.")
+    check_in_date: str = Field(..., description="The users check in date of the hotel room. The format must be d-m-Y.")
+    check_out_date: str = Field(..., description="The users check out date of the hotel room. The format must be d-m-Y.")
+
+class CheckRoomTool(BaseTool):
+    name = "get_hotel_availability"
+    description = "Gets the hotel room availability."
+
+    def _run(self, num_adult: int, num_children: int, num_rooms: int, check_in_date: str, check_out_date: str):
+        # Same search within the last few minutes (or running right now) is reused
+        key = availability.availability_key(num_adult, num_children, num_rooms, check_in_date, check_out_date)
+        prefetch.claim(key)
+        rooms = availability.get_cache().get_or_fetch(
+            key,
+            lambda: webscrap.scape_hotel(*key),
+            cacheable=lambda rooms: rooms != webscrap.rooms_busy,
+        )
+
+        return rooms
+
+    async def _arun(self, num_adult: int, num_children: int, num_rooms: int, check_in_date: str, check_out_date: str):
+        key = availability.availability_key(num_adult, num_children, num_rooms, check_in_date, check_out_date)
+        prefetch.claim(key)
+        search = availability.get_cache().aget_or_fetch(
+            key,
+            lambda: webscrap.ascape_hotel(*key),
+            cacheable=lambda rooms: rooms != webscrap.rooms_busy,
+        )
+
+        try:
+            # A search that takes too long keeps running and fills the cache for the next ask
+            return await asyncio.wait_for(asyncio.shield(search), settings.CHAT_AVAILABILITY_TIMEOUT)
+        except asyncio.TimeoutError:
+            return webscrap.rooms_busy
+
+    args_schema: Optional[Type[BaseModel]] = CheckRoomCheckInput
+
+
+# Custom tool for getting hotel room avalibility
+class CheckFeedbackInput(BaseModel):
+    """Input for Feedback store."""
+    feedback: str = Field(..., description="The feedback that the user gives. If you are unable to store it apologise.")
+
+class CheckFeedbackTool(BaseTool):
+    name = "get_feedback"
+    description = "Gets the users feedback and stores it."
+
+    def _run(self, feedback: str):
+        # print("i'm running")
+        feedback_response = store_feedback(feedback)
+
+        return feedback_response
+
+    async def _arun(self, feedback: str):
+        # Only queues the write, safe to call on the event loop
+        return store_feedback(feedback)
+
+    args_schema: Optional[Type[BaseModel]] = CheckFeedbackInput
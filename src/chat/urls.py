@@ -6,5 +6,7 @@ app_name = 'chat'
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path("ready/", views.ready, name="ready"),
+    path("metrics/", views.metrics_view, name="metrics"),
     path("<str:room_name>/", views.room, name="room"),
 ]
\ No newline at end of file
@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# How a room is answered as it uses up its token budget
+FULL = "full"
+TRIM_HISTORY = "trim_history"  # shorter history, nothing summarised
+NO_DOC_SEARCH = "no_doc_search"  # shorter history and no get_doc_info tool
+
+# Share of the budget at which the history is trimmed
+TRIM_AT = 0.8
+
+
+def empty_totals():
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_s": 0.0}
+
+
+# Tokens used by the LLM calls of this process, per room and in total.
+# Budgets apply to the tokens of the last `window` seconds. Records are
+# also queued for the TokenUsage table and written by a background thread.
+class TokenUsageTracker:
+    def __init__(self, window=3600, room_budget=0, global_budget=0, persist=False, flush_interval=5, max_rooms=10000):
+        self.window = window
+        self.room_budget = room_budget
+        self.global_budget = global_budget
+        self.persist = persist
+        self.flush_interval = flush_interval
+        self.max_rooms = max_rooms
+
+        # room -> {source -> totals}, the rooms used least recently are dropped
+        # past max_rooms, the TokenUsage table keeps everything
+        self.rooms = OrderedDict()
+        self.total = empty_totals()
+        self._recent = {}  # room -> deque of (time, tokens), only rooms with calls in the window
+        self._recent_total = deque()
+        self._swept = time.monotonic()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._writer = None
+
+    def record(self, room, source, model, prompt_tokens, completion_tokens, latency):
+        # Calls outside a room (warm up, router) are accounted to ""
+        room = room or ""
+        now = time.monotonic()
+        tokens = prompt_tokens + completion_tokens
+        with self._lock:
+            sources = self.rooms.setdefault(room, {})
+            self.rooms.move_to_end(room)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+            for totals in (sources.setdefault(source, empty_totals()), self.total):
+                totals["calls"] += 1
+                totals["prompt_tokens"] += prompt_tokens
+                totals["completion_tokens"] += completion_tokens
+                totals["latency_s"] += latency
+            self._recent.setdefault(room, deque()).append((now, tokens))
+            self._recent_total.append((now, tokens))
+            # Forget the rooms that have been quiet for a whole window
+            if now - self._swept > self.window:
+                self._swept = now
+                for quiet in [quiet for quiet, recent in self._recent.items() if not self._window_tokens(recent, now)]:
+                    del self._recent[quiet]
+            if self.persist:
+                self._pending.append((room, source, model, prompt_tokens, completion_tokens, latency))
+        if self.persist:
+            self._start_writer()
+
+    def _window_tokens(self, recent, now):
+        while recent and now - recent[0][0] > self.window:
+            recent.popleft()
+        return sum(tokens for _, tokens in recent)
+
+    # Tokens used in the current window by the room, or by the process
+    def window_tokens(self, room=None):
+        now = time.monotonic()
+        with self._lock:
+            if room is None:
+                return self._window_tokens(self._recent_total, now)
+            recent = self._recent.get(room)
+            if recent is None:
+                return 0
+            used = self._window_tokens(recent, now)
+            if not recent:
+                del self._recent[room]
+            return used
+
+    def _share(self, used, budget):
+        return used / budget if budget else 0.0
+
+    # How cheaply the room has to be answered right now
+    def downgrade(self, room):
+        share = max(
+            self._share(self.window_tokens(room), self.room_budget),
+            self._share(self.window_tokens(), self.global_budget),
+        )
+        if share >= 1:
+            return NO_DOC_SEARCH
+        if share >= TRIM_AT:
+            return TRIM_HISTORY
+        return FULL
+
+    def snapshot(self):
+        with self._lock:
+            rooms = {
+                room: {source: dict(totals) for source, totals in sources.items()}
+                for room, sources in self.rooms.items()
+            }
+            total = dict(self.total)
+        return {"rooms": rooms, "total": total}
+
+    def _start_writer(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._write_forever, name="token-usage", daemon=True)
+                    self._writer.start()
+
+    def _write_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning("Failed to write token usage: %s", e)
+
+    # Write the queued records to the TokenUsage table
+    def flush(self):
+        from .models import TokenUsage
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            TokenUsage.objects.bulk_create([
+                TokenUsage(room=room, source=source, model=model, prompt_tokens=prompt_tokens,
+                           completion_tokens=completion_tokens, latency=latency)
+                for room, source, model, prompt_tokens, completion_tokens, latency in pending
+            ])
+        return len(pending)
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = TokenUsageTracker(
+                    window=settings.CHAT_TOKEN_BUDGET_WINDOW,
+                    room_budget=settings.CHAT_ROOM_TOKEN_BUDGET,
+                    global_budget=settings.CHAT_GLOBAL_TOKEN_BUDGET,
+                    persist=settings.CHAT_TOKEN_USAGE_PERSIST,
+                    max_rooms=settings.CHAT_SESSION_MAX,
+                )
+    return _tracker
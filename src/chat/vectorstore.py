@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+
+VECTORS_NAME = "vectors.npy"
+CHUNKS_NAME = "chunks.json"
+
+
+def normalise_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+# Chunk embeddings in one contiguous float32 matrix with unit rows, so the
+# cosine similarity of a batch of queries is one matrix product. Opened from
+# disk the matrix is memory-mapped and every worker shares its pages.
+class NumpyVectorStore(VectorStore):
+    def __init__(self, embedding, ids=None, texts=None, metadatas=None, vectors=None, query_cache_size=256):
+        self.embedding = embedding
+        self.ids = list(ids or [])
+        self.texts = list(texts or [])
+        self.metadatas = list(metadatas or [{} for _ in self.ids])
+        self.vectors = vectors if vectors is not None else np.zeros((0, 0), dtype=np.float32)
+
+        # Embeddings of recent queries, guests ask the same things
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        vectors = normalise_rows(self.embedding.embed_documents(texts))
+
+        self.vectors = np.vstack([self.vectors, vectors]) if self.ids else vectors
+        self.ids.extend(ids)
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas or [{} for _ in texts])
+        return ids
+
+    def delete(self, ids=None, **kwargs):
+        removed = set(ids or [])
+        keep = [row for row, id_ in enumerate(self.ids) if id_ not in removed]
+        self.vectors = np.ascontiguousarray(self.vectors[keep])
+        self.ids = [self.ids[row] for row in keep]
+        self.texts = [self.texts[row] for row in keep]
+        self.metadatas = [self.metadatas[row] for row in keep]
+        return True
+
+    # Unit vectors of the queries, embedded together if they are not cached
+    def embed_queries(self, queries):
+        with self._lock:
+            cached = {query: self._query_cache[query] for query in queries if query in self._query_cache}
+            for query in cached:
+                self._query_cache.move_to_end(query)
+        missing = list(dict.fromkeys(query for query in queries if query not in cached))
+        self.query_cache_hits += len(queries) - len(missing)
+        self.query_cache_misses += len(missing)
+
+        if missing:
+            if len(missing) == 1:
+                embedded = [self.embedding.embed_query(missing[0])]
+            else:
+                embedded = self.embedding.embed_documents(missing)
+            for query, vector in zip(missing, normalise_rows(embedded)):
+                cached[query] = vector
+            with self._lock:
+                for query in missing:
+                    self._query_cache[query] = cached[query]
+                while len(self._query_cache) > self.query_cache_size:
+                    self._query_cache.popitem(last=False)
+        return np.vstack([cached[query] for query in queries])
+
+    # For each row of `vectors` the k most similar chunks with their cosine similarity
+    def search_vectors(self, vectors, k=4):
+        if not self.ids:
+            return [[] for _ in vectors]
+        scores = np.asarray(vectors, dtype=np.float32) @ self.vectors.T
+        k = min(k, len(self.ids))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, columns in zip(scores, top):
+            columns = columns[np.argsort(-row[columns])]
+            results.append([
+                (Document(page_content=self.texts[column], metadata=self.metadatas[column]), float(row[column]))
+                for column in columns
+            ])
+        return results
+
+    def batch_similarity_search_with_score(self, queries, k=4):
+        return self.search_vectors(self.embed_queries(list(queries)), k)
+
+    def batch_similarity_search(self, queries, k=4):
+        return [[doc for doc, _ in results] for results in self.batch_similarity_search_with_score(queries, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.batch_similarity_search_with_score([query], k)[0]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return self.batch_similarity_search([query], k)[0]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.search_vectors(normalise_rows([embedding]), k)[0]]
+
+    # Cosine similarity to a relevance in [0, 1]
+    def _select_relevance_score_fn(self):
+        return lambda similarity: (similarity + 1) / 2
+
+    # Written next to each other and swapped in, readers keep their old mapping
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        vectors_path = os.path.join(index_dir, VECTORS_NAME)
+        chunks_path = os.path.join(index_dir, CHUNKS_NAME)
+        with open(vectors_path + ".tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(self.vectors, dtype=np.float32))
+        with open(chunks_path + ".tmp", "w") as f:
+            json.dump({"ids": self.ids, "texts": self.texts, "metadatas": self.metadatas}, f)
+        os.replace(vectors_path + ".tmp", vectors_path)
+        os.replace(chunks_path + ".tmp", chunks_path)
+
+    @classmethod
+    def exists(cls, index_dir):
+        return os.path.exists(os.path.join(index_dir, VECTORS_NAME))
+
+    @classmethod
+    def load(cls, index_dir, embedding, **kwargs):
+        with open(os.path.join(index_dir, CHUNKS_NAME)) as f:
+            chunks = json.load(f)
+        vectors = np.load(os.path.join(index_dir, VECTORS_NAME), mmap_mode="r")
+        return cls(embedding, chunks["ids"], chunks["texts"], chunks["metadatas"], vectors, **kwargs)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, **kwargs):
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
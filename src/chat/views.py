@@ -1,9 +1,24 @@
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
 
+from . import metrics
+from . import openai_utils as oau
+
 # Create your views here.
 
 def index(request):
     return render(request, 'chat/index.html')
 
 def room(request, room_name):
-    return render(request, "chat/room.html", {"room_name": room_name})
\ No newline at end of file
+    return render(request, "chat/room.html", {"room_name": room_name})
+
+# Readiness probe for the load balancer, 503 until the agent is warmed up
+def ready(request):
+    if oau.is_ready():
+        return JsonResponse({"ready": True})
+    return JsonResponse({"ready": False}, status=503)
+
+
+# Stage latency histograms for Prometheus to scrape
+def metrics_view(request):
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
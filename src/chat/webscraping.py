@@ -1,13 +1,21 @@
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
-
+# Selenium is imported where a browser is used, importing this module
+# (and the plain http path) does not load it
 from datetime import datetime
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from html.parser import HTMLParser
+from urllib.request import Request, urlopen
 
 from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
 
+from django.conf import settings
+
+from . import browser_pool
+from . import metrics
+
 # Create a dictionary to map month names to numerical representations
 month_mapping = {
     "January": "00",
@@ -41,12 +49,21 @@ def convert_date(date):
 
 # Define a function to extract the room data
 def extract_room_data(room_element):
+    from selenium.webdriver.common.by import By
+
     room_name = room_element.find_element(By.CLASS_NAME, "d-flex.roomName").text
     room_price = room_element.find_element(By.CLASS_NAME, "cash").text
     return {"name": room_name, "price": room_price}
 
-# Web scrape hotel info for avaliablity
-def scape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_date):
+# Define the User-Agent header to mimic a web browser
+user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.1000.100 Safari/537.36"
+
+rooms_unavailable = "There are no rooms avaliable for corresponding to your values."
+rooms_busy = "Sorry, I am unable to check room availability right now. Try again later."
+
+
+# Build the IHG room search url for the guest's values
+def build_url(num_adult, num_children, num_rooms, check_in_date, check_out_date):
     url = "https://www.ihg.com/crowneplaza/hotels/us/en/find-hotels/select-roomrate?fromRedirect=true&qSrt=sBR&qIta=99502222&icdv=99502222&qSlH=SINCP&qRms=6&qAdlt=2&qChld=1&qCiD=25&qCiMy=72023&qCoD=26&qCoMy=72023&qAAR=6CBARC&qRtP=6CBARC&setPMCookies=true&qSHBrC=CP&qDest=75%20Airport%20Boulevard%2001-01,%20Singapore,%20SG&srb_u=1"
 
     parsed_url = urlparse(url)
@@ -67,20 +84,217 @@ def scape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_dat
 
     # Construct the new URL with updated query parameters
     new_query = urlencode(query_parameters, doseq=True)
-    new_url = urlunparse(parsed_url._replace(query=new_query))
+    return urlunparse(parsed_url._replace(query=new_query))
+
+
+# Requests the light mode browser does not make, the room cards only need the html and scripts
+blocked_urls = [
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.svg", "*.ico",
+    "*.woff", "*.woff2", "*.ttf", "*.otf", "*.mp4", "*.webm",
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+    "*facebook.net*", "*hotjar.com*", "*demdex.net*", "*omtrdc.net*",
+]
+
+# Reads every room card in one round trip instead of two per card
+extract_rooms_script = """
+return Array.from(document.querySelectorAll('.room-rate-card')).map(function (card) {
+    var name = card.querySelector('.d-flex.roomName');
+    var price = card.querySelector('.cash');
+    return {
+        name: name ? name.innerText.trim() : '',
+        price: price ? price.innerText.trim() : ''
+    };
+}).filter(function (room) { return room.name; });
+"""
+
+# Threads for browser scrapes started from async code, one per pooled browser
+scrape_executor = ThreadPoolExecutor(max_workers=settings.CHAT_BROWSER_POOL_SIZE, thread_name_prefix="chat-scrape")
+
+# Duration of recent scrapes per path: http, browser_light, browser_full
+timings = {"http": deque(maxlen=100), "browser_light": deque(maxlen=100), "browser_full": deque(maxlen=100)}
+
+
+def timed(path, func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        record_timing(path, time.perf_counter() - start)
+
 
-    # Define the User-Agent header to mimic a web browser
-    user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.1000.100 Safari/537.36"
+def record_timing(path, elapsed):
+    timings[path].append(elapsed)
+    metrics.observe(f"scrape_{path}", elapsed)
+
+
+# Create a new instance of the Chrome browser, browser_pool keeps them warm
+def create_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+
+    light = settings.CHAT_SCRAPER_MODE == "light"
 
-    # Web scrape info
     # Chrome options 
     options = Options()
-    options.headless = True  # Enable headless mode
+    options.add_argument("--headless=new")  # Enable headless mode
     options.add_argument(f"user-agent={user_agent}")
+    if light:
+        # Hand the page over once the DOM is ready, without images
+        options.page_load_strategy = "eager"
+        options.add_argument("--blink-settings=imagesEnabled=false")
 
-    # Create a new instance of the Chrome browser
     driver = webdriver.Chrome(options=options)
 
+    if light:
+        # Skip fonts, media and trackers as well
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": blocked_urls})
+    return driver
+
+
+# Web scrape hotel info for avaliablity
+def scape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_date):
+    new_url = build_url(num_adult, num_children, num_rooms, check_in_date, check_out_date)
+
+    # A plain request is enough when the rates are in the served html
+    if settings.CHAT_SCRAPER_HTTP_FIRST:
+        rooms = timed("http", fetch_rooms_http, new_url)
+        if rooms:
+            return rooms
+
+    return scrape_with_browser(new_url)
+
+
+# Async version of scape_hotel. Neither the http request nor the browser
+# block the event loop, the browser runs on one of the scrape threads.
+async def ascape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_date):
+    new_url = build_url(num_adult, num_children, num_rooms, check_in_date, check_out_date)
+
+    if settings.CHAT_SCRAPER_HTTP_FIRST:
+        start = time.perf_counter()
+        rooms = await afetch_rooms_http(new_url)
+        record_timing("http", time.perf_counter() - start)
+        if rooms:
+            return rooms
+
+    loop = asyncio.get_running_loop()
+    # Copy the context so the browser spans land in the message's trace
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(scrape_executor, context.run, scrape_with_browser, new_url)
+
+
+def scrape_with_browser(new_url):
+    # Web scrape info with a browser from the pool, it is returned
+    # (or replaced if something went wrong) when the block exits
+    try:
+        with browser_pool.get_pool().driver() as driver:
+            if settings.CHAT_SCRAPER_MODE == "light":
+                return timed("browser_light", scrape_rooms_light, driver, new_url)
+            return timed("browser_full", scrape_rooms, driver, new_url)
+    except Exception as e:
+        print("Exception for browser:", e)
+        return rooms_busy
+
+
+# Collects the room names and prices from room-rate-card elements
+class RoomCardParser(HTMLParser):
+    void_tags = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+    def __init__(self):
+        super().__init__()
+        self.rooms = []
+        self.stack = []  # (tag, field) for every open element
+        self.room = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.void_tags:
+            return
+        classes = (dict(attrs).get("class") or "").split()
+        field = None
+        if "room-rate-card" in classes:
+            field = "card"
+            self.room = {"name": "", "price": ""}
+        elif self.room is not None and "roomName" in classes and "d-flex" in classes:
+            field = "name"
+        elif self.room is not None and "cash" in classes:
+            field = "price"
+        self.stack.append((tag, field))
+
+    def handle_endtag(self, tag):
+        # Pop up to the matching open tag, html is not always well formed
+        while self.stack:
+            open_tag, field = self.stack.pop()
+            if field == "card" and self.room is not None:
+                if self.room["name"]:
+                    self.rooms.append({key: " ".join(value.split()) for key, value in self.room.items()})
+                self.room = None
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.room is None:
+            return
+        for _, field in reversed(self.stack):
+            if field in ("name", "price"):
+                self.room[field] += data
+                break
+
+
+def parse_rooms_html(html):
+    parser = RoomCardParser()
+    parser.feed(html)
+    parser.close()
+    return parser.rooms
+
+
+async def afetch_rooms_http(new_url):
+    import aiohttp
+
+    try:
+        timeout = aiohttp.ClientTimeout(total=settings.CHAT_SCRAPER_HTTP_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(new_url, headers={"User-Agent": user_agent, "Accept": "text/html"}) as response:
+                html = await response.text(errors="replace")
+    except Exception as e:
+        print("Exception for http fetch:", e)
+        return None
+    return parse_rooms_html(html) or None
+
+
+# Fetch the search page without a browser, None if the rates are not in the html
+def fetch_rooms_http(new_url):
+    try:
+        request = Request(new_url, headers={"User-Agent": user_agent, "Accept": "text/html"})
+        with urlopen(request, timeout=settings.CHAT_SCRAPER_HTTP_TIMEOUT) as response:
+            html = response.read().decode(response.headers.get_content_charset() or "utf-8", "replace")
+    except Exception as e:
+        print("Exception for http fetch:", e)
+        return None
+    return parse_rooms_html(html) or None
+
+
+def scrape_rooms_light(driver, new_url):
+    from selenium.webdriver.support.ui import WebDriverWait
+
+    # Navigate to the URL
+    driver.get(new_url)
+
+    # Poll the page with the extraction script until room cards show up
+    try:
+        rooms = WebDriverWait(driver, 5).until(lambda d: d.execute_script(extract_rooms_script) or False)
+    except Exception as e:
+        print("Exception for room_rate_items:", e)
+        return rooms_unavailable
+
+    print(rooms)
+    return rooms
+
+
+def scrape_rooms(driver, new_url):
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     # Navigate to the URL
     driver.get(new_url)
 
@@ -89,15 +303,9 @@ def scape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_dat
 
     # Initialize values outside the try-except block
     room_rate_items = None
-    rooms = "There are no rooms avaliable for corresponding to your values."
+    rooms = rooms_unavailable
 
     print("Is page loaded?", driver.execute_script("return document.readyState") == "complete")
-    
-    # # Get the entire page source code
-    # page_source = driver.page_source
-
-    # Print the page content
-    # print(page_source)
 
     # Wait for room rate items to load
     try:
@@ -113,10 +321,8 @@ def scape_hotel(num_adult, num_children, num_rooms, check_in_date, check_out_dat
 
     except Exception as e:
         print("Exception for room:", e)
+        # The page is in an odd state, start the next search with a fresh browser
+        browser_pool.get_pool().recycle(driver)
         return rooms
 
-    # Close the browser window
-    driver.quit()
-
     return rooms
-
@@ -0,0 +1,171 @@
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+
+from . import consumers
+from . import job_queue
+from . import metrics
+from . import openai_utils as oau
+from . import prefetch
+from . import replay
+
+logger = logging.getLogger(__name__)
+
+# Queue worker of `manage.py run_chat_workers`. Every shard it leases is read
+# by one coroutine, one job at a time, and the jobs run on the agent pool
+# (agent_runner) just like in the web process.
+
+# Only the holder may renew or drop a lease
+renew_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+release_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+# A shard is worked by one worker at a time, the one holding its lease. The
+# lease is renewed while the worker runs and expires `ttl` seconds after it
+# died, then another worker takes the shard and the jobs it left running.
+class ShardLease:
+    def __init__(self, client, key, owner, ttl):
+        self.client = client
+        self.key = key
+        self.owner = owner
+        self.ttl_ms = max(1, int(ttl * 1000))
+
+    async def acquire(self):
+        return bool(await self.client.set(self.key, self.owner, nx=True, px=self.ttl_ms))
+
+    async def renew(self):
+        return bool(await self.client.eval(renew_script, 1, self.key, self.owner, self.ttl_ms))
+
+    async def release(self):
+        await self.client.eval(release_script, 1, self.key, self.owner)
+
+    # Renews the lease until cancelled, sets `lost` when another worker has it
+    async def keep(self, lost):
+        while True:
+            await asyncio.sleep(self.ttl_ms / 3000)
+            if not await self.renew():
+                lost.set()
+                return
+
+
+# What answers the job, as in ChatConsumer.receive
+def job_call(job):
+    if "messages" in job:
+        generate = oau.agenerate_chat_response if settings.CHAT_AGENT_ASYNC else oau.generate_chat_response
+        return functools.partial(generate, session_key=job["key"]), (job["messages"],)
+    return consumers.get_session_turn(), (job["key"], job["message"])
+
+
+# Answer one job and publish the reply to its room group
+async def run_job(job, layer):
+    async def publish(event, timed=True):
+        event = await replay.record(job["group"], event)
+        with metrics.span("channel_layer") if timed else contextlib.nullcontext():
+            await layer.group_send(job["group"], event)
+
+    with metrics.trace(job["room"], job["stream_id"]):
+        metrics.observe("job_queue_wait", max(0.0, time.time() - job["enqueued"]))
+        if settings.CHAT_AVAILABILITY_PREFETCH:
+            prefetch.prefetch(job["message"] if "message" in job else job["messages"][-1]["content"])
+        func, args = job_call(job)
+        try:
+            with metrics.span("job_run"):
+                await consumers.answer(job["group"], job["stream_id"], publish, func, *args)
+        except Exception:
+            logger.exception("Chat job for room %s failed", job["room"])
+            await publish({"type": "bot_message", "assistant_message": consumers.error_message, "stream_id": job["stream_id"]})
+
+
+async def wait(stop, timeout):
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(stop.wait(), timeout)
+
+
+async def work_shard(client, queue, shard, layer, stop, owner):
+    lease = ShardLease(client, queue.lease_key(shard), owner, settings.CHAT_QUEUE_LEASE_TTL)
+    while not stop.is_set():
+        if not await lease.acquire():
+            # Another worker has the shard, take over if it stops renewing
+            await wait(stop, settings.CHAT_QUEUE_LEASE_TTL / 3)
+            continue
+        lost = asyncio.Event()
+        keeping = asyncio.create_task(lease.keep(lost))
+        try:
+            await work_leased_shard(client, queue, shard, layer, stop, lost)
+        finally:
+            keeping.cancel()
+            if not lost.is_set():
+                await lease.release()
+        if lost.is_set():
+            logger.warning("Lost the lease of shard %s", shard)
+
+
+async def work_leased_shard(client, queue, shard, layer, stop, lost):
+    key, running_key = queue.key(shard), queue.running_key(shard)
+    # Jobs the last worker of this shard took and did not answer go first
+    while await client.lmove(running_key, key, "RIGHT", "LEFT"):
+        pass
+
+    while not stop.is_set() and not lost.is_set():
+        raw = await client.blmove(key, running_key, 1, "LEFT", "RIGHT")
+        if raw is None:
+            continue
+        try:
+            await run_job(json.loads(raw), layer)
+        finally:
+            await client.lrem(running_key, 1, raw)
+
+
+# Work on `shards` until `stop` is set, the jobs being answered are finished
+async def work(shards, stop):
+    import redis.asyncio
+    from channels.layers import get_channel_layer
+
+    client = redis.asyncio.Redis.from_url(settings.CHAT_REDIS_URL)
+    queue = job_queue.get_queue()
+    layer = get_channel_layer()
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    try:
+        await asyncio.gather(*(work_shard(client, queue, shard, layer, stop, owner) for shard in shards))
+    finally:
+        await client.aclose()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The worker's histograms (job_queue_wait, job_run, ...) for Prometheus to scrape
+def serve_metrics(port):
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
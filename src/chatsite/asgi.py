@@ -8,6 +8,7 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
 import os
+import threading
 
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
@@ -20,6 +21,14 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatsite.settings')
 
 django_asgi_app = get_asgi_application()
 
+from django.conf import settings
+
+from chat import openai_utils
+
+# Build the agent and the document index and start the browsers before the first guest, /chat/ready/ reports when done
+if settings.CHAT_WARM_UP:
+    threading.Thread(target=openai_utils.warm_up, name="chat-warm-up", daemon=True).start()
+
 
 application = ProtocolTypeRouter(
     {
@@ -136,4 +136,138 @@ CHANNEL_LAYERS = {
             "hosts": [("127.0.0.1", 6379)],
         },
     },
-}
\ No newline at end of file
+}
+
+# Chat agent
+# Number of threads that run agent/LLM calls off the event loop
+CHAT_AGENT_WORKERS = int(os.environ.get('CHAT_AGENT_WORKERS', '4'))
+# Stream assistant replies token by token over the websocket
+CHAT_STREAMING = os.environ.get('CHAT_STREAMING', 'True') == 'True'
+
+# Server side conversation sessions, 'memory' (per process) or 'redis' (shared)
+CHAT_SESSION_BACKEND = os.environ.get('CHAT_SESSION_BACKEND', 'memory')
+CHAT_SESSION_TTL = int(os.environ.get('CHAT_SESSION_TTL', '86400'))  # seconds
+CHAT_SESSION_MAX = int(os.environ.get('CHAT_SESSION_MAX', '10000'))  # in memory backend only
+CHAT_REDIS_URL = os.environ.get('CHAT_REDIS_URL', 'redis://127.0.0.1:6379/1')
+
+# Prompt tokens of chat history kept verbatim, older turns are summarised
+CHAT_MEMORY_TOKEN_BUDGET = int(os.environ.get('CHAT_MEMORY_TOKEN_BUDGET', '1500'))
+
+# Documents for the get_doc_info tool and where `manage.py build_index` persists their embeddings
+CHAT_DOCUMENTS_DIR = os.environ.get('CHAT_DOCUMENTS_DIR', os.path.join(BASE_DIR, 'static'))
+CHAT_DOCUMENTS_GLOB = os.environ.get('CHAT_DOCUMENTS_GLOB', '**/*.txt')
+CHAT_INDEX_DIR = os.environ.get('CHAT_INDEX_DIR', os.path.join(BASE_DIR, 'index'))
+# Vector store of the document index, 'chroma' or 'numpy' (one memory-mapped matrix, see chat/vectorstore.py)
+CHAT_VECTOR_BACKEND = os.environ.get('CHAT_VECTOR_BACKEND', 'chroma')
+CHAT_VECTOR_QUERY_CACHE_SIZE = int(os.environ.get('CHAT_VECTOR_QUERY_CACHE_SIZE', '256'))  # query embeddings kept, numpy only
+# Document search prompt: chunks fetched, near duplicates dropped (word trigram overlap), then
+# the best ones packed into this many tokens, 0 stuffs the 4 nearest chunks as they are
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.environ.get('CHAT_CONTEXT_TOKEN_BUDGET', '600'))
+CHAT_CONTEXT_FETCH_K = int(os.environ.get('CHAT_CONTEXT_FETCH_K', '8'))
+CHAT_CONTEXT_DUPLICATE_THRESHOLD = float(os.environ.get('CHAT_CONTEXT_DUPLICATE_THRESHOLD', '0.8'))
+
+# Model providers, 'openai' or offline stand-ins ('fake' chat model, 'hashing' embeddings)
+CHAT_LLM_PROVIDER = os.environ.get('CHAT_LLM_PROVIDER', 'openai')
+CHAT_EMBEDDINGS_PROVIDER = os.environ.get('CHAT_EMBEDDINGS_PROVIDER', 'openai')
+CHAT_OPENAI_MODEL = os.environ.get('CHAT_OPENAI_MODEL', 'gpt-3.5-turbo-0613')
+CHAT_FAKE_LLM_LATENCY = float(os.environ.get('CHAT_FAKE_LLM_LATENCY', '0.5'))  # seconds before the first token
+CHAT_FAKE_LLM_TOKENS_PER_SECOND = float(os.environ.get('CHAT_FAKE_LLM_TOKENS_PER_SECOND', '50'))
+
+# Headless Chrome pool for the room availability scraper
+CHAT_BROWSER_POOL_SIZE = int(os.environ.get('CHAT_BROWSER_POOL_SIZE', '2'))  # browsers alive at most
+CHAT_BROWSER_POOL_WARM = int(os.environ.get('CHAT_BROWSER_POOL_WARM', '1'))  # started ahead of the first search
+CHAT_BROWSER_MAX_PAGES = int(os.environ.get('CHAT_BROWSER_MAX_PAGES', '50'))  # pages before a browser is replaced
+CHAT_BROWSER_CHECKOUT_TIMEOUT = float(os.environ.get('CHAT_BROWSER_CHECKOUT_TIMEOUT', '30'))  # seconds
+
+# Cache of scraped room availability, shared through Redis when enabled
+CHAT_AVAILABILITY_CACHE_TTL = int(os.environ.get('CHAT_AVAILABILITY_CACHE_TTL', '300'))  # seconds
+CHAT_AVAILABILITY_CACHE_SIZE = int(os.environ.get('CHAT_AVAILABILITY_CACHE_SIZE', '1000'))
+CHAT_AVAILABILITY_CACHE_REDIS = os.environ.get('CHAT_AVAILABILITY_CACHE_REDIS', 'False') == 'True'
+# 'light' blocks images, fonts and trackers and reads all rooms in one script call, 'full' loads the whole page
+CHAT_SCRAPER_MODE = os.environ.get('CHAT_SCRAPER_MODE', 'light')
+# Try a plain http request before starting a browser
+CHAT_SCRAPER_HTTP_FIRST = os.environ.get('CHAT_SCRAPER_HTTP_FIRST', 'False') == 'True'
+CHAT_SCRAPER_HTTP_TIMEOUT = float(os.environ.get('CHAT_SCRAPER_HTTP_TIMEOUT', '5'))  # seconds
+
+# Run the agent as a coroutine on the event loop (async tools) instead of on the worker threads
+CHAT_AGENT_ASYNC = os.environ.get('CHAT_AGENT_ASYNC', 'False') == 'True'
+# Start the room search as soon as a message contains the dates and guests, before the agent asks.
+# Off by default, every such message then costs a browser search even if the agent never needs it
+CHAT_AVAILABILITY_PREFETCH = os.environ.get('CHAT_AVAILABILITY_PREFETCH', 'False') == 'True'
+# Seconds an async tool waits before answering that it is unavailable
+CHAT_AVAILABILITY_TIMEOUT = float(os.environ.get('CHAT_AVAILABILITY_TIMEOUT', '60'))
+
+# Guest feedback, written behind to DynamoDB in batches
+CHAT_FEEDBACK_TABLE = os.environ.get('CHAT_FEEDBACK_TABLE', 'Feedback')
+CHAT_FEEDBACK_REGION = os.environ.get('CHAT_FEEDBACK_REGION', 'us-east-1')
+# e.g. http://localhost:8000 for DynamoDB Local
+CHAT_DYNAMODB_ENDPOINT = os.environ.get('CHAT_DYNAMODB_ENDPOINT') or None
+CHAT_FEEDBACK_BATCH_SIZE = int(os.environ.get('CHAT_FEEDBACK_BATCH_SIZE', '25'))  # 25 at most
+CHAT_FEEDBACK_FLUSH_INTERVAL = float(os.environ.get('CHAT_FEEDBACK_FLUSH_INTERVAL', '2'))  # seconds
+CHAT_FEEDBACK_QUEUE_SIZE = int(os.environ.get('CHAT_FEEDBACK_QUEUE_SIZE', '10000'))
+# Feedback DynamoDB did not take, replayed after the next good write
+CHAT_FEEDBACK_SPILL_PATH = os.environ.get('CHAT_FEEDBACK_SPILL_PATH', str(BASE_DIR / 'feedback_spill.jsonl'))
+# Writes rejecting an item before it goes to the dead letter file (spill path + '.dead')
+CHAT_FEEDBACK_MAX_ATTEMPTS = int(os.environ.get('CHAT_FEEDBACK_MAX_ATTEMPTS', '5'))
+
+# Answers of the document search reused for questions with the same meaning
+CHAT_ANSWER_CACHE_THRESHOLD = float(os.environ.get('CHAT_ANSWER_CACHE_THRESHOLD', '0.95'))  # cosine similarity
+CHAT_ANSWER_CACHE_SIZE = int(os.environ.get('CHAT_ANSWER_CACHE_SIZE', '500'))
+CHAT_ANSWER_CACHE_TTL = int(os.environ.get('CHAT_ANSWER_CACHE_TTL', '3600'))  # seconds
+
+# Answer small talk, off-topic questions and complete availability requests without the agent
+CHAT_ROUTER_ENABLED = os.environ.get('CHAT_ROUTER_ENABLED', 'True') == 'True'
+
+# Build the agent and document index in the background when the ASGI application loads
+CHAT_WARM_UP = os.environ.get('CHAT_WARM_UP', 'True') == 'True'
+
+# Token budgets over a rolling window, 0 for no limit. From 80% of a budget the
+# history is trimmed to CHAT_TRIMMED_HISTORY_BUDGET tokens, from 100% doc search is off too
+CHAT_TOKEN_BUDGET_WINDOW = int(os.environ.get('CHAT_TOKEN_BUDGET_WINDOW', '3600'))  # seconds
+CHAT_ROOM_TOKEN_BUDGET = int(os.environ.get('CHAT_ROOM_TOKEN_BUDGET', '100000'))
+CHAT_GLOBAL_TOKEN_BUDGET = int(os.environ.get('CHAT_GLOBAL_TOKEN_BUDGET', '0'))
+CHAT_TRIMMED_HISTORY_BUDGET = int(os.environ.get('CHAT_TRIMMED_HISTORY_BUDGET', '300'))
+# Write every LLM call's token usage to the TokenUsage table
+CHAT_TOKEN_USAGE_PERSIST = os.environ.get('CHAT_TOKEN_USAGE_PERSIST', 'True') == 'True'
+
+# Admission control. Messages per connection and per room (token buckets), runs at
+# once and runs waiting across rooms. Past these the client gets a "busy, retry" frame.
+# In queue mode CHAT_MAX_QUEUED_RUNS caps the jobs waiting in the shared Redis queue
+CHAT_RATE_CONNECTION_PER_MINUTE = float(os.environ.get('CHAT_RATE_CONNECTION_PER_MINUTE', '20'))
+CHAT_RATE_CONNECTION_BURST = int(os.environ.get('CHAT_RATE_CONNECTION_BURST', '5'))
+CHAT_RATE_ROOM_PER_MINUTE = float(os.environ.get('CHAT_RATE_ROOM_PER_MINUTE', '60'))
+CHAT_RATE_ROOM_BURST = int(os.environ.get('CHAT_RATE_ROOM_BURST', '10'))
+CHAT_MAX_CONCURRENT_RUNS = int(os.environ.get('CHAT_MAX_CONCURRENT_RUNS', str(CHAT_AGENT_WORKERS)))
+CHAT_MAX_QUEUED_RUNS = int(os.environ.get('CHAT_MAX_QUEUED_RUNS', '50'))
+
+# Send straight to the websocket when a connection is alone in its room, skipping the
+# channel layer. Room members are tracked in 'memory' (one process serves the
+# websockets) or 'redis' (several processes)
+CHAT_DIRECT_SEND = os.environ.get('CHAT_DIRECT_SEND', 'True') == 'True'
+CHAT_PRESENCE_BACKEND = os.environ.get('CHAT_PRESENCE_BACKEND', 'memory')
+
+# Echoed messages and replies kept per room for clients that reconnect, 0 turns it off.
+# 'memory' or 'redis', queue mode needs 'redis' (the workers number the replies)
+CHAT_REPLAY_BUFFER_SIZE = int(os.environ.get('CHAT_REPLAY_BUFFER_SIZE', '50'))
+CHAT_REPLAY_BACKEND = os.environ.get('CHAT_REPLAY_BACKEND', 'memory')
+
+# 'local' answers messages in the web process, 'queue' hands them through Redis to
+# `manage.py run_chat_workers`. Queue mode needs CHAT_SESSION_BACKEND = 'redis' and a
+# channel layer shared with the workers
+CHAT_AGENT_MODE = os.environ.get('CHAT_AGENT_MODE', 'local')
+CHAT_QUEUE_SHARDS = int(os.environ.get('CHAT_QUEUE_SHARDS', '16'))  # queues the rooms are spread over
+CHAT_QUEUE_LEASE_TTL = float(os.environ.get('CHAT_QUEUE_LEASE_TTL', '30'))  # seconds a dead worker keeps its shards
+
+# One JSON line per answered message with the time spent in each stage, see chat/metrics.py
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "chat.trace": {
+            "handlers": ["console"],
+            "level": os.environ.get('CHAT_TRACE_LOG_LEVEL', 'INFO'),
+            "propagate": False,
+        },
+    },
+}
@@ -1,6 +1,34 @@
 // Constant variables
 const roomName = localStorage.getItem('roomName'); // Room name
 
+// Server side session id, lets us send only the new message
+var sessionId = localStorage.getItem('chatSessionId');
+if (sessionId === null) {
+    sessionId = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    localStorage.setItem('chatSessionId', sessionId);
+}
+
+// Numbered frames already shown, per room, the server replays what we missed while
+// reconnecting. Numbers restart with a new epoch when the server lost its replay buffer.
+var seenRooms = JSON.parse(localStorage.getItem('chatSeen')) || {};
+if (!(roomName in seenRooms) || !('seqs' in seenRooms[roomName])) {
+    seenRooms[roomName] = { epoch: null, seqs: [] };
+}
+var seen = seenRooms[roomName];
+
+// Returns false for a frame we have seen before
+function seen_store(epoch, seq) {
+    if (epoch !== seen.epoch) {
+        seen = seenRooms[roomName] = { epoch: epoch, seqs: [] };
+    } else if (seen.seqs.includes(seq)) {
+        return false;
+    }
+    seen.seqs.push(seq);
+    seen.seqs = seen.seqs.slice(-100);
+    localStorage.setItem('chatSeen', JSON.stringify(seenRooms));
+    return true;
+}
+
 // Function to create messages
 function message_load(message, time, user) {
     // Get the template element based on user 
@@ -18,6 +46,22 @@ function message_load(message, time, user) {
     // Append the new message to the chat container
     const chatContainer = document.querySelector('#chat-container');
     chatContainer.appendChild(newMessage);
+    return newMessage;
+}
+
+// Assistant messages that are still being streamed, by stream id
+var streamingMessages = {};
+
+// Function to add a streamed piece of an assistant message
+function message_stream(delta, time, streamId) {
+    var stream = streamingMessages[streamId];
+    if (stream === undefined) {
+        // First piece, create an empty chatbot message to fill in
+        var element = message_load('', time, 'assistant');
+        stream = streamingMessages[streamId] = { element: element, text: '' };
+    }
+    stream.text += delta;
+    stream.element.querySelector('p').innerHTML = stream.text;
 }
 
 // Function to store messages in local storage
@@ -37,6 +81,17 @@ function message_store(message, time, user) {
     localStorage.setItem('chatMessages', JSON.stringify(existingMessages));
 }
 
+// Function to send the whole local history, seeds the server side session
+function send_all_messages(message) {
+    const existingMessages = JSON.parse(localStorage.getItem('chatMessages'));
+    chatSocket.send(JSON.stringify({
+        'command': 'send_all_messages',
+        'session_id': sessionId,
+        'message_new': message,
+        'messages': existingMessages,
+    }));
+}
+
 // Establish chatsocket connection
 const chatSocket = new ReconnectingWebSocket(
     'ws://'
@@ -48,19 +103,56 @@ const chatSocket = new ReconnectingWebSocket(
 
 // Chatsocket functions
 
+var rendered = false;
+
 chatSocket.onopen = function(e) {
-    var existingMessages = JSON.parse(localStorage.getItem('chatMessages')) || [];
+    // Also called on every reconnect, render the stored messages only once
+    if (!rendered) {
+        var existingMessages = JSON.parse(localStorage.getItem('chatMessages')) || [];
+
+        // Render existing messages in the chat interface
+        existingMessages.forEach(message => {
+            message_load(message.content, message.timestamp, message.role)
+        });
+        rendered = true;
+    }
 
-    // Render existing messages in the chat interface
-    existingMessages.forEach(message => {
-        message_load(message.content, message.timestamp, message.role)
-    });
+    // Ask for the messages and replies sent while we were away
+    if (seen.epoch !== null) {
+        chatSocket.send(JSON.stringify({
+            'command': 'resume',
+            'epoch': seen.epoch,
+            'last_seq': Math.max(0, ...seen.seqs),
+        }));
+    }
 }
 
 chatSocket.onmessage = function(e) {
     const data = JSON.parse(e.data);
     console.log(data)
 
+    // The server lost our session, resend the history once
+    if ('session_missing' in data) {
+        send_all_messages(data['message_new']);
+        return;
+    }
+
+    // Too many messages or the assistant is overloaded, nothing was sent to the room
+    if ('busy' in data) {
+        var now = new Date().toLocaleTimeString([], { hour: '2-digit', minute: '2-digit', hour12: false });
+        message_load('The assistant is busy, please try again in ' + data['retry_after'] + ' seconds.', now, 'assistant');
+        const messageInputDom = document.querySelector('#chat-message-input');
+        if (messageInputDom.value === '') {
+            messageInputDom.value = data['message_new']; // Give the message back to resend
+        }
+        return;
+    }
+
+    // Replayed after a reconnect and already shown
+    if ('seq' in data && !seen_store(data['epoch'], data['seq'])) {
+        return;
+    }
+
     var message = data['message']
     var assistant_message = data['assistant_message']
 
@@ -78,9 +170,21 @@ chatSocket.onmessage = function(e) {
         message_store(message, currentTime, 'user'); // Store in local storage
     }
     
+    // Handler for streamed parts of assistant messages
+    if ('assistant_message_delta' in data) {
+        message_stream(data['assistant_message_delta'], currentTime, data['stream_id']); // Show partial message in html
+    }
+
     // Handler for assistant messages
     if ('assistant_message' in data) {
-        message_load(assistant_message, currentTime, 'assistant'); // Show messages in html
+        var stream = streamingMessages[data['stream_id']];
+        if (stream !== undefined) {
+            // Replace the streamed text with the final message
+            stream.element.querySelector('p').innerHTML = assistant_message;
+            delete streamingMessages[data['stream_id']];
+        } else {
+            message_load(assistant_message, currentTime, 'assistant'); // Show messages in html
+        }
         message_store(assistant_message, currentTime, 'assistant'); // Store in local storage
     }    
 
@@ -102,15 +206,13 @@ document.querySelector('#chat-message-input').onkeyup = function(e) {
 document.querySelector('#chat-message-submit').onclick = function(e) {
     const messageInputDom = document.querySelector('#chat-message-input');
     const message = messageInputDom.value;
-    const existingMessages = JSON.parse(localStorage.getItem('chatMessages'));
-    console.log(existingMessages)
     console.log(message)
 
-    // Handle new message and existing messages
+    // Only the new message is sent, the server keeps the history
     chatSocket.send(JSON.stringify({
-        'command': 'send_all_messages',
-        'message_new': message,
-        'messages': existingMessages,
+        'command': 'send_message',
+        'session_id': sessionId,
+        'message': message,
     }));
     messageInputDom.value = '';
 };
\ No newline at end of file